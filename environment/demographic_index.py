@@ -0,0 +1,156 @@
+import os
+import json
+import threading
+
+import numpy
+import pandas as pd
+
+from simulation_engine.default_settings import *
+from simulation_engine.settings import *
+
+
+INDEX_FILE = "scratch_index.json"
+
+
+class DemographicIndex:
+  """
+  A columnar index of the scratch.json attributes (e.g., "state", "age",
+  "political_views") of every agent in a population folder. It is kept
+  next to the agents in <population_dir>/scratch_index.json, and refresh()
+  only re-reads the scratch files that were added or modified since the
+  last refresh (by mtime), so selecting agents by their attributes does
+  not require loading every agent.
+
+  Queries are conjunctions of predicates on the attributes (see query).
+  """
+  def __init__(self, population_dir):
+    self.population_dir = population_dir
+    self.index_path = os.path.join(population_dir, INDEX_FILE)
+    self.lock = threading.Lock()
+    self.mtimes = dict()
+    self.table = pd.DataFrame()
+    self._load()
+
+
+  def _load(self):
+    if not os.path.exists(self.index_path):
+      return
+    try:
+      with open(self.index_path, "r") as f:
+        index = json.load(f)
+    except (json.JSONDecodeError, OSError):
+      return
+    self.mtimes = dict(zip(index["agent_ids"], index["mtimes"]))
+    self.table = pd.DataFrame(index["columns"], index=index["agent_ids"])
+
+
+  def _save(self):
+    # Missing attributes are saved as null. 
+    table = self.table.astype(object).where(self.table.notna(), None)
+    index = {"agent_ids": self.table.index.tolist(),
+             "mtimes": [self.mtimes[agent_id] for agent_id in self.table.index],
+             "columns": {field: table[field].tolist() 
+                         for field in table.columns}}
+    tmp_path = self.index_path + ".tmp"
+    with open(tmp_path, "w") as f:
+      json.dump(index, f)
+    os.replace(tmp_path, self.index_path)
+
+
+  def refresh(self):
+    """
+    Brings the index up to date with the scratch files of the population,
+    and returns the number of agents that were (re-)read or dropped.
+    """
+    with self.lock:
+      mtimes = dict()
+      for entry in os.scandir(self.population_dir):
+        if not entry.is_dir():
+          continue
+        try:
+          mtimes[entry.name] = os.stat(
+            os.path.join(entry.path, "scratch.json")).st_mtime_ns
+        except FileNotFoundError:
+          continue
+
+      changed = [agent_id for agent_id, mtime in mtimes.items()
+                 if self.mtimes.get(agent_id) != mtime]
+      removed = [agent_id for agent_id in self.mtimes
+                 if agent_id not in mtimes]
+      if not changed and not removed: 
+        return 0
+
+      rows = dict()
+      for agent_id in changed:
+        with open(os.path.join(self.population_dir, agent_id,
+                               "scratch.json"), "r") as f:
+          rows[agent_id] = json.load(f)
+      self.table = pd.concat([
+        self.table.drop(index=changed + removed, errors="ignore"), 
+        pd.DataFrame.from_dict(rows, orient="index")])
+      for agent_id in removed:
+        del self.mtimes[agent_id]
+      self.mtimes.update({agent_id: mtimes[agent_id] for agent_id in changed})
+      self._save()
+      return len(changed) + len(removed)
+
+
+  def _mask(self, field, predicate):
+    if field not in self.table.columns:
+      return numpy.zeros(len(self.table), dtype=bool)
+    column = self.table[field]
+    if isinstance(predicate, (list, tuple, set)):
+      return column.isin(list(predicate)).values
+    if not isinstance(predicate, dict):
+      return (column == predicate).values
+
+    mask = numpy.ones(len(self.table), dtype=bool)
+    if "in" in predicate:
+      mask &= column.isin(list(predicate["in"])).values
+    if "not_in" in predicate:
+      mask &= ~column.isin(list(predicate["not_in"])).values
+    if "min" in predicate or "max" in predicate:
+      values = pd.to_numeric(column, errors="coerce").values
+      if "min" in predicate:
+        mask &= values >= predicate["min"]
+      if "max" in predicate:
+        mask &= values <= predicate["max"]
+    return mask
+
+
+  def query(self, predicates):
+    """
+    Returns the ids of the agents that satisfy all the <predicates>.
+
+    Parameters:
+      predicates: A dictionary of {field: predicate}, where a predicate is
+        a value (equality), a list of values (membership), or a dict with
+        any of "min" and "max" (an inclusive numeric range), "in", and
+        "not_in". E.g., {"state": ["CA", "NY"], "age": {"min": 30,
+        "max": 49}, "political_views": {"not_in": ["Moderate"]}}.
+    Returns:
+      The list of the matching agent ids.
+    """
+    with self.lock:
+      mask = numpy.ones(len(self.table), dtype=bool)
+      for field, predicate in predicates.items():
+        mask &= self._mask(field, predicate)
+      return self.table.index[mask].tolist()
+
+
+_INDEXES = dict()
+_INDEXES_LOCK = threading.Lock()
+
+
+def demographic_index(population):
+  """
+  The DemographicIndex of <population> (a folder in POPULATIONS_DIR),
+  refreshed. The index is kept in memory between calls.
+  """
+  with _INDEXES_LOCK:
+    if population not in _INDEXES:
+      _INDEXES[population] = DemographicIndex(
+        os.path.join(POPULATIONS_DIR, population))
+    index = _INDEXES[population]
+  index.refresh()
+  return index
@@ -1,8 +1,57 @@
 import uuid
 import os
 import json
+import threading
 import pandas as pd
 
+from simulation_engine.concurrency import request_key
+
+
+class RunJournal:
+  """
+  An append-only JSON Lines file of the results of a run, written as each 
+  agent finishes so that a run that crashes (or runs out of quota) keeps 
+  everything it completed. Every record is flushed as soon as it is 
+  written; a last line cut short by a crash is ignored when reading. 
+  """
+  def __init__(self, path):
+    self.path = path
+    self.lock = threading.Lock()
+    if os.path.dirname(path): 
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+
+
+  def append(self, record):
+    line = json.dumps(record) + "\n"
+    with self.lock: 
+      with open(self.path, "a") as f: 
+        f.write(line)
+        f.flush()
+
+
+  def read(self):
+    """Returns the list of the records in the journal."""
+    if not os.path.exists(self.path): 
+      return []
+    records = []
+    with open(self.path, "r") as f: 
+      for line in f: 
+        try: 
+          records += [json.loads(line)]
+        except json.JSONDecodeError: 
+          continue
+    return records
+
+
+  def reset(self, records=[]):
+    """Replaces the content of the journal with <records>."""
+    tmp_path = self.path + ".tmp"
+    with self.lock: 
+      with open(tmp_path, "w") as f: 
+        for record in records: 
+          f.write(json.dumps(record) + "\n")
+      os.replace(tmp_path, self.path)
+
 
 class Environment:
   def __init__(self, env_type, saved_dir=None):
@@ -10,6 +59,7 @@ class Environment:
     self.env_id = f'{env_type}_{str(uuid.uuid4())[:15]}'
     self.agent_registry = dict()
     self.responses = None  # Will be different for Survey and Interview
+    self.journal = None
 
     if saved_dir:
       self._load_saved_env(saved_dir)
@@ -43,9 +93,80 @@ class Environment:
 
 
   def load_agents(self, agent_meta_list):
+    if self.journal: 
+      # Agents that the journal already registered (in the run that is being
+      # resumed) keep their agent_pid. 
+      registered = {(agent_meta.get("population"), agent_meta.get("agent_id")) 
+                    for agent_meta in self.agent_registry.values()}
+      agent_meta_list = [agent_meta for agent_meta in agent_meta_list 
+                         if (agent_meta.get("population"), 
+                             agent_meta.get("agent_id")) not in registered]
     new_agent_registry = {f'agent_pid_{str(uuid.uuid4())[:15]}': agent_meta 
                           for agent_meta in agent_meta_list}
     self.agent_registry.update(new_agent_registry)
+    if self.journal and new_agent_registry: 
+      self.journal.append({"type": "agents", "agents": new_agent_registry})
+
+
+  # ###################### JOURNAL ###################### #
+
+  def attach_journal(self, journal_path):
+    """
+    Streams the results of the following runs to the journal at 
+    <journal_path>. If the journal already exists (e.g., the previous run 
+    crashed), its agents and results are restored first, and the runs 
+    skip the agents the journal already has a result for. save() compacts 
+    the journal into the saved responses. 
+    """
+    self.journal = RunJournal(journal_path)
+    results = dict()
+    for record in self.journal.read(): 
+      if record["type"] == "agents": 
+        self.agent_registry.update(record["agents"])
+      elif record["type"] == "result": 
+        results.setdefault(record["run"], []).append(record)
+    for run_records in results.values(): 
+      self._replay_results(run_records)
+    self.journal.append({"type": "agents", "agents": self.agent_registry})
+
+
+  def _replay_results(self, run_records):
+    # This method will be overridden in child classes
+    pass
+
+
+  def _merge_shards(self, shard_envs):
+    # This method will be overridden in child classes
+    pass
+
+
+  def _run_key(self, *parts):
+    return request_key(self.env_type, *[json.dumps(part, sort_keys=True) 
+                                        for part in parts])
+
+
+  def _resume(self, run_key, agent_pids):
+    """
+    Returns ({agent_pid: output} for the agents of <agent_pids> that the 
+    journal has a result of run <run_key> for, [the other agents]). 
+    """
+    if not self.journal: 
+      return dict(), list(agent_pids)
+    done = {record["agent_pid"]: record["output"] 
+            for record in self.journal.read() 
+            if record["type"] == "result" and record["run"] == run_key}
+    done = {agent_pid: done[agent_pid] for agent_pid in agent_pids 
+            if agent_pid in done}
+    todo = [agent_pid for agent_pid in agent_pids if agent_pid not in done]
+    if done: 
+      print(f"Resuming: {len(done)} agents already done, {len(todo)} to go")
+    return done, todo
+
+
+  def _record(self, run_key, agent_pid, output, **meta):
+    if self.journal: 
+      self.journal.append({"type": "result", "run": run_key, 
+                           "agent_pid": agent_pid, "output": output, **meta})
 
 
   def package(self):
@@ -62,19 +183,24 @@ class Environment:
 
 
   def save(self, save_dir):
-    package = self.package()
     os.makedirs(save_dir, exist_ok=True)
 
     with open(os.path.join(save_dir, "meta.json"), 'w') as json_file:
-      json.dump(package["packaged_meta"], json_file, indent=2)
+      json.dump({"env_id": self.env_id}, json_file, indent=2)
 
     with open(os.path.join(save_dir, "agent_registry.json"), 'w') as json_file:
-      json.dump(package["packaged_agents"], json_file, indent=2)
+      json.dump(self.agent_registry, json_file, indent=2)
+
+    # The responses are written straight from self.responses, in the format 
+    # set in the settings, rather than from their packaged form. 
+    self._save_responses(save_dir)
 
-    self._save_responses(save_dir, package["packaged_responses"])
+    # The results in the journal are now in the saved responses. 
+    if self.journal: 
+      self.journal.reset([{"type": "agents", "agents": self.agent_registry}])
 
 
-  def _save_responses(self, save_dir, packaged_responses):
+  def _save_responses(self, save_dir):
     # This method will be overridden in child classes
     pass
 
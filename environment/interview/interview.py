@@ -1,28 +1,39 @@
-import json
-import concurrent.futures
-from concurrent.futures import ThreadPoolExecutor
 
+from simulation_engine.default_settings import *
 from simulation_engine.settings import *
 from simulation_engine.global_methods import *
+from simulation_engine.concurrency import ChainScheduler
+from simulation_engine.serialization import (read_json, read_jsonl, 
+                                             write_json, write_jsonl)
 from environment.environment import Environment 
 from genagents.genagents import GenerativeAgent
+from genagents.modules.interaction import DialogueState
 
 
 class Interview(Environment):
-  def __init__(self, saved_dir=None):
+  def __init__(self, saved_dir=None, journal_path=None):
     super().__init__('interview', saved_dir)
     if not saved_dir: 
       self.responses = {}
+    if journal_path: 
+      self.attach_journal(journal_path)
 
 
   def _load_responses(self, saved_dir):
+    # responses.jsonl (one agent per line) or responses.json, whichever was 
+    # saved. 
+    jsonl_path = os.path.join(saved_dir, "responses.jsonl")
     responses_path = os.path.join(saved_dir, "responses.json")
 
-    if os.path.exists(responses_path):
-      with open(responses_path, 'r') as f:
-        self.responses = json.load(f)
+    if os.path.exists(jsonl_path):
+      self.responses = {record["agent_pid"]: record["transcript"] 
+                        for record in read_jsonl(jsonl_path)}
+      print(f"Loaded responses from {jsonl_path}")
+    elif os.path.exists(responses_path):
+      self.responses = read_json(responses_path)
       print(f"Loaded responses from {responses_path}")
     else:
+      self.responses = {}
       print(f"Responses file not found at {responses_path}")
 
 
@@ -30,44 +41,101 @@ class Interview(Environment):
     return self.responses
 
 
-  def _save_responses(self, save_dir, packaged_responses):
-    with open(os.path.join(save_dir, "responses.json"), 'w') as json_file:
-        json.dump(packaged_responses, json_file, indent=2)
-
-
-  def _interview_agent(self, agent_pid, agent_meta, interview_script, context):
+  def _save_responses(self, save_dir):
+    paths = {"json": os.path.join(save_dir, "responses.json"), 
+             "jsonl": os.path.join(save_dir, "responses.jsonl")}
+    if TRANSCRIPTS_FORMAT == "jsonl": 
+      write_jsonl([{"agent_pid": agent_pid, "transcript": transcript} 
+                   for agent_pid, transcript in self.responses.items()], 
+                  paths["jsonl"])
+    else: 
+      write_json(self.responses, paths["json"])
+    # A file left in the other format would shadow or go stale. 
+    for fmt, path in paths.items(): 
+      if fmt != TRANSCRIPTS_FORMAT and os.path.exists(path): 
+        os.remove(path)
+
+
+  def _load_agent(self, agent_meta):
+    return GenerativeAgent(os.path.join(POPULATIONS_DIR, 
+                                        agent_meta["population"], 
+                                        agent_meta["agent_id"]))
+
+
+  def _interview_chain(self, agent_pid, agent_meta, interview_script, context):
+    """
+    The interview of one agent as a chain of steps for the ChainScheduler: 
+    loading the agent, then one step per turn. Returns the transcript. 
+    """
     print (f"working on {agent_pid}")
-    curr_agent = GenerativeAgent(agent_meta["population"], agent_meta["agent_id"])
-    agent_responses = []
+    curr_agent = self._load_agent(agent_meta)
+    yield
+    if INTERVIEW_DIALOGUE_STATE: 
+      # Windowed, summarized transcript (see DialogueState). 
+      dialogue = DialogueState()
+      add_turn = dialogue.append
+    else: 
+      dialogue = []
+      add_turn = lambda speaker, text: dialogue.append([speaker, text])
     for interview_q, duration in interview_script:
-      agent_responses.append(["Interviewer", interview_q])
-      agent_response = curr_agent.utterance(agent_responses, context)
-      agent_responses.append([curr_agent.scratch.get_fullname(), agent_response])
-    return agent_pid, agent_responses
-
-
-  def interview(self, interview_script, context, num_threads=50):
-    with ThreadPoolExecutor(max_workers=num_threads) as executor:
-      future_to_agent = {executor.submit(self._interview_agent, agent_pid, agent_meta, interview_script, context): agent_pid 
-                         for agent_pid, agent_meta in self.agent_registry.items()}
-      
-      for future in concurrent.futures.as_completed(future_to_agent):
-        agent_pid = future_to_agent[future]
-        try:
-          agent_pid, agent_responses = future.result()
-          if agent_pid not in self.responses:
-            self.responses[agent_pid] = []
-
-          print (self.responses[agent_pid])
-          self.responses[agent_pid] += agent_responses
-        except Exception as exc:
+      add_turn("Interviewer", interview_q)
+      agent_response = curr_agent.utterance(dialogue, context)
+      add_turn(curr_agent.get_fullname(), agent_response)
+      yield
+    return dialogue.turns if INTERVIEW_DIALOGUE_STATE else dialogue
+
+
+  def interview_stream(self, interview_script, context, num_threads=50):
+    """
+    Interviews every agent, interleaving the turns of all the interviews on 
+    one pool of <num_threads> threads, and yields (agent_pid, transcript) 
+    as each interview finishes. With a journal attached, each transcript is 
+    journaled before it is yielded, and the agents that already have a 
+    transcript of this interview in the journal are skipped. 
+    """
+    run_key = self._run_key(interview_script, context)
+    _, todo = self._resume(run_key, list(self.agent_registry))
+
+    scheduler = ChainScheduler(max_workers=num_threads)
+    for agent_pid in todo: 
+      scheduler.submit(agent_pid, self._interview_chain(
+        agent_pid, self.agent_registry[agent_pid], interview_script, context))
+    try: 
+      for agent_pid, agent_responses, exc in scheduler.as_completed(): 
+        if exc is not None: 
           print(f'{agent_pid} generated an exception: {exc}')
+          continue
+        self._record(run_key, agent_pid, agent_responses)
+        yield agent_pid, agent_responses
+    finally: 
+      scheduler.shutdown()
 
-    return self.responses
 
+  def _add_transcript(self, agent_pid, agent_responses): 
+    if agent_pid not in self.responses:
+      self.responses[agent_pid] = []
+    self.responses[agent_pid] += agent_responses
 
 
+  def _replay_results(self, run_records):
+    for record in run_records: 
+      self._add_transcript(record["agent_pid"], record["output"])
 
 
+  def _merge_shards(self, shard_envs):
+    transcripts = dict()
+    for shard in shard_envs: 
+      for agent_pid in shard.agent_registry: 
+        if agent_pid in shard.responses: 
+          transcripts[agent_pid] = shard.responses[agent_pid]
+    for agent_pid in self.agent_registry: 
+      if agent_pid in transcripts: 
+        self.responses[agent_pid] = transcripts[agent_pid]
 
 
+  def interview(self, interview_script, context, num_threads=50):
+    for agent_pid, agent_responses in self.interview_stream(
+        interview_script, context, num_threads): 
+      self._add_transcript(agent_pid, agent_responses)
+
+    return self.responses
@@ -0,0 +1,125 @@
+import os
+import sys
+import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from simulation_engine.global_methods import *
+from simulation_engine.gpt_structure import set_rate_share
+from environment.survey.survey import Survey
+from environment.interview.interview import Interview
+
+
+ENVIRONMENTS = {"survey": Survey, "interview": Interview}
+
+
+def shard_agents(agent_pids, num_shards):
+  """
+  Splits <agent_pids> into <num_shards> lists, round robin in the given
+  order, so the shards are balanced and the split is the same on every
+  machine.
+  """
+  return [list(agent_pids)[i::num_shards] for i in range(num_shards)]
+
+
+def _shard_path(shard_dir, shard_index):
+  return os.path.join(shard_dir, f"shard_{shard_index}")
+
+
+def run_shard(shard_dir, shard_index):
+  """
+  Runs shard <shard_index> of the plan in <shard_dir> (see
+  ShardedRun.prepare): loads the environment, keeps only the shard's
+  agents, runs the planned method with this process's share of the rate
+  limits, and saves the result in the shard's folder. The shard's results
+  are journaled, so running a shard again after a crash resumes it.
+  """
+  with open(os.path.join(shard_dir, "plan.json"), "r") as f:
+    plan = json.load(f)
+  shard_path = _shard_path(shard_dir, shard_index)
+  shard_pids = shard_agents(plan["agent_pids"], plan["num_shards"])[shard_index]
+
+  set_rate_share(1 / plan["num_shards"])
+  env = ENVIRONMENTS[plan["env_type"]](saved_dir=os.path.join(shard_dir, "base"))
+  env.agent_registry = {agent_pid: env.agent_registry[agent_pid]
+                        for agent_pid in shard_pids}
+  env.attach_journal(os.path.join(shard_path, "journal.jsonl"))
+
+  getattr(env, plan["method"])(*plan["args"], **plan["kwargs"])
+  env.save(os.path.join(shard_path, "saved"))
+  write_dict_to_json({"agents": len(shard_pids)},
+                     os.path.join(shard_path, "done.json"))
+  return shard_index
+
+
+class ShardedRun:
+  """
+  Runs a Survey or Interview method over the agents of <env> in
+  <num_shards> processes. Each shard is a process with its own clients,
+  GIL, and 1/<num_shards> of the rate limits, and works on a round-robin
+  slice of the agent registry.
+
+  The shards communicate only through <shard_dir>: prepare() writes the
+  environment and the plan there, each shard writes its result to its own
+  folder, and merge() folds the results back into <env> in the order of
+  the agent registry, so the outcome does not depend on the number of
+  shards or the order in which they finish. run() does all three on a
+  local process pool; on several machines sharing <shard_dir>, call
+  prepare(), run `python -m environment.sharded <shard_dir> <shard_index>`
+  for each shard, then call merge().
+  """
+  def __init__(self, env, shard_dir, num_shards=None):
+    self.env = env
+    self.shard_dir = shard_dir
+    self.num_shards = num_shards or os.cpu_count()
+
+
+  def prepare(self, method, *args, **kwargs):
+    """
+    Writes the plan for running env.<method>(*args, **kwargs) over the
+    shards. The arguments must be JSON serializable.
+    """
+    self.env.save(os.path.join(self.shard_dir, "base"))
+    write_dict_to_json({"env_type": self.env.env_type,
+                        "method": method,
+                        "args": args,
+                        "kwargs": kwargs,
+                        "num_shards": self.num_shards,
+                        "agent_pids": list(self.env.agent_registry)},
+                       os.path.join(self.shard_dir, "plan.json"))
+
+
+  def run(self, method, *args, **kwargs):
+    """
+    Runs env.<method>(*args, **kwargs) over the shards on a local process
+    pool and merges the results into the environment.
+    """
+    self.prepare(method, *args, **kwargs)
+    # Forking a process that already runs the client threads is unsafe, so
+    # the shards start from fresh interpreters.
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=self.num_shards,
+                             mp_context=context) as executor:
+      futures = [executor.submit(run_shard, self.shard_dir, shard_index)
+                 for shard_index in range(self.num_shards)]
+      for future in futures:
+        future.result()
+    return self.merge()
+
+
+  def merge(self):
+    """Merges the results of all the shards into the environment."""
+    shard_envs = []
+    for shard_index in range(self.num_shards):
+      shard_path = _shard_path(self.shard_dir, shard_index)
+      if not os.path.exists(os.path.join(shard_path, "done.json")):
+        raise RuntimeError(f"Shard {shard_index} has not finished.")
+      shard_envs += [ENVIRONMENTS[self.env.env_type](
+        saved_dir=os.path.join(shard_path, "saved"))]
+    self.env._load_responses(os.path.join(self.shard_dir, "base"))
+    self.env._merge_shards(shard_envs)
+    return self.env.responses
+
+
+if __name__ == "__main__":
+  run_shard(sys.argv[1], int(sys.argv[2]))
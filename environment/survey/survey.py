@@ -1,27 +1,187 @@
+import math
+import random
+import statistics
 import pandas as pd
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
+from simulation_engine.default_settings import *
 from simulation_engine.settings import *
 from simulation_engine.global_methods import *
 from environment.environment import Environment 
+from environment.demographic_index import demographic_index
+from simulation_engine.gpt_structure import *
+from simulation_engine.serialization import find_table, read_table, write_table
 from genagents.genagents import GenerativeAgent
+from genagents.modules.interaction import (_in_options, _match_items, 
+                                           categorical_resp_prompt, 
+                                           categorical_resp_format,
+                                           complete_categorical_resp,
+                                           run_gpt_generate_categorical_resp)
+
+
+# The ways Survey.survey can administer the questions. 
+SURVEY_MODES = ("interactive", "batch", "logprobs")
+
+
+class ResponseAccumulator: 
+  """
+  Collects the outputs of a survey run into columns (one list per question, 
+  in the order the agents were added) and merges them into the responses 
+  table with a single vectorized upsert, instead of one lookup and update 
+  per agent. 
+  """
+  def __init__(self, questions): 
+    self.questions = list(questions)
+    self.agent_pids = []
+    self.columns = {question: [] for question in self.questions}
+
+
+  def add(self, output): 
+    self.agent_pids += [output["agent_pid"]]
+    for count, question in enumerate(self.questions): 
+      self.columns[question] += [output["responses"][count]]
+
+
+  def add_frame(self, frame): 
+    """Adds the rows of a responses table that has all the questions."""
+    self.agent_pids += frame["agent_pid"].tolist()
+    for question in self.questions: 
+      self.columns[question] += frame[question].tolist()
+
+
+  def frame(self): 
+    """The accumulated responses, one row per agent (the last one wins)."""
+    frame = pd.DataFrame({"agent_pid": self.agent_pids, **self.columns})
+    return frame.drop_duplicates("agent_pid", keep="last")
+
+
+  def upsert(self, responses): 
+    """
+    Returns <responses> with the accumulated responses merged in: the 
+    agents that already have a row get these questions' columns 
+    overwritten, and the new agents are appended in the order they were 
+    added. 
+    """
+    new = self.frame().set_index("agent_pid")
+    if responses is None or responses.empty: 
+      return new.reset_index()
+
+    merged = responses.set_index("agent_pid")
+    added = new.index[~new.index.isin(merged.index)]
+    merged = merged.reindex(index=merged.index.append(added), 
+                            columns=merged.columns.union(new.columns, 
+                                                         sort=False))
+    merged = merged.astype({question: object for question in new.columns})
+    merged.loc[new.index, new.columns] = new
+    return merged.reset_index()
+
+
+def _column_names(texts): 
+  """
+  The response column of each question text: the text itself, with " (2)", 
+  " (3)", ... appended to the repetitions of a text, so that questions with 
+  the same text get distinct columns. 
+  """
+  taken = set(texts)
+  ret = []
+  for text in texts: 
+    name, count = text, 1
+    while name in ret: 
+      count += 1
+      name = f"{text} ({count})"
+      # Not the text of another question either. 
+      while name in taken: 
+        count += 1
+        name = f"{text} ({count})"
+    ret += [name]
+  return ret
+
+
+def _allocate_batch(weights, sampled, remaining, batch_size): 
+  """
+  Splits the next batch of <batch_size> agents between the strata, in 
+  proportion to their <weights> (population shares) given the number of 
+  agents <sampled> from each so far, and without exceeding the agents 
+  <remaining> in each. Returns {stratum: count}. 
+  """
+  total = sum(sampled.values()) + batch_size
+  target = min(batch_size, sum(len(remaining[h]) for h in weights))
+  # The strata that are behind their share, scaled to the batch. 
+  want = {h: max(0.0, weights[h] * total - sampled[h]) for h in weights}
+  scale = target / sum(want.values()) if sum(want.values()) else 0.0
+  alloc = {h: min(len(remaining[h]), int(want[h] * scale)) for h in weights}
+  left = target - sum(alloc.values())
+  while left > 0: 
+    # The leftover goes to the strata that are the most behind. 
+    for h in sorted(weights, key=lambda h: weights[h] * total 
+                                           - sampled[h] - alloc[h], 
+                    reverse=True): 
+      if left > 0 and alloc[h] < len(remaining[h]): 
+        alloc[h] += 1
+        left -= 1
+  return alloc
+
+
+def _stratified_estimate(answers, options, population, z): 
+  """
+  The post-stratified share of each option and its confidence interval. 
+
+  Parameters:
+    answers: {stratum: [valid answers of the sampled agents]}
+    options: The options of the question. 
+    population: {stratum: number of agents in the population}
+    z: The normal quantile of the confidence level. 
+  Returns: 
+    {option: {"estimate": share, "ci": [low, high], "margin": half width}}
+  """
+  # Strata without answers yet are left out, and the weights renormalized. 
+  sampled = {h: a for h, a in answers.items() if a}
+  if not sampled: 
+    return {option: {"estimate": None, "ci": [0.0, 1.0], "margin": math.inf} 
+            for option in options}
+  total = sum(population[h] for h in sampled)
+  ret = dict()
+  for option in options: 
+    estimate, variance = 0.0, 0.0
+    for h, a in sampled.items(): 
+      weight = population[h] / total
+      n = len(a)
+      count = sum(1 for answer in a if answer == option)
+      # The variance uses a smoothed share, so that a stratum where all the 
+      # few sampled agents agree does not look certain. 
+      smoothed = (count + 1) / (n + 2)
+      fpc = 1 - n / population[h]
+      estimate += weight * count / n
+      variance += weight ** 2 * smoothed * (1 - smoothed) / n * fpc
+    half_width = z * math.sqrt(variance)
+    ret[option] = {"estimate": estimate, 
+                   "ci": [max(0.0, estimate - half_width), 
+                          min(1.0, estimate + half_width)], 
+                   "margin": half_width}
+  return ret
 
 
 class Survey(Environment): 
-  def __init__(self, saved_dir=None):
+  def __init__(self, saved_dir=None, journal_path=None):
     super().__init__('survey', saved_dir)
     if not saved_dir: 
       self.responses = pd.DataFrame(columns=['agent_pid'])
-    
+    if journal_path: 
+      self.attach_journal(journal_path)
+
 
   def _load_responses(self, responses_path):
-    responses_path = os.path.join(responses_path, "responses.csv")
+    # responses.parquet or responses.csv, whichever was saved. 
+    table_path = find_table(os.path.join(responses_path, "responses"))
 
-    if os.path.exists(responses_path):
-      self.responses = pd.read_csv(responses_path)
-      print(f"Loaded responses from {responses_path}")
+    if table_path: 
+      self.responses = read_table(table_path)
+      print(f"Loaded responses from {table_path}")
     else:
-      print(f"Responses file not found at {responses_path}")
+      print(f"Responses file not found in {responses_path}")
+    if self.responses is None or 'agent_pid' not in self.responses.columns: 
+      # An environment saved without responses may have an empty file. 
+      self.responses = pd.DataFrame(columns=['agent_pid'])
 
 
   def _package_responses(self):
@@ -33,58 +193,445 @@ class Survey(Environment):
     return [self.responses.columns.tolist()] + self.responses[columns].values.tolist()
 
 
-  def _save_responses(self, save_dir, packaged_responses):
-    write_list_of_list_to_csv(packaged_responses, os.path.join(save_dir, "responses.csv"))
+  def _save_responses(self, save_dir):
+    columns = ['agent_pid'] + [col for col in self.responses.columns if col != 'agent_pid']
+    write_table(self.responses[columns], os.path.join(save_dir, "responses"), 
+                RESPONSES_FORMAT)
 
 
-  def _administer_to_agent(self, agent_pid, questions):
+  def _load_agent(self, agent_pid):
     population = self.agent_registry[agent_pid]["population"]
     agent_id = self.agent_registry[agent_pid]["agent_id"]
+    return GenerativeAgent(os.path.join(POPULATIONS_DIR, population, agent_id))
+
 
-    agent = GenerativeAgent(population, agent_id)
+  def _administer_to_agent(self, agent_pid, questions, samples=1):
+    agent = self._load_agent(agent_pid)
     print (f"Generating {agent_pid}'s response")
-    output = agent.categorical_resp(questions) 
+    output = agent.categorical_resp(questions, samples) 
     output["agent_pid"] = agent_pid
     print (output)
     return output
 
 
+  def _dist_for_agent(self, agent_pid, questions):
+    agent = self._load_agent(agent_pid)
+    output = agent.categorical_dist(questions)
+    output["agent_pid"] = agent_pid
+    return output
+
+
+  def _ask_agent(self, agent_pid, questions):
+    agent = self._load_agent(agent_pid)
+    output = agent.ask(questions)
+    output["agent_pid"] = agent_pid
+    return output
+
+
   def _filter_agents(self, inclusion_criteria):
+    inclusion_criteria = dict(inclusion_criteria)
+    scratch_criteria = inclusion_criteria.pop("scratch", None)
+    filtered_agents = list(self.agent_registry)
+
     if inclusion_criteria:
       # Apply inclusion criteria as filters on the DataFrame
       criteria = [(self.responses[question].isin(allowed_responses)) 
                 for question, allowed_responses in inclusion_criteria.items()]
       mask = pd.concat(criteria, axis=1).all(axis=1)
       filtered_agents = self.responses[mask]['agent_pid'].unique()
-      return list(filtered_agents)
-    return list(self.agent_registry)
+      filtered_agents = [agent_pid for agent_pid in filtered_agents 
+                         if agent_pid in self.agent_registry]
+
+    if scratch_criteria: 
+      # The scratch predicates are resolved on the demographic index of 
+      # each population, without loading the agents. 
+      matches = dict()
+      for agent_pid in filtered_agents: 
+        population = self.agent_registry[agent_pid]["population"]
+        if population not in matches: 
+          matches[population] = set(
+            demographic_index(population).query(scratch_criteria))
+      filtered_agents = [agent_pid for agent_pid in filtered_agents 
+                         if self.agent_registry[agent_pid]["agent_id"] 
+                         in matches[self.agent_registry[agent_pid]["population"]]]
+    return filtered_agents
+
+
+  def _render_for_agent(self, agent_pid, questions):
+    agent = self._load_agent(agent_pid)
+    prompt, _ = categorical_resp_prompt(agent, questions)
+    request = {"custom_id": agent_pid, "prompt": prompt, "model": LLM_VERS}
+    response_format = structured_format(
+      LLM_VERS, categorical_resp_format(questions))
+    if response_format: 
+      request["response_format"] = response_format
+    return request
+
+
+  def _survey_batch(self, filtered_agents, questions, num_threads, 
+                    batch_id, batch_dir, batch_client, poll_interval):
+    """
+    Runs the survey through the Batch API. Every agent's prompt is rendered 
+    (retrieval still runs locally), written to a JSONL batch file, and 
+    submitted as one batch job. If <batch_id> is given, we skip straight to 
+    polling that job, which lets us resume a run that was interrupted. 
+    """
+    batch_dir = batch_dir or os.path.join(BASE_DIR, "batch_jobs", self.env_id)
+
+    if not batch_id: 
+      with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        futures = [executor.submit(self._render_for_agent, agent_pid, questions) 
+                   for agent_pid in filtered_agents]
+        batch_requests = [future.result() for future in futures]
+
+      batch_file = write_batch_file(batch_requests, 
+                                    os.path.join(batch_dir, "batch_input.jsonl"))
+      batch_id = submit_batch(batch_file, batch_client)
+      write_dict_to_json({"batch_id": batch_id, 
+                          "batch_file": batch_file, 
+                          "questions": questions}, 
+                         os.path.join(batch_dir, "batch_meta.json"))
+      print (f"Submitted batch {batch_id} with {len(batch_requests)} requests")
+
+    batch = wait_for_batch(batch_id, batch_client, poll_interval)
+    if batch.status != "completed": 
+      print (f"Batch {batch_id} ended with status {batch.status}")
+      return []
+    results = retrieve_batch_results(batch, batch_client)
+
+    # The parser only depends on the questions, so we get it from a prompt
+    # rendered with an empty agent description. 
+    _, func_clean_up = run_gpt_generate_categorical_resp(
+      "", questions, "1", LLM_VERS, prompt_only=True)
+
+    outputs = dict()
+    to_repair = dict()
+    for agent_pid in filtered_agents: 
+      output = func_clean_up(results.get(agent_pid, ""))
+      # The items are matched to the questions by their echoes, like in the 
+      # interactive mode, since a complete reply may still be reordered. 
+      matched = _match_items(questions, output)
+      if all(question in matched and _in_options(matched[question][0], options) 
+             for question, options in questions.items()): 
+        outputs[agent_pid] = {
+          "responses": [matched[question][0] for question in questions], 
+          "reasonings": [matched[question][1] for question in questions]}
+      else: 
+        to_repair[agent_pid] = output
+
+    # Only the missing or invalid items of these agents are re-issued, as 
+    # regular requests. 
+    if to_repair: 
+      print (f"Re-issuing the missing items of {len(to_repair)} agents")
+      with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        futures = {agent_pid: executor.submit(self._complete_for_agent, 
+                                              agent_pid, questions, output) 
+                   for agent_pid, output in to_repair.items()}
+        for agent_pid, future in futures.items(): 
+          outputs[agent_pid] = future.result()
 
+    ret = []
+    for agent_pid in filtered_agents: 
+      outputs[agent_pid]["agent_pid"] = agent_pid
+      ret += [outputs[agent_pid]]
+    return ret
+
+
+  def _complete_for_agent(self, agent_pid, questions, output): 
+    agent = self._load_agent(agent_pid)
+    return complete_categorical_resp(agent, questions, output)
+
+
+  def _merge_outputs(self, outputs, questions):
+    accumulator = ResponseAccumulator(list(questions))
+    for output in outputs:
+      accumulator.add(output)
+    self.responses = accumulator.upsert(self.responses)
+
+
+  def _replay_results(self, run_records):
+    outputs = [dict(record["output"], agent_pid=record["agent_pid"]) 
+               for record in run_records]
+    self._merge_outputs(outputs, run_records[0]["questions"])
+
+
+  def _merge_shards(self, shard_envs):
+    order = {agent_pid: count 
+             for count, agent_pid in enumerate(self.agent_registry)}
+    frame = pd.concat([shard.responses[shard.responses["agent_pid"].isin(
+                         list(shard.agent_registry))] 
+                       for shard in shard_envs])
+    frame = frame.sort_values("agent_pid", kind="stable", 
+                              key=lambda agent_pids: agent_pids.map(order))
+    accumulator = ResponseAccumulator([col for col in frame.columns 
+                                       if col != "agent_pid"])
+    accumulator.add_frame(frame)
+    self.responses = accumulator.upsert(self.responses)
+
+
+  def _administer_journaled(self, run_key, agent_pids, columns, fn, 
+                            num_threads):
+    """
+    Runs fn(agent_pid) for the <agent_pids> on <num_threads> threads, 
+    journaling each output (the responses to the <columns>) as soon as its 
+    agent is done. The agents the journal already has an output of run 
+    <run_key> for are not run again. Returns the outputs in the order of 
+    <agent_pids>. 
+    """
+    outputs, todo = self._resume(run_key, agent_pids)
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+      futures = [executor.submit(fn, agent_pid) for agent_pid in todo]
+      for future in as_completed(futures): 
+        output = future.result()
+        self._record(run_key, output["agent_pid"], output, 
+                     questions=list(columns))
+        outputs[output["agent_pid"]] = output
+    return [dict(outputs[agent_pid], agent_pid=agent_pid) 
+            for agent_pid in agent_pids]
+
+
+  def survey(self, questions, inclusion_criteria={}, num_threads=50, 
+             mode="interactive", batch_id=None, batch_dir=None, 
+             batch_client=None, poll_interval=30, samples=1):
+    """
+    Administers the categorical <questions> to the agents. 
+
+    Parameters:
+      questions: A dictionary of {question: [options]}. 
+      inclusion_criteria: A dictionary of {question: [allowed_responses]} 
+        that filters the agents on their previous responses. Its "scratch" 
+        entry, if any, filters the agents on their scratch attributes (see 
+        DemographicIndex.query), e.g., {"scratch": {"state": ["CA"]}}. 
+      num_threads: Number of threads used to query (or render) the agents. 
+      mode: "interactive" queries each agent with a regular request. "batch" 
+        sends all prompts as one job through the Batch API. "logprobs" 
+        reads each agent's distribution over the options from the 
+        log-probabilities of one call per question (see 
+        GenerativeAgent.categorical_dist); the merged responses are the most 
+        likely options. 
+      batch_id: (batch mode) Resume polling an already submitted batch. 
+      batch_dir: (batch mode) Where the batch file and its meta are written. 
+      batch_client: (batch mode) The client for the Batch API; defaults to 
+        the OpenAI client. Pass a FakeBatchClient to run offline. 
+      poll_interval: (batch mode) Seconds between two polls of the batch.
+      samples: (interactive mode) Samples every agent's answers this many 
+        times in one call per agent. The merged responses are the most 
+        frequent answers, and each output also has the "distributions" of 
+        the agent's answers. 
+    With a journal attached (see attach_journal), each agent's output is 
+    journaled as soon as it is done, and the agents that already have an 
+    output for these questions in the journal are skipped. 
+    Returns: 
+      The list of the agents' outputs. 
+    """
+    if mode not in SURVEY_MODES: 
+      raise ValueError(f"Unknown survey mode {mode!r}; expected one of "
+                       f"{', '.join(SURVEY_MODES)}.")
+    if mode == "batch" and samples > 1: 
+      raise ValueError("Sampling is only supported in interactive mode.")
 
-  def survey(self, questions, inclusion_criteria={}, num_threads=50):
     filtered_agents = self._filter_agents(inclusion_criteria)
 
     if not filtered_agents:
       print("No agents meet the inclusion criteria.")
       return []
 
-    with ThreadPoolExecutor(max_workers=num_threads) as executor:
-      futures = [executor.submit(self._administer_to_agent, agent_pid, questions) 
-                 for agent_pid in filtered_agents]
-      outputs = [future.result() for future in futures]
+    metrics_baseline = METRICS.snapshot()
 
-    for output in outputs:
-      response_data = {question: output["responses"][i] 
-                       for i, question in enumerate(questions.keys())}
-      response_data["agent_pid"] = output["agent_pid"]
-
-      if (self.responses['agent_pid'] == output["agent_pid"]).any():
-        idx = self.responses[self.responses['agent_pid'] == output["agent_pid"]].index
-        for key, value in response_data.items():
-            self.responses.loc[idx, key] = value
-      else:
-        self.responses = pd.concat([self.responses, 
-                                    pd.DataFrame([response_data])], 
-                                    ignore_index=True)
+    run_key = self._run_key("categorical", questions)
+    if samples > 1: 
+      run_key = self._run_key("categorical", questions, samples)
+    if mode == "logprobs": 
+      outputs = self._administer_journaled(
+        self._run_key("categorical_dist", questions), filtered_agents, 
+        questions, lambda agent_pid: self._dist_for_agent(agent_pid, questions), 
+        num_threads)
+    elif mode == "batch": 
+      done, todo = self._resume(run_key, filtered_agents)
+      if todo: 
+        for output in self._survey_batch(todo, questions, num_threads, 
+                                         batch_id, batch_dir, batch_client, 
+                                         poll_interval): 
+          self._record(run_key, output["agent_pid"], output, 
+                       questions=list(questions))
+          done[output["agent_pid"]] = output
+      outputs = [dict(done[agent_pid], agent_pid=agent_pid) 
+                 for agent_pid in filtered_agents if agent_pid in done]
+    else: 
+      outputs = self._administer_journaled(
+        run_key, filtered_agents, questions, 
+        lambda agent_pid: self._administer_to_agent(agent_pid, questions, 
+                                                    samples), 
+        num_threads)
+
+    self._merge_outputs(outputs, questions)
 
+    print (METRICS.summary(metrics_baseline))
     return outputs
 
+
+  def ask_population(self, questions, inclusion_criteria={}, num_threads=50):
+    """
+    Administers a mixed questionnaire (see GenerativeAgent.ask) to the 
+    agents, with one LLM call per agent (plus follow-ups for the responses 
+    that were missing or invalid). 
+
+    Parameters:
+      questions: A list of question dicts with "question", "response-type" 
+        (categorical, int, float, or open), and "response-options", 
+        "response-scale", or "response-char-limit". 
+      inclusion_criteria: A dictionary of {question: [allowed_responses]} 
+        that filters the agents on their previous responses, and on their 
+        scratch attributes with a "scratch" entry (see survey). 
+      num_threads: Number of threads used to query the agents. 
+    The responses are merged into one column per question, named after its 
+    text; repeated texts get " (2)", " (3)", ... appended. 
+    Returns: 
+      The list of the agents' outputs. 
+    """
+    filtered_agents = self._filter_agents(inclusion_criteria)
+
+    if not filtered_agents:
+      print("No agents meet the inclusion criteria.")
+      return []
+
+    metrics_baseline = METRICS.snapshot()
+
+    # One column per question, in order, even if some texts are repeated. 
+    columns = _column_names([q["question"] for q in questions])
+    outputs = self._administer_journaled(
+      self._run_key("ask", questions), filtered_agents, columns, 
+      lambda agent_pid: self._ask_agent(agent_pid, questions), 
+      num_threads)
+
+    self._merge_outputs(outputs, columns)
+
+    print (METRICS.summary(metrics_baseline))
+    return outputs
+
+
+  def _strata_of(self, agent_pids, strata): 
+    """
+    {agent_pid: stratum}, where an agent's stratum is the tuple of its 
+    values of the <strata> scratch fields (the empty tuple if no strata). 
+    The agents that are not in the demographic index (e.g., without a 
+    scratch.json) are put in an "unknown" stratum. 
+    """
+    tables = dict()
+    ret = dict()
+    unknown = 0
+    for agent_pid in agent_pids: 
+      agent_meta = self.agent_registry[agent_pid]
+      ret[agent_pid] = ()
+      if strata: 
+        if agent_meta["population"] not in tables: 
+          tables[agent_meta["population"]] = demographic_index(
+            agent_meta["population"]).table
+        table = tables[agent_meta["population"]]
+        if agent_meta["agent_id"] not in table.index: 
+          ret[agent_pid] = ("unknown",) * len(strata)
+          unknown += 1
+          continue
+        row = table.loc[agent_meta["agent_id"]]
+        ret[agent_pid] = tuple(str(row.get(field)) for field in strata)
+    if unknown: 
+      print(f"{unknown} agents are not in the demographic index of their "
+            f"population; they are estimated as an \"unknown\" stratum.")
+    return ret
+
+
+  def estimate(self, questions, precision=0.03, confidence=0.95, 
+               strata=None, batch_size=50, inclusion_criteria={}, 
+               num_threads=50, max_agents=None, seed=0): 
+    """
+    Estimates the population distribution of the answers to the categorical 
+    <questions> from a random sample of the agents, instead of surveying all 
+    of them. Agents are surveyed in random batches (stratified on the 
+    <strata> scratch fields, if given) until the confidence interval of 
+    every option's share is within +/- <precision>. The estimates are 
+    post-stratified: each stratum is weighted by its share of the 
+    population. The sampled agents' responses are merged into the 
+    responses like survey's. 
+
+    Parameters:
+      questions: A dictionary of {question: [options]}. 
+      precision: The target half-width of the confidence intervals. 
+      confidence: The confidence level of the intervals. 
+      strata: A list of scratch fields (e.g., ["sex", "race"]) to stratify 
+        the sample on, or None for a simple random sample. 
+      batch_size: Number of agents surveyed between two checks. 
+      inclusion_criteria: Restricts the population (see survey). 
+      num_threads: Number of threads used to query the agents. 
+      max_agents: Stop after surveying this many agents. 
+      seed: The seed of the random sample. 
+    Returns: 
+      A dictionary with "estimates" ({question: {option: {"estimate", 
+      "ci", "margin"}}}), "sampled" and "population" (the number of agents), and 
+      "converged" (whether the target precision was reached). 
+    """
+    filtered_agents = self._filter_agents(inclusion_criteria)
+    if not filtered_agents:
+      print("No agents meet the inclusion criteria.")
+      return {}
+
+    metrics_baseline = METRICS.snapshot()
+    z = statistics.NormalDist().inv_cdf((1 + confidence) / 2)
+    rng = random.Random(seed)
+
+    stratum_of = self._strata_of(filtered_agents, strata or [])
+    remaining = dict()
+    for agent_pid in filtered_agents: 
+      remaining.setdefault(stratum_of[agent_pid], []).append(agent_pid)
+    population = {h: len(agent_pids) for h, agent_pids in remaining.items()}
+    weights = {h: count / len(filtered_agents) 
+               for h, count in population.items()}
+    for agent_pids in remaining.values(): 
+      rng.shuffle(agent_pids)
+
+    run_key = self._run_key("categorical", questions)
+    max_agents = min(max_agents or len(filtered_agents), len(filtered_agents))
+    sampled = {h: 0 for h in remaining}
+    answers = {question: {h: [] for h in remaining} for question in questions}
+    outputs = []
+    converged = False
+    while not converged and len(outputs) < max_agents: 
+      alloc = _allocate_batch(weights, sampled, remaining, 
+                              min(batch_size, max_agents - len(outputs)))
+      batch = []
+      for h, count in alloc.items(): 
+        batch += remaining[h][:count]
+        remaining[h] = remaining[h][count:]
+        sampled[h] += count
+      batch_outputs = self._administer_journaled(
+        run_key, batch, questions, 
+        lambda agent_pid: self._administer_to_agent(agent_pid, questions), 
+        num_threads)
+      outputs += batch_outputs
+
+      for output in batch_outputs: 
+        for count, (question, options) in enumerate(questions.items()): 
+          resp = (output["responses"][count] 
+                  if count < len(output["responses"]) else None)
+          if resp in [str(option) for option in options]: 
+            answers[question][stratum_of[output["agent_pid"]]] += [resp]
+
+      estimates = {question: _stratified_estimate(
+                     answers[question], [str(option) for option in options], 
+                     population, z) 
+                   for question, options in questions.items()}
+      half_widths = [share["margin"] for question in estimates 
+                     for share in estimates[question].values()]
+      # Every stratum needs a couple of answers before its variance means 
+      # anything. 
+      covered = all(sampled[h] >= min(2, population[h]) for h in sampled)
+      converged = covered and max(half_widths) <= precision
+      print (f"Sampled {len(outputs)}/{len(filtered_agents)} agents, "
+             f"max CI half-width {max(half_widths):.3f}")
+
+    self._merge_outputs(outputs, questions)
+
+    print (METRICS.summary(metrics_baseline))
+    return {"estimates": estimates, 
+            "sampled": len(outputs), 
+            "population": len(filtered_agents), 
+            "converged": converged}
@@ -1,7 +1,11 @@
+import threading
 import uuid
+from collections import OrderedDict
 
 from genagents.modules.interaction import *
+from genagents.modules.interaction import _build_agent_desc
 from genagents.modules.memory_stream import *
+from simulation_engine.serialization import read_json, write_json
 
 
 # ############################################################################
@@ -17,12 +21,9 @@ class GenerativeAgent:
         return 
       
       # Loading the agent's memories. 
-      with open(f"{agent_folder}/scratch.json") as json_file:
-        scratch = json.load(json_file)
-      with open(f"{agent_folder}/memory_stream/embeddings.json") as json_file:
-        embeddings = json.load(json_file)
-      with open(f"{agent_folder}/memory_stream/nodes.json") as json_file:
-        nodes = json.load(json_file)
+      scratch = read_json(f"{agent_folder}/scratch.json")
+      embeddings = read_json(f"{agent_folder}/memory_stream/embeddings.json")
+      nodes = read_json(f"{agent_folder}/memory_stream/nodes.json")
 
       self.id = uuid.uuid4()
       self.scratch = scratch
@@ -71,20 +72,16 @@ class GenerativeAgent:
     
     # Saving the agent's memory stream. This includes saving the embeddings 
     # as well as the nodes. 
-    with open(f"{storage}/memory_stream/embeddings.json", "w") as json_file:
-      json.dump(self.memory_stream.embeddings, 
-                json_file)
-    with open(f"{storage}/memory_stream/nodes.json", "w") as json_file:
-      json.dump([node.package() for node in self.memory_stream.seq_nodes], 
-                json_file, indent=2)
+    write_json(self.memory_stream.embeddings, 
+               f"{storage}/memory_stream/embeddings.json")
+    write_json([node.package() for node in self.memory_stream.seq_nodes], 
+               f"{storage}/memory_stream/nodes.json")
 
     # Saving the agent's scratch memories. 
-    with open(f"{storage}/scratch.json", "w") as json_file:
-      json.dump(self.scratch, json_file, indent=2)
+    write_json(self.scratch, f"{storage}/scratch.json")
 
     # Saving the agent's meta information. 
-    with open(f"{storage}/meta.json", "w") as json_file:
-      json.dump(self.package(), json_file, indent=2)
+    write_json(self.package(), f"{storage}/meta.json")
 
 
   def get_fullname(self): 
@@ -93,7 +90,15 @@ class GenerativeAgent:
     else: 
       return ""
 
-  def get_self_description(self): 
+  def get_self_description(self, canonical=False): 
+    """
+    Returns the agent's scratch as a string. With <canonical>, the keys are 
+    sorted and the formatting is fixed so that the same scratch always 
+    renders to the same bytes (this keeps prompt prefixes cacheable). 
+    """
+    if canonical: 
+      return json.dumps(self.scratch, sort_keys=True, ensure_ascii=False, 
+                        default=str)
     return str(self.scratch)
 
   def remember(self, content, time_step=0): 
@@ -121,13 +126,43 @@ class GenerativeAgent:
     self.memory_stream.reflect(anchor, time_step)
 
 
-  def categorical_resp(self, questions): 
-    ret = categorical_resp(self, questions)
+  def categorical_resp(self, questions, samples=1): 
+    """
+    With <samples> > 1, the answers are sampled that many times in one LLM 
+    call, and the output also has their "samples" and "distributions". 
+    """
+    ret = categorical_resp(self, questions, samples)
     return ret
     
 
-  def numerical_resp(self, questions, float_resp=False): 
-    ret = numerical_resp(self, questions, float_resp)
+  def numerical_resp(self, questions, float_resp=False, samples=1): 
+    ret = numerical_resp(self, questions, float_resp, samples)
+    return ret
+
+
+  def categorical_dist(self, questions, fallback_samples=10): 
+    """
+    The probability of each option of the categorical <questions>, from the 
+    log-probabilities of one call per question (see 
+    interaction.categorical_dist). 
+    """
+    return categorical_dist(self, questions, fallback_samples)
+
+
+  def ask(self, questions): 
+    """
+    Asks a mixed questionnaire (categorical, int, float, and open questions) 
+    in one LLM call. 
+
+    Example: 
+      agent.ask([{"question": "Do you own a car?", 
+                  "response-type": "categorical", 
+                  "response-options": ["Yes", "No"]}, 
+                 {"question": "How many hours do you sleep?", 
+                  "response-type": "float", 
+                  "response-scale": [0, 24]}])
+    """
+    ret = ask(self, questions)
     return ret
 
 
@@ -136,3 +171,103 @@ class GenerativeAgent:
     return ret 
 
 
+  def utterance_stream(self, curr_dialogue, context=""): 
+    """
+    Generator that yields the agent's utterance as the tokens arrive. 
+
+    Example: 
+      for chunk in agent.utterance_stream(dialogue): 
+        print(chunk, end="", flush=True)
+    """
+    return utterance_stream(self, curr_dialogue, context)
+
+
+# ############################################################################
+# ###                          AGENT SESSION CLASS                         ###
+# ############################################################################
+
+class AgentSession: 
+  """
+  A warmed agent for asking it many questions in a row. The session builds 
+  the agent's retrieval index once (see RetrievalIndex) and caches the 
+  rendered agent descriptions by anchor, so that every question only pays 
+  for embedding its own anchor. 
+
+  If the session is given an <anchor>, every question uses it for the 
+  retrieval and the agent description is rendered once; with PROMPT_LAYOUT 
+  set to "cache", the description does not depend on the anchor anyway. 
+  Either way, every prompt of the session starts with the same prefix. 
+
+  Up to <cache_size> descriptions are kept, least recently used first out, 
+  so a long session with a new anchor every turn (e.g., a dialogue) does 
+  not keep growing. 
+
+  The session is a snapshot of the agent: call refresh() after adding 
+  memories to it. 
+
+  Example: 
+    session = AgentSession(agent)
+    for question, options in questionnaire.items(): 
+      session.categorical_resp({question: options})
+  """
+  def __init__(self, agent, anchor=None, cache_size=256): 
+    self.agent = agent
+    self.anchor = anchor
+    self.cache_size = cache_size
+    self.lock = threading.Lock()
+    self.refresh()
+
+
+  def refresh(self): 
+    with self.lock: 
+      self.index = self.agent.memory_stream.retrieval_index()
+      self.agent_descs = OrderedDict()
+
+
+  def get_fullname(self): 
+    return self.agent.get_fullname()
+
+
+  def agent_desc(self, anchor, site="agent_desc"): 
+    """The agent description for <anchor>, rendered once per anchor."""
+    if self.anchor is not None: 
+      anchor = self.anchor
+    if PROMPT_LAYOUT == "cache": 
+      anchor = None
+    key = (site, anchor)
+    with self.lock: 
+      if key in self.agent_descs: 
+        self.agent_descs.move_to_end(key)
+        return self.agent_descs[key]
+      index = self.index
+    agent_desc = _build_agent_desc(self.agent, anchor, AGENT_DESC_TOKEN_BUDGET, 
+                                   site, retriever=index.scored)
+    with self.lock: 
+      self.agent_descs[key] = agent_desc
+      while len(self.agent_descs) > self.cache_size: 
+        self.agent_descs.popitem(last=False)
+    return agent_desc
+
+
+  def categorical_resp(self, questions, samples=1): 
+    return categorical_resp(self, questions, samples)
+
+
+  def numerical_resp(self, questions, float_resp=False, samples=1): 
+    return numerical_resp(self, questions, float_resp, samples)
+
+
+  def categorical_dist(self, questions, fallback_samples=10): 
+    return categorical_dist(self, questions, fallback_samples)
+
+
+  def ask(self, questions): 
+    return ask(self, questions)
+
+
+  def utterance(self, curr_dialogue, context=""): 
+    return utterance(self, curr_dialogue, context)
+
+
+  def utterance_stream(self, curr_dialogue, context=""): 
+    return utterance_stream(self, curr_dialogue, context)
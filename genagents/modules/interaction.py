@@ -4,51 +4,352 @@ import datetime
 import random
 import string
 import re
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy
 from numpy import dot
 from numpy.linalg import norm
 
+from simulation_engine.default_settings import *
 from simulation_engine.settings import * 
 from simulation_engine.global_methods import *
 from simulation_engine.gpt_structure import *
 from simulation_engine.llm_json_parser import *
 
 
-def _main_agent_desc(agent, anchor): 
+def _build_agent_desc(agent, anchor, token_budget=None, site="agent_desc", 
+                      retriever=None): 
+  """
+  Builds the description of the agent that goes into the prompts: the self 
+  description followed by the memories retrieved for the anchor. 
+
+  If <token_budget> is set, the retrieved memories are greedily packed, 
+  highest score first, until the description reaches the budget; the 
+  packed memories are then emitted in the order they were created. The 
+  tokens saved this way are recorded in CONTEXT_SAVINGS under <site>. 
+
+  Parameters:
+    agent: The GenerativeAgent. 
+    anchor: The retrieval anchor (str). 
+    token_budget: Max number of tokens of the description, or None. 
+    site: The name under which the token savings are recorded. 
+    retriever: retriever(anchor, n_count) returns the scored nodes, highest 
+      first; defaults to agent.memory_stream.retrieve_scored. 
+  Returns: 
+    The agent description (str). 
+  """
+  if PROMPT_LAYOUT == "cache": 
+    return _stable_agent_desc(agent, token_budget, site)
+
   agent_desc = ""
   agent_desc += f"Self description: {agent.get_self_description()}\n==\n"
   agent_desc += f"Other observations about the subject:\n\n"
 
-  retrieved = agent.memory_stream.retrieve([anchor], 0, n_count=120)
-  if len(retrieved) == 0:
+  if token_budget is None and retriever is not None: 
+    nodes = [node for node, _ in retriever(anchor, n_count=120)]
+    for node in sorted(nodes, key=lambda node: node.created):
+      agent_desc += f"{node.content}\n"
+    return agent_desc
+
+  if token_budget is None: 
+    retrieved = agent.memory_stream.retrieve([anchor], 0, n_count=120)
+    if len(retrieved) == 0:
+      return agent_desc
+    nodes = list(retrieved.values())[0]
+    for node in nodes:
+      agent_desc += f"{node.content}\n"
     return agent_desc
-  nodes = list(retrieved.values())[0]
-  for node in nodes:
+
+  retriever = retriever or agent.memory_stream.retrieve_scored
+  scored = retriever(anchor, n_count=120)
+  used_tokens = count_tokens(agent_desc)
+  full_tokens = used_tokens
+  packed = []
+  for node, score in scored: 
+    node_tokens = count_tokens(f"{node.content}\n")
+    full_tokens += node_tokens
+    if used_tokens + node_tokens <= token_budget: 
+      packed += [node]
+      used_tokens += node_tokens
+  CONTEXT_SAVINGS.record(site, full_tokens, used_tokens)
+
+  for node in sorted(packed, key=lambda node: node.created):
     agent_desc += f"{node.content}\n"
   return agent_desc
 
 
-def _utterance_agent_desc(agent, anchor): 
+def _stable_agent_desc(agent, token_budget=None, site="agent_desc"): 
+  """
+  Builds an agent description that does not depend on the question, so that 
+  every prompt for the agent starts with the same bytes and the provider's 
+  prompt cache can reuse it. The self description is canonicalized and the 
+  memories are chosen by importance (up to 120, or up to <token_budget>) 
+  instead of by relevance to an anchor, and emitted in (created, node_id) 
+  order. 
+  """
   agent_desc = ""
-  agent_desc += f"Self description: {agent.get_self_description()}\n==\n"
+  agent_desc += ("Self description: "
+                 f"{agent.get_self_description(canonical=True)}\n==\n")
   agent_desc += f"Other observations about the subject:\n\n"
 
-  retrieved = agent.memory_stream.retrieve([anchor], 0, n_count=120)
-  if len(retrieved) == 0:
-    return agent_desc
-  
-  nodes = list(retrieved.values())[0]
-  for node in nodes:
+  nodes = sorted(agent.memory_stream.seq_nodes, 
+                 key=lambda node: (-node.importance, node.node_id))[:120]
+  if token_budget is not None: 
+    used_tokens = count_tokens(agent_desc)
+    full_tokens = used_tokens
+    packed = []
+    for node in nodes: 
+      node_tokens = count_tokens(f"{node.content}\n")
+      full_tokens += node_tokens
+      if used_tokens + node_tokens <= token_budget: 
+        packed += [node]
+        used_tokens += node_tokens
+    CONTEXT_SAVINGS.record(site, full_tokens, used_tokens)
+    nodes = packed
+
+  for node in sorted(nodes, key=lambda node: (node.created, node.node_id)): 
     agent_desc += f"{node.content}\n"
   return agent_desc
 
 
+def _main_agent_desc(agent, anchor): 
+  if hasattr(agent, "agent_desc"): 
+    # An AgentSession, which caches the descriptions. 
+    return agent.agent_desc(anchor, "main_agent_desc")
+  return _build_agent_desc(agent, anchor, AGENT_DESC_TOKEN_BUDGET, 
+                           "main_agent_desc")
+
+
+def _utterance_agent_desc(agent, anchor): 
+  if hasattr(agent, "agent_desc"): 
+    return agent.agent_desc(anchor, "utterance_agent_desc")
+  return _build_agent_desc(agent, anchor, AGENT_DESC_TOKEN_BUDGET, 
+                           "utterance_agent_desc")
+
+
+def _echoed_questions(gpt_response): 
+  """The questions ("Q") that the completion repeated, in order."""
+  items = extract_response_items(gpt_response) or []
+  return [str(i.get("Q", "")) for i in items]
+
+
+def _to_number(val, float_resp): 
+  try: 
+    return float(val) if float_resp else int(float(val))
+  except (TypeError, ValueError): 
+    return None
+
+
+def _in_options(response, options): 
+  options = options if isinstance(options, list) else [options]
+  return response is not None and str(response) in [str(i) for i in options]
+
+
+def _in_range(response, scale): 
+  if not isinstance(response, (int, float)): 
+    return False
+  if isinstance(scale, list) and scale: 
+    return min(scale) <= response <= max(scale)
+  return True
+
+
+def _normalize_question(question): 
+  return " ".join(str(question).lower().split())
+
+
+def _match_items(questions, output, func_text=None): 
+  """
+  Maps the items of a parsed completion to the keys of <questions>: by the 
+  question that each item repeated ("Q") when every item can be matched 
+  that way (the items may be reordered or some skipped), and otherwise by 
+  position if the completion has one item per question. A truncated 
+  completion without echoes loses its last items. 
+
+  Parameters:
+    questions: A dictionary keyed by question. 
+    output: The parsed output ({"responses", "reasonings", "questions"}). 
+    func_text: func_text(key) returns the text of the question of <key>; 
+      by default the key is the question. 
+  Returns: 
+    A dict of {question: (response, reasoning)}. 
+  """
+  keys = list(questions.keys())
+  responses = output.get("responses") or []
+  reasonings = list(output.get("reasonings") or [])
+  reasonings += [""] * (len(responses) - len(reasonings))
+  items = list(zip(responses, reasonings))
+  echoed = output.get("questions") or []
+  if len(echoed) != len(items): 
+    return dict(zip(keys, items))
+
+  # Questions with the same text are matched to the echoes in order. 
+  lookup = dict()
+  for key in keys: 
+    text = func_text(key) if func_text else key
+    lookup.setdefault(_normalize_question(text), []).append(key)
+  ret = dict()
+  for echo, item in zip(echoed, items): 
+    candidates = [key for key in lookup.get(_normalize_question(echo), []) 
+                  if key not in ret]
+    if candidates: 
+      ret[candidates[0]] = item
+  if len(ret) < len(items) and len(items) == len(keys): 
+    # Some echoes do not repeat their question faithfully. 
+    return dict(zip(keys, items))
+  return ret
+
+
+def _complete_items(questions, output, func_valid, func_request, 
+                    func_convert=None, func_text=None): 
+  """
+  Item-level validation of a batch categorical/numerical completion. The 
+  valid items of <output> are kept, and only the missing or invalid 
+  questions are re-issued (func_request(sub_questions) returns the parsed 
+  output for them) for up to PARTIAL_RETRY_ROUNDS rounds. 
+
+  Parameters:
+    questions: A dictionary of {question: options or range}. 
+    output: The parsed output ({"responses", "reasonings", "questions"}). 
+    func_valid: func_valid(response, options or range) -> bool. 
+    func_request: Requests the output for a subset of the questions. 
+    func_convert: func_convert(response, options or range) converts a raw 
+      response once it is matched to its question; None keeps it as is. 
+    func_text: See _match_items. 
+  Returns: 
+    {"responses": [...], "reasonings": [...]} aligned with <questions>. The 
+    responses of the questions that never got a valid answer are None. 
+  """
+  accepted = dict()
+  asked = questions
+  for round_count in range(PARTIAL_RETRY_ROUNDS + 1): 
+    matched = _match_items(asked, output, func_text)
+    for key, (response, reasoning) in matched.items(): 
+      if func_convert: 
+        response = func_convert(response, questions[key])
+      if func_valid(response, questions[key]): 
+        accepted[key] = (response, reasoning)
+    asked = {key: val for key, val in questions.items() 
+             if key not in accepted}
+    if not asked or round_count == PARTIAL_RETRY_ROUNDS: 
+      break
+    output = func_request(asked)
+
+  return {"responses": [accepted.get(key, (None, ""))[0] for key in questions], 
+          "reasonings": [accepted.get(key, (None, ""))[1] for key in questions]}
+
+
+def _chunk_questions(questions): 
+  """
+  Splits <questions> into chunks of up to MAX_CHUNK_SIZE consecutive 
+  questions (a questionnaire keeps related questions together). 
+  """
+  if not MAX_CHUNK_SIZE or len(questions) <= MAX_CHUNK_SIZE: 
+    return [questions]
+  return [dict(chunk) 
+          for chunk in chunk_list(list(questions.items()), MAX_CHUNK_SIZE)]
+
+
+def _resp_in_chunks(questions, func_chunk_resp): 
+  """
+  Runs func_chunk_resp(chunk) on every chunk of <questions> concurrently and 
+  reassembles the outputs in question order. 
+  """
+  chunks = _chunk_questions(questions)
+  if len(chunks) == 1: 
+    return func_chunk_resp(questions)
+  with ThreadPoolExecutor(max_workers=len(chunks)) as executor:
+    outputs = list(executor.map(func_chunk_resp, chunks))
+  return {key: [i for output in outputs for i in output[key]] 
+          for key in outputs[0]}
+
+
+def _sample_distributions(questions, outputs, func_valid): 
+  """
+  Combines the parsed outputs of several samples of the same categorical/ 
+  numerical prompt. Invalid or missing answers are left out of the 
+  distributions. 
+
+  Parameters:
+    questions: A dictionary of {question: options or range}. 
+    outputs: The parsed output of every sample. 
+    func_valid: func_valid(response, options or range) -> bool. 
+  Returns: 
+    {"responses", "reasonings"} aligned with <questions> (the most frequent 
+    answer of each question and the reasoning of its first sample), 
+    "samples" (the list of every sample's answer, None if invalid, for each 
+    question), and "distributions" ({answer: share} for each question). 
+  """
+  samples = {key: [] for key in questions}
+  reasonings = {key: [] for key in questions}
+  for output in outputs: 
+    matched = _match_items(questions, output)
+    for key in questions: 
+      response, reasoning = matched.get(key, (None, ""))
+      valid = func_valid(response, questions[key])
+      samples[key] += [response if valid else None]
+      reasonings[key] += [reasoning if valid else ""]
+
+  ret = {"responses": [], "reasonings": [], "samples": [], 
+         "distributions": []}
+  for key in questions: 
+    counts = Counter(i for i in samples[key] if i is not None)
+    total = sum(counts.values())
+    mode = counts.most_common(1)[0][0] if counts else None
+    ret["responses"] += [mode]
+    ret["reasonings"] += [reasonings[key][samples[key].index(mode)] 
+                          if counts else ""]
+    ret["samples"] += [samples[key]]
+    ret["distributions"] += [{answer: count / total 
+                              for answer, count in counts.items()}]
+  return ret
+
+
+def categorical_resp_format(questions): 
+  """
+  The response_format (JSON schema) of the categorical_resp templates for 
+  <questions>. The "Response" of every question is restricted to its options. 
+  """
+  properties = dict()
+  for count, options in enumerate(questions.values()): 
+    options = [str(i) for i in (options if isinstance(options, list) 
+                                else [options])]
+    per_option = strict_object({i: {"type": "string"} for i in options})
+    properties[str(count+1)] = strict_object({
+      "Q": {"type": "string"}, 
+      "Option Interpretation": per_option, 
+      "Option Choice": per_option, 
+      "Reasoning": {"type": "string"}, 
+      "Response": {"type": "string", "enum": options}})
+  return json_schema_format("categorical_resp", properties)
+
+
+def numerical_resp_format(questions, float_resp): 
+  """
+  The response_format (JSON schema) of the numerical_resp templates for 
+  <questions>. 
+  """
+  properties = dict()
+  for count, scale in enumerate(questions.values()): 
+    ends = [str(scale[0]), str(scale[-1])] if isinstance(scale, list) else []
+    properties[str(count+1)] = strict_object({
+      "Q": {"type": "string"}, 
+      "Range Interpretation": strict_object({i: {"type": "string"} 
+                                             for i in ends}), 
+      "Reasoning": {"type": "string"}, 
+      "Response": {"type": "number" if float_resp else "integer"}})
+  return json_schema_format("numerical_resp", properties)
+
+
 def run_gpt_generate_categorical_resp(
   agent_desc, 
   questions,
   prompt_version="1",
   gpt_version="GPT4o",  
-  verbose=False):
+  verbose=False,
+  prompt_only=False,
+  samples=1):
 
   def create_prompt_input(agent_desc, questions):
     str_questions = ""
@@ -60,11 +361,20 @@ def run_gpt_generate_categorical_resp(
 
   def _func_clean_up(gpt_response, prompt=""): 
     responses, reasonings = extract_first_json_dict_categorical(gpt_response)
-    ret = {"responses": responses, "reasonings": reasonings}
+    ret = {"responses": responses, "reasonings": reasonings, 
+           "questions": _echoed_questions(gpt_response)}
     return ret
 
+  def _func_validate(output): 
+    options = [val if isinstance(val, list) else [val] 
+               for val in questions.values()]
+    if len(output["responses"]) != len(options): 
+      return False
+    return all(_in_options(resp, opts) 
+               for resp, opts in zip(output["responses"], options))
+
   def _get_fail_safe():
-    return None
+    return {"responses": [], "reasonings": []}
 
   if len(questions) > 1: 
     prompt_lib_file = f"{LLM_PROMPT_DIR}/generative_agent/interaction/categorical_resp/batch_v1.txt" 
@@ -74,18 +384,166 @@ def run_gpt_generate_categorical_resp(
   prompt_input = create_prompt_input(agent_desc, questions) 
   fail_safe = _get_fail_safe() 
 
+  if prompt_only: 
+    return generate_prompt(prompt_input, prompt_lib_file), _func_clean_up
+
+  if samples > 1: 
+    # A list with the parsed output of every sample. 
+    output, prompt, prompt_input, fail_safe = chat_safe_generate_samples(
+      prompt_input, prompt_lib_file, gpt_version, samples, 1, fail_safe, 
+      _func_clean_up, verbose, 
+      response_format=categorical_resp_format(questions))
+    return output, [output, prompt, prompt_input, fail_safe]
+
   output, prompt, prompt_input, fail_safe = chat_safe_generate(
     prompt_input, prompt_lib_file, gpt_version, 1, fail_safe, 
-    _func_clean_up, verbose)
+    _func_clean_up, verbose, func_validate=_func_validate, 
+    response_format=categorical_resp_format(questions))
 
   return output, [output, prompt, prompt_input, fail_safe]
 
 
-def categorical_resp(agent, questions): 
+def categorical_resp(agent, questions, samples=1): 
+  """
+  Long questionnaires are split into chunks of MAX_CHUNK_SIZE questions; 
+  each chunk retrieves the memories for its own questions and the chunks 
+  are sent concurrently. 
+
+  With <samples> > 1, each chunk requests that many completions in one call 
+  and the output also has the "samples" and "distributions" of the answers 
+  (see _sample_distributions). 
+  """
+  if samples > 1: 
+    return _resp_in_chunks(
+      questions, lambda chunk: _categorical_samples(agent, chunk, samples))
+  return _resp_in_chunks(
+    questions, lambda chunk: complete_categorical_resp(agent, chunk))
+
+
+def _categorical_samples(agent, questions, samples): 
+  anchor = " ".join(list(questions.keys()))
+  agent_desc = _main_agent_desc(agent, anchor)
+  outputs = run_gpt_generate_categorical_resp(
+    agent_desc, questions, "1", LLM_VERS, samples=samples)[0]
+  return _sample_distributions(questions, outputs, _in_options)
+
+
+def complete_categorical_resp(agent, questions, output=None): 
+  """
+  Validates <output> (the parsed completion of a categorical_resp prompt for 
+  <questions>; it is requested if None) item by item and re-issues only the 
+  missing or invalid questions. See _complete_items. 
+  """
+  anchor = " ".join(list(questions.keys()))
+  agent_desc = _main_agent_desc(agent, anchor)
+  def request(sub_questions): 
+    return run_gpt_generate_categorical_resp(
+             agent_desc, sub_questions, "1", LLM_VERS)[0]
+  if output is None: 
+    output = request(questions)
+  return _complete_items(questions, output, _in_options, request)
+
+
+def categorical_resp_prompt(agent, questions): 
+  """
+  Renders the categorical_resp prompt for the agent without calling the 
+  LLM. Used when the completions are generated elsewhere (e.g., through 
+  the Batch API). 
+
+  Returns: 
+    prompt: The fully rendered prompt string. 
+    func_clean_up: The function that parses the completion of the prompt. 
+  """
   anchor = " ".join(list(questions.keys()))
   agent_desc = _main_agent_desc(agent, anchor)
   return run_gpt_generate_categorical_resp(
-           agent_desc, questions, "1", LLM_VERS)[0]
+           agent_desc, questions, "1", LLM_VERS, prompt_only=True)
+
+
+# The labels of the options in the logprob prompt; each is a single token. 
+OPTION_LABELS = string.ascii_uppercase
+
+# The number of top logprobs requested (the API returns at most 20), and so 
+# the max number of options whose distribution can be read from them. 
+LOGPROB_OPTIONS = 20
+
+
+def run_gpt_generate_categorical_logprobs(
+  agent_desc, 
+  question,
+  options,
+  prompt_version="1",
+  gpt_version="GPT4o",  
+  verbose=False):
+
+  def create_prompt_input(agent_desc, question, options):
+    str_options = "\n".join(f"{label}) {option}" 
+                            for label, option in zip(OPTION_LABELS, options))
+    return [agent_desc, question, str_options]
+
+  def _func_clean_up(token_logprobs): 
+    # The probability of each option is the mass of the tokens that spell 
+    # its label (e.g., "A" and " A"), normalized over the labels. 
+    labels = dict(zip(OPTION_LABELS, options))
+    probs = dict()
+    for token, logprob in token_logprobs.items(): 
+      label = token.strip().strip("()\"'.")
+      if label in labels: 
+        option = str(labels[label])
+        probs[option] = probs.get(option, 0.0) + math.exp(logprob)
+    total = sum(probs.values())
+    if not total: 
+      return None
+    return {str(option): probs.get(str(option), 0.0) / total 
+            for option in options}
+
+  prompt_lib_file = f"{LLM_PROMPT_DIR}/generative_agent/interaction/categorical_resp/logprob_v1.txt" 
+
+  prompt_input = create_prompt_input(agent_desc, question, options) 
+  token_logprobs, prompt, prompt_input = chat_safe_generate_logprobs(
+    prompt_input, prompt_lib_file, gpt_version, 1, verbose, 
+    top_logprobs=LOGPROB_OPTIONS)
+  output = _func_clean_up(token_logprobs) if token_logprobs else None
+
+  return output, [output, prompt, prompt_input, None]
+
+
+def categorical_dist(agent, questions, fallback_samples=10): 
+  """
+  The probability distribution of the agent's answer over the options of 
+  each categorical question, read from the log-probabilities of a 
+  single-letter answer: one call per question (sent concurrently) instead 
+  of repeated sampling. When the backend returns no logprobs for a 
+  question, its answer is sampled <fallback_samples> times instead (see 
+  categorical_resp). So is a question with more than LOGPROB_OPTIONS 
+  options, since the options outside the top logprobs would get no 
+  probability at all. 
+
+  Returns: 
+    {"responses": the most likely option, "reasonings": "", 
+     "distributions": {option: probability}, "methods": "logprobs" or 
+     "samples"}, each a list aligned with <questions>. 
+  """
+  def question_dist(item): 
+    question, options = item
+    options = options if isinstance(options, list) else [options]
+    dist = None
+    if len(options) <= min(LOGPROB_OPTIONS, len(OPTION_LABELS)): 
+      agent_desc = _main_agent_desc(agent, question)
+      dist = run_gpt_generate_categorical_logprobs(
+        agent_desc, question, options, "1", LLM_VERS)[0]
+    if dist: 
+      return max(dist, key=dist.get), dist, "logprobs"
+    output = categorical_resp(agent, {question: options}, 
+                              max(2, fallback_samples))
+    return output["responses"][0], output["distributions"][0], "samples"
+
+  with ThreadPoolExecutor(max_workers=max(1, len(questions))) as executor:
+    results = list(executor.map(question_dist, questions.items()))
+  return {"responses": [i[0] for i in results], 
+          "reasonings": [""] * len(results), 
+          "distributions": [i[1] for i in results], 
+          "methods": [i[2] for i in results]}
 
 
 def run_gpt_generate_numerical_resp(
@@ -94,7 +552,9 @@ def run_gpt_generate_numerical_resp(
   float_resp,
   prompt_version="1",
   gpt_version="GPT4o",  
-  verbose=False):
+  verbose=False,
+  prompt_only=False,
+  samples=1):
 
   def create_prompt_input(agent_desc, questions, float_resp):
     str_questions = ""
@@ -111,11 +571,20 @@ def run_gpt_generate_numerical_resp(
 
   def _func_clean_up(gpt_response, prompt=""): 
     responses, reasonings = extract_first_json_dict_numerical(gpt_response)
-    ret = {"responses": responses, "reasonings": reasonings}
+    responses = [_to_number(i, float_resp) for i in responses]
+    ret = {"responses": responses, "reasonings": reasonings, 
+           "questions": _echoed_questions(gpt_response)}
     return ret
 
+  def _func_validate(output): 
+    scales = list(questions.values())
+    if len(output["responses"]) != len(scales): 
+      return False
+    return all(_in_range(resp, scale) 
+               for resp, scale in zip(output["responses"], scales))
+
   def _get_fail_safe():
-    return None
+    return {"responses": [], "reasonings": []}
 
   if len(questions) > 1: 
     prompt_lib_file = f"{LLM_PROMPT_DIR}/generative_agent/interaction/numerical_resp/batch_v1.txt" 
@@ -125,23 +594,253 @@ def run_gpt_generate_numerical_resp(
   prompt_input = create_prompt_input(agent_desc, questions, float_resp) 
   fail_safe = _get_fail_safe() 
 
+  if prompt_only: 
+    return generate_prompt(prompt_input, prompt_lib_file), _func_clean_up
+
+  if samples > 1: 
+    # A list with the parsed output of every sample. 
+    output, prompt, prompt_input, fail_safe = chat_safe_generate_samples(
+      prompt_input, prompt_lib_file, gpt_version, samples, 1, fail_safe, 
+      _func_clean_up, verbose, 
+      response_format=numerical_resp_format(questions, float_resp))
+    return output, [output, prompt, prompt_input, fail_safe]
+
   output, prompt, prompt_input, fail_safe = chat_safe_generate(
     prompt_input, prompt_lib_file, gpt_version, 1, fail_safe, 
-    _func_clean_up, verbose)
-
-  if float_resp: 
-    output["responses"] = [float(i) for i in output["responses"]]
-  else: 
-    output["responses"] = [int(i) for i in output["responses"]]
+    _func_clean_up, verbose, func_validate=_func_validate, 
+    response_format=numerical_resp_format(questions, float_resp))
 
   return output, [output, prompt, prompt_input, fail_safe]
 
 
-def numerical_resp(agent, questions, float_resp): 
+def numerical_resp(agent, questions, float_resp, samples=1): 
+  """Chunked (and sampled) like categorical_resp."""
+  if samples > 1: 
+    return _resp_in_chunks(
+      questions, 
+      lambda chunk: _numerical_samples(agent, chunk, float_resp, samples))
+  return _resp_in_chunks(
+    questions, lambda chunk: _numerical_resp_chunk(agent, chunk, float_resp))
+
+
+def _numerical_resp_chunk(agent, questions, float_resp): 
   anchor = " ".join(list(questions.keys()))
   agent_desc = _main_agent_desc(agent, anchor)
-  return run_gpt_generate_numerical_resp(
-           agent_desc, questions, float_resp, "1", LLM_VERS)[0]
+  def request(sub_questions): 
+    return run_gpt_generate_numerical_resp(
+             agent_desc, sub_questions, float_resp, "1", LLM_VERS)[0]
+  return _complete_items(questions, request(questions), _in_range, request)
+
+
+def _numerical_samples(agent, questions, float_resp, samples): 
+  anchor = " ".join(list(questions.keys()))
+  agent_desc = _main_agent_desc(agent, anchor)
+  outputs = run_gpt_generate_numerical_resp(
+    agent_desc, questions, float_resp, "1", LLM_VERS, samples=samples)[0]
+  return _sample_distributions(questions, outputs, _in_range)
+
+
+def run_gpt_generate_dialogue_summary(
+  prev_summary, 
+  str_turns,
+  prompt_version="1",
+  gpt_version="GPT4o",  
+  verbose=False):
+
+  def create_prompt_input(prev_summary, str_turns):
+    return [prev_summary, str_turns]
+
+  def _func_clean_up(gpt_response, prompt=""): 
+    return extract_first_json_dict(gpt_response)["summary"]
+
+  def _func_validate(output): 
+    return isinstance(output, str) and bool(output.strip())
+
+  def _get_fail_safe():
+    return None
+
+  prompt_lib_file = f"{LLM_PROMPT_DIR}/generative_agent/interaction/dialogue_summary/summary_v1.txt" 
+
+  prompt_input = create_prompt_input(prev_summary, str_turns) 
+  fail_safe = _get_fail_safe() 
+
+  output, prompt, prompt_input, fail_safe = chat_safe_generate(
+    prompt_input, prompt_lib_file, gpt_version, 1, fail_safe, 
+    _func_clean_up, verbose, func_validate=_func_validate, 
+    response_format=json_schema_format("dialogue_summary", 
+                                       {"summary": {"type": "string"}}))
+
+  return output, [output, prompt, prompt_input, fail_safe]
+
+
+# Runs the compactions of the DialogueStates in the background. 
+_COMPACTION_EXECUTOR = ThreadPoolExecutor(max_workers=8, 
+                                          thread_name_prefix="compaction")
+
+
+class DialogueState: 
+  """
+  A conversation that grows one turn at a time, for generating utterances 
+  in long dialogues without rebuilding (and re-embedding) the whole 
+  transcript on every turn. 
+
+  - The last <window> turns are rendered verbatim. Once 2 * <window> turns 
+    are unsummarized, the older ones are folded into a running summary by 
+    the LLM, in the background; until the summary is ready, the turns are 
+    rendered in full. 
+  - The retrieval anchor is the mean of the embeddings of the last 
+    <anchor_turns> turns. Every turn is embedded once, when it first falls 
+    in the anchor. 
+
+  <turns> keeps the full transcript. utterance(agent, dialogue_state) and 
+  utterance_stream accept a DialogueState in place of the list of turns. 
+  """
+  def __init__(self, turns=None, window=None, anchor_turns=None): 
+    self.window = window or DIALOGUE_WINDOW_TURNS
+    self.anchor_turns = anchor_turns or DIALOGUE_ANCHOR_TURNS
+    self.lock = threading.Lock()
+    self.turns = []
+    self.recent = []
+    self.summary = ""
+    self.embeddings = dict()
+    self.compaction = None
+    self.index = None
+    self.index_agent = None
+    for speaker, text in turns or []: 
+      self.append(speaker, text)
+
+
+  def append(self, speaker, text): 
+    with self.lock: 
+      self.turns += [[speaker, text]]
+      self.recent += [f"[{speaker}]: {text}\n"]
+    self._apply_compaction()
+    self._start_compaction()
+
+
+  def _start_compaction(self): 
+    with self.lock: 
+      if (not self.window or self.compaction is not None 
+          or len(self.recent) < 2 * self.window): 
+        return
+      count = len(self.recent) - self.window
+      str_turns = "".join(self.recent[:count])
+      self.compaction = _COMPACTION_EXECUTOR.submit(
+        self._summarize, self.summary, str_turns, count)
+
+
+  def _summarize(self, prev_summary, str_turns, count): 
+    summary = run_gpt_generate_dialogue_summary(
+                prev_summary, str_turns, "1", LLM_VERS)[0]
+    return count, summary
+
+
+  def _apply_compaction(self): 
+    with self.lock: 
+      if self.compaction is None or not self.compaction.done(): 
+        return
+      compaction, self.compaction = self.compaction, None
+      try: 
+        count, summary = compaction.result()
+      except Exception as e: 
+        print (f"Dialogue compaction failed: {e}")
+        return
+      if summary: 
+        self.summary = summary
+        self.recent = self.recent[count:]
+
+
+  def wait(self): 
+    """Blocks until the running compaction (if any) is applied."""
+    compaction = self.compaction
+    if compaction is not None: 
+      try: 
+        compaction.result()
+      except Exception: 
+        pass
+    self._apply_compaction()
+
+
+  def render(self, next_speaker): 
+    """The dialogue so far, ending with <next_speaker>'s turn to fill in."""
+    self._apply_compaction()
+    with self.lock: 
+      str_dialogue = ""
+      if self.summary: 
+        str_dialogue += (f"(Summary of the earlier conversation: "
+                         f"{self.summary})\n\n")
+      str_dialogue += "".join(self.recent)
+    str_dialogue += f"[{next_speaker}]: [Fill in]\n"
+    return str_dialogue
+
+
+  def anchor(self): 
+    """The text of the last <anchor_turns> turns."""
+    with self.lock: 
+      return " ".join(f"{speaker}: {text}" 
+                      for speaker, text in self.turns[-self.anchor_turns:])
+
+
+  def retrieval_index(self, agent): 
+    """
+    The RetrievalIndex of <agent> (a GenerativeAgent or an AgentSession), 
+    built once per dialogue. 
+    """
+    with self.lock: 
+      if self.index is None or self.index_agent is not agent: 
+        self.index_agent = agent
+        self.index = getattr(agent, "index", None)
+        if self.index is None: 
+          self.index = agent.memory_stream.retrieval_index()
+      return self.index
+
+
+  def anchor_embedding(self): 
+    with self.lock: 
+      start = max(0, len(self.turns) - self.anchor_turns)
+      indices = list(range(start, len(self.turns)))
+      texts = {i: f"{self.turns[i][0]}: {self.turns[i][1]}" for i in indices}
+      missing = [i for i in indices if i not in self.embeddings]
+    if missing: 
+      embeddings = get_text_embeddings([texts[i] for i in missing])
+      with self.lock: 
+        self.embeddings.update(zip(missing, embeddings))
+    with self.lock: 
+      return numpy.mean([self.embeddings[i] for i in indices], axis=0)
+
+
+def _dialogue_prompt_input(agent, curr_dialogue): 
+  """
+  Returns the (agent_desc, str_dialogue) of the utterance prompt for 
+  <curr_dialogue>, which is either a list of [speaker, text] turns or a 
+  DialogueState. 
+  """
+  if not isinstance(curr_dialogue, DialogueState): 
+    str_dialogue = ""
+    for row in curr_dialogue:
+      str_dialogue += f"[{row[0]}]: {row[1]}\n"
+    str_dialogue += f"[{agent.get_fullname()}]: [Fill in]\n"
+
+    anchor = str_dialogue
+    return _utterance_agent_desc(agent, anchor), str_dialogue
+
+  str_dialogue = curr_dialogue.render(agent.get_fullname())
+  if getattr(agent, "anchor", None) is not None or not curr_dialogue.turns: 
+    # An AgentSession with a fixed anchor, or nothing to anchor on yet. 
+    return _utterance_agent_desc(agent, str_dialogue), str_dialogue
+
+  base_agent = getattr(agent, "agent", agent)
+  index = curr_dialogue.retrieval_index(agent)
+  retriever = lambda anchor, n_count=120: index.scored_by_embedding(
+    curr_dialogue.anchor_embedding(), n_count)
+  agent_desc = _build_agent_desc(base_agent, curr_dialogue.anchor(), 
+                                 AGENT_DESC_TOKEN_BUDGET, 
+                                 "utterance_agent_desc", retriever)
+  return agent_desc, str_dialogue
+
+
+UTTERANCE_FORMAT = json_schema_format("utterance", 
+                                      {"utterance": {"type": "string"}})
 
 
 def run_gpt_generate_utterance(
@@ -159,6 +858,9 @@ def run_gpt_generate_utterance(
     utterance = extract_first_json_dict(gpt_response)["utterance"]
     return utterance
 
+  def _func_validate(output): 
+    return isinstance(output, str) and bool(output.strip())
+
   def _get_fail_safe():
     return None
 
@@ -169,87 +871,175 @@ def run_gpt_generate_utterance(
 
   output, prompt, prompt_input, fail_safe = chat_safe_generate(
     prompt_input, prompt_lib_file, gpt_version, 1, fail_safe, 
-    _func_clean_up, verbose)
+    _func_clean_up, verbose, func_validate=_func_validate, 
+    response_format=UTTERANCE_FORMAT)
 
   return output, [output, prompt, prompt_input, fail_safe]
 
 
 def utterance(agent, curr_dialogue, context): 
-  str_dialogue = ""
-  for row in curr_dialogue:
-    str_dialogue += f"[{row[0]}]: {row[1]}\n"
-  str_dialogue += f"[{agent.get_fullname()}]: [Fill in]\n"
-
-  anchor = str_dialogue
-  agent_desc = _utterance_agent_desc(agent, anchor)
+  agent_desc, str_dialogue = _dialogue_prompt_input(agent, curr_dialogue)
   return run_gpt_generate_utterance(
            agent_desc, str_dialogue, context, "1", LLM_VERS)[0]
 
-##  Ask function.
-def run_gpt_generate_ask(
-    agent_desc,
-    questions,
-    prompt_version="1",
-    gpt_version="GPT4o",
-    verbose=False):
-
-    def create_prompt_input(agent_desc, questions):
-        str_questions = ""
-        i = 1
-        for q in questions:
-            str_questions += f"Q{i}: {q['question']}\n"
-            str_questions += f"Type: {q['response-type']}\n"
-            if q['response-type'] == 'categorical':
-                str_questions += f"Options: {', '.join(q['response-options'])}\n"
-            elif q['response-type'] in ['int', 'float']:
-                str_questions += f"Range: {q['response-scale']}\n"
-            elif q['response-type'] == 'open':
-                char_limit = q.get('response-char-limit', 200)
-                str_questions += f"Character Limit: {char_limit}\n"
-            str_questions += "\n"
-            i += 1
-        return [agent_desc, str_questions.strip()]
-
-    def _func_clean_up(gpt_response, prompt=""):
-        responses = extract_first_json_dict(gpt_response)
-        return responses
-
-    def _get_fail_safe():
-        return None
-
-    prompt_lib_file = f"{LLM_PROMPT_DIR}/generative_agent/interaction/ask/batch_v1.txt"
-
-    prompt_input = create_prompt_input(agent_desc, questions)
-    fail_safe = _get_fail_safe()
-
-    output, prompt, prompt_input, fail_safe = chat_safe_generate(
-        prompt_input, prompt_lib_file, gpt_version, 1, fail_safe,
-        _func_clean_up, verbose)
-
-    return output, [output, prompt, prompt_input, fail_safe]
-
-
-
-  
-
-
 
+def run_gpt_generate_utterance_stream(
+  agent_desc, 
+  str_dialogue,
+  context,
+  prompt_version="1",
+  gpt_version="GPT4o",  
+  verbose=False):
+  """
+  Streaming version of run_gpt_generate_utterance. Yields the text of the 
+  "utterance" field as the tokens arrive, and returns the full utterance. 
+  """
+  prompt_lib_file = f"{LLM_PROMPT_DIR}/generative_agent/interaction/utternace/utterance_v1.txt" 
+  prompt_input = [agent_desc, context, str_dialogue]
+
+  parser = IncrementalJSONFieldParser("utterance")
+  raw = yield from chat_safe_generate_stream(
+    prompt_input, prompt_lib_file, gpt_version, parser.feed, verbose, 
+    response_format=UTTERANCE_FORMAT)
+
+  if parser.found(): 
+    return parser.value
+
+  # The model did not stream the field in the expected form; fall back on 
+  # parsing the whole completion. 
+  output = extract_first_json_dict(raw)
+  utterance = output.get("utterance") if output else None
+  if utterance: 
+    yield utterance
+  return utterance
+
+
+def utterance_stream(agent, curr_dialogue, context): 
+  """
+  Like utterance, but a generator that yields the agent's utterance as it is 
+  generated. The full utterance is the generator's return value. 
+  """
+  agent_desc, str_dialogue = _dialogue_prompt_input(agent, curr_dialogue)
+  return (yield from run_gpt_generate_utterance_stream(
+            agent_desc, str_dialogue, context, "1", LLM_VERS))
+
+def ask_format(questions): 
+  """
+  The response_format (JSON schema) of the ask template for <questions>; 
+  the type of every "Response" follows its question's response-type. 
+  """
+  properties = dict()
+  for count, q in enumerate(questions): 
+    if q["response-type"] == "categorical": 
+      response = {"type": "string", 
+                  "enum": [str(i) for i in q["response-options"]]}
+    elif q["response-type"] == "int": 
+      response = {"type": "integer"}
+    elif q["response-type"] == "float": 
+      response = {"type": "number"}
+    else: 
+      response = {"type": "string"}
+    properties[str(count+1)] = strict_object({"Q": {"type": "string"}, 
+                                              "Reasoning": {"type": "string"}, 
+                                              "Response": response})
+  return json_schema_format("ask", properties)
 
 
-  
+def _ask_response(response, q): 
+  """Converts <response> to the type of the question <q>, or None."""
+  if response is None: 
+    return None
+  if q["response-type"] == "int": 
+    return _to_number(response, False)
+  if q["response-type"] == "float": 
+    return _to_number(response, True)
+  response = str(response).strip()
+  if q["response-type"] == "open": 
+    return response[:q.get("response-char-limit", 200)]
+  return response
 
 
+def _valid_ask_response(response, q): 
+  if q["response-type"] == "categorical": 
+    return _in_options(response, q["response-options"])
+  if q["response-type"] in ["int", "float"]: 
+    return _in_range(response, q.get("response-scale"))
+  return isinstance(response, str) and bool(response)
 
 
-  
+def run_gpt_generate_ask(
+  agent_desc,
+  questions,
+  prompt_version="1",
+  gpt_version="GPT4o",
+  verbose=False):
 
+  def create_prompt_input(agent_desc, questions):
+    str_questions = ""
+    for count, q in enumerate(questions): 
+      str_questions += f"Q{count+1}: {q['question']}\n"
+      str_questions += f"Question Type: {q['response-type']}\n"
+      if q['response-type'] == 'categorical':
+        str_questions += f"Options: {q['response-options']}\n"
+      elif q['response-type'] in ['int', 'float']:
+        str_questions += f"Range: {q['response-scale']}\n"
+      elif q['response-type'] == 'open':
+        char_limit = q.get('response-char-limit', 200)
+        str_questions += f"Character Limit: {char_limit}\n"
+      str_questions += "\n"
+    return [agent_desc, str_questions.strip()]
+
+  def _func_clean_up(gpt_response, prompt=""):
+    # The raw responses; they are converted once matched to their questions 
+    # (an item may have been skipped or reordered). 
+    items = extract_response_items(gpt_response) or []
+    ret = {"responses": [i.get("Response") for i in items], 
+           "reasonings": [str(i.get("Reasoning", "")) for i in items], 
+           "questions": [str(i.get("Q", "")) for i in items]}
+    return ret
 
+  def _func_validate(output): 
+    if len(output["responses"]) != len(questions): 
+      return False
+    return all(_valid_ask_response(_ask_response(resp, q), q) 
+               for resp, q in zip(output["responses"], questions))
 
+  def _get_fail_safe():
+    return {"responses": [], "reasonings": []}
 
+  prompt_lib_file = f"{LLM_PROMPT_DIR}/generative_agent/interaction/ask/batch_v1.txt"
 
-  
+  prompt_input = create_prompt_input(agent_desc, questions)
+  fail_safe = _get_fail_safe()
 
+  output, prompt, prompt_input, fail_safe = chat_safe_generate(
+    prompt_input, prompt_lib_file, gpt_version, 1, fail_safe,
+    _func_clean_up, verbose, func_validate=_func_validate, 
+    response_format=ask_format(questions))
 
+  return output, [output, prompt, prompt_input, fail_safe]
 
 
+def ask(agent, questions): 
+  """
+  Asks a mixed questionnaire in a single prompt. Every question is a dict 
+  with "question" and "response-type" (categorical, int, float, or open), 
+  plus "response-options" (categorical), "response-scale" (int and float), 
+  or "response-char-limit" (open, default 200). The responses are 
+  validated per type and only the missing or invalid ones are re-issued 
+  (see _complete_items). 
 
+  Returns: 
+    {"responses": [...], "reasonings": [...]} in the order of <questions>. 
+  """
+  anchor = " ".join([q["question"] for q in questions])
+  agent_desc = _main_agent_desc(agent, anchor)
+  # Keyed by position, so questions with the same text stay separate. 
+  by_index = dict(enumerate(questions))
+  def request(sub_questions): 
+    return run_gpt_generate_ask(agent_desc, list(sub_questions.values()), 
+                                "1", LLM_VERS)[0]
+  return _complete_items(by_index, request(by_index), 
+                         _valid_ask_response, request, 
+                         func_convert=_ask_response, 
+                         func_text=lambda key: by_index[key]["question"])
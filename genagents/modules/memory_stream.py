@@ -5,9 +5,11 @@ import random
 import string
 import re
 
+import numpy
 from numpy import dot
 from numpy.linalg import norm
 
+from simulation_engine.default_settings import *
 from simulation_engine.settings import * 
 from simulation_engine.global_methods import *
 from simulation_engine.gpt_structure import *
@@ -31,8 +33,18 @@ def run_gpt_generate_importance(
     gpt_response = extract_first_json_dict(gpt_response)
     return list(gpt_response.values())
 
+  def _func_validate(output): 
+    return (len(output) == len(records) 
+            and all(isinstance(i, (int, float)) and 0 <= i <= 100 
+                    for i in output))
+
   def _get_fail_safe():
-    return 25
+    return [25] * len(records)
+
+  def _get_response_format(): 
+    return json_schema_format("importance_score", 
+      {f"Item {count+1}": {"type": "integer"} 
+       for count in range(len(records))})
 
   if len(records) > 1: 
     prompt_lib_file = f"{LLM_PROMPT_DIR}/generative_agent/memory_stream/importance_score/batch_v1.txt" 
@@ -44,7 +56,8 @@ def run_gpt_generate_importance(
 
   output, prompt, prompt_input, fail_safe = chat_safe_generate(
     prompt_input, prompt_lib_file, gpt_version, 1, fail_safe, 
-    _func_clean_up, verbose)
+    _func_clean_up, verbose, func_validate=_func_validate, 
+    response_format=_get_response_format())
 
   return output, [output, prompt, prompt_input, fail_safe]
 
@@ -71,9 +84,17 @@ def run_gpt_generate_reflection(
   def _func_clean_up(gpt_response, prompt=""): 
     return extract_first_json_dict(gpt_response)["reflection"]
 
+  def _func_validate(output): 
+    return (isinstance(output, list) and len(output) > 0
+            and all(isinstance(i, str) and i.strip() for i in output))
+
   def _get_fail_safe():
     return []
 
+  def _get_response_format(): 
+    return json_schema_format("reflection", 
+      {"reflection": {"type": "array", "items": {"type": "string"}}})
+
   if reflection_count > 1: 
     prompt_lib_file = f"{LLM_PROMPT_DIR}/generative_agent/memory_stream/reflection/batch_v1.txt" 
   else: 
@@ -84,7 +105,8 @@ def run_gpt_generate_reflection(
 
   output, prompt, prompt_input, fail_safe = chat_safe_generate(
     prompt_input, prompt_lib_file, gpt_version, 1, fail_safe, 
-    _func_clean_up, verbose)
+    _func_clean_up, verbose, func_validate=_func_validate, 
+    response_format=_get_response_format())
 
   return output, [output, prompt, prompt_input, fail_safe]
 
@@ -309,6 +331,74 @@ class ConceptNode:
     return curr_package
 
 
+# ##############################################################################
+# ###                            RETRIEVAL INDEX                             ###
+# ##############################################################################
+
+def _min_max(values): 
+  """Vectorized normalize_dict_floats to the range [0, 1]."""
+  if len(values) == 0: 
+    return values
+  range_val = values.max() - values.min()
+  if range_val == 0: 
+    return numpy.full(len(values), 0.5)
+  return (values - values.min()) / range_val
+
+
+class RetrievalIndex: 
+  """
+  A snapshot of the anchor-independent part of the retrieval: the nodes, 
+  their normalized recency and importance, and their unit-length embeddings 
+  as one matrix. Scoring an anchor against it then takes one embedding 
+  request and one matrix-vector product, with the same scores as 
+  MemoryStream.retrieve_scored. Build a new index once the memory stream 
+  changes. 
+  """
+  def __init__(self, memory_stream, curr_filter="all"): 
+    if curr_filter == "all": 
+      self.nodes = list(memory_stream.seq_nodes)
+    else: 
+      self.nodes = [i for i in memory_stream.seq_nodes 
+                    if i.node_type == curr_filter]
+    if not self.nodes: 
+      return
+
+    last_retrieved = numpy.array([i.last_retrieved for i in self.nodes], 
+                                 dtype=float)
+    self.recency = _min_max(0.99 ** (last_retrieved.max() - last_retrieved))
+    self.importance = _min_max(numpy.array([i.importance for i in self.nodes], 
+                                           dtype=float))
+    embeddings = numpy.array([memory_stream.embeddings[i.content] 
+                              for i in self.nodes], dtype=float)
+    self.unit_embeddings = (embeddings 
+                            / norm(embeddings, axis=1, keepdims=True))
+
+
+  def scored(self, focal_pt, n_count=120, hp=[0, 1, 0.5]): 
+    """
+    Returns the top <n_count> (node, score) pairs for <focal_pt>, highest 
+    score first. 
+    """
+    if not self.nodes: 
+      return []
+    return self.scored_by_embedding(get_text_embedding(focal_pt), n_count, hp)
+
+
+  def scored_by_embedding(self, focal_embedding, n_count=120, 
+                          hp=[0, 1, 0.5]): 
+    """Like scored, for an already embedded focal point."""
+    if not self.nodes: 
+      return []
+    focal_embedding = numpy.array(focal_embedding, dtype=float)
+    relevance = _min_max(self.unit_embeddings @ focal_embedding 
+                         / norm(focal_embedding))
+    scores = (hp[0] * self.recency 
+              + hp[1] * relevance 
+              + hp[2] * self.importance)
+    top = numpy.argsort(-scores, kind="stable")[:n_count]
+    return [(self.nodes[i], float(scores[i])) for i in top]
+
+
 # ##############################################################################
 # ###                             MEMORY STREAM                              ###
 # ##############################################################################
@@ -379,31 +469,7 @@ class MemoryStream:
     # <retrieved> is the main dictionary that we are returning
     retrieved = dict() 
     for focal_pt in focal_points: 
-      # Calculating the component dictionaries and normalizing them.
-      x = extract_recency(curr_nodes)
-      recency_out = normalize_dict_floats(x, 0, 1)
-      x = extract_importance(curr_nodes)
-      importance_out = normalize_dict_floats(x, 0, 1)  
-      x = extract_relevance(curr_nodes, self.embeddings, focal_pt)
-      relevance_out = normalize_dict_floats(x, 0, 1)
-      
-      # Computing the final scores that combines the component values. 
-      master_out = dict()
-      for key in recency_out.keys(): 
-        recency_w = hp[0]
-        relevance_w = hp[1]
-        importance_w = hp[2]
-        master_out[key] = (recency_w * recency_out[key]
-                         + relevance_w * relevance_out[key] 
-                         + importance_w * importance_out[key])
-
-      if verbose: 
-        master_out = top_highest_x_values(master_out, len(master_out.keys()))
-        for key, val in master_out.items(): 
-          print (self.id_to_node[key].content, val)
-          print (recency_w*recency_out[key]*1, 
-                 relevance_w*relevance_out[key]*1, 
-                 importance_w*importance_out[key]*1)
+      master_out = self._score_nodes(curr_nodes, focal_pt, hp, verbose)
 
       # Extracting the highest x values.
       # <master_out> has the key of node.id and value of float. Once we get  
@@ -427,7 +493,77 @@ class MemoryStream:
     return retrieved 
 
 
-  def _add_node(self, time_step, node_type, content, importance, pointer_id):
+  def _score_nodes(self, curr_nodes, focal_pt, hp, verbose=False): 
+    """
+    Scores <curr_nodes> against the focal_pt. The score is the weighted sum 
+    of the normalized recency, relevance, and importance of each node. 
+
+    Parameters:
+      curr_nodes: A list of nodes to score. 
+      focal_pt: The query sentence. 
+      hp: Hyperparameter for [recency_w, relevance_w, importance_w]
+    Returns: 
+      master_out: A dictionary whose keys are node_ids and whose values are 
+        the float scores. 
+    """
+    # Calculating the component dictionaries and normalizing them.
+    x = extract_recency(curr_nodes)
+    recency_out = normalize_dict_floats(x, 0, 1)
+    x = extract_importance(curr_nodes)
+    importance_out = normalize_dict_floats(x, 0, 1)  
+    x = extract_relevance(curr_nodes, self.embeddings, focal_pt)
+    relevance_out = normalize_dict_floats(x, 0, 1)
+    
+    # Computing the final scores that combines the component values. 
+    master_out = dict()
+    for key in recency_out.keys(): 
+      recency_w = hp[0]
+      relevance_w = hp[1]
+      importance_w = hp[2]
+      master_out[key] = (recency_w * recency_out[key]
+                       + relevance_w * relevance_out[key] 
+                       + importance_w * importance_out[key])
+
+    if verbose: 
+      master_out = top_highest_x_values(master_out, len(master_out.keys()))
+      for key, val in master_out.items(): 
+        print (self.id_to_node[key].content, val)
+        print (recency_w*recency_out[key]*1, 
+               relevance_w*relevance_out[key]*1, 
+               importance_w*importance_out[key]*1)
+
+    return master_out
+
+
+  def retrieve_scored(self, focal_pt, n_count=120, curr_filter="all", 
+                      hp=[0, 1, 0.5]): 
+    """
+    Like retrieve, but for a single focal_pt and without the chronological 
+    reordering: returns the top <n_count> (node, score) pairs, highest score 
+    first. 
+    """
+    if len(self.seq_nodes) == 0:
+      return []
+
+    if curr_filter == "all": 
+      curr_nodes = self.seq_nodes
+    else: 
+      curr_nodes = [i for i in self.seq_nodes if i.node_type == curr_filter]
+    if len(curr_nodes) == 0: 
+      return []
+
+    master_out = self._score_nodes(curr_nodes, focal_pt, hp)
+    master_out = top_highest_x_values(master_out, n_count)
+    return [(self.id_to_node[key], val) for key, val in master_out.items()]
+
+
+  def retrieval_index(self, curr_filter="all"): 
+    """A RetrievalIndex over the current nodes. See RetrievalIndex."""
+    return RetrievalIndex(self, curr_filter)
+
+
+  def _add_node(self, time_step, node_type, content, importance, pointer_id, 
+                embedding=None):
     """
     Adding a new node to the memory stream. 
 
@@ -437,6 +573,7 @@ class MemoryStream:
       content: the str content of the memory record
       importance: int score of the importance score
       pointer_id: the str of the parent node 
+      embedding: the embedding of the content, if it was already computed
     Returns: 
       retrieved: A dictionary whose keys are a focal_pt query str, and whose
         values are a list of nodes that are retrieved for that query str. 
@@ -453,7 +590,9 @@ class MemoryStream:
 
     self.seq_nodes += [new_node]
     self.id_to_node[new_node.node_id] = new_node
-    self.embeddings[content] = get_text_embedding(content)
+    if embedding is None: 
+      embedding = get_text_embedding(content)
+    self.embeddings[content] = embedding
 
 
   def remember(self, content, time_step=0):
@@ -467,10 +606,11 @@ class MemoryStream:
     record_ids = [i.node_id for i in records]
     reflections = generate_reflection(records, anchor, reflection_count)
     scores = generate_importance_score(reflections)
+    embeddings = get_text_embeddings(reflections)
 
     for count, reflection in enumerate(reflections): 
       self._add_node(time_step, "reflection", reflections[count], 
-                     scores[count], record_ids)
+                     scores[count], record_ids, embeddings[count])
 
 
 
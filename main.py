@@ -19,9 +19,14 @@ class Conversation:
         break
       # Add the interviewer's utterance to the conversation history
       self.conversation_history.append([self.interviewer_name, user_input])
-      # Get the agent's response
-      agent_response = self.agent.utterance(self.conversation_history)
-      print(f"{self.agent.get_fullname()}: {agent_response}")
+      # Get the agent's response, printing it as the tokens arrive
+      print(f"{self.agent.get_fullname()}: ", end="", flush=True)
+      chunks = []
+      for chunk in self.agent.utterance_stream(self.conversation_history):
+        print(chunk, end="", flush=True)
+        chunks.append(chunk)
+      print()
+      agent_response = "".join(chunks)
       # Add the agent's response to the conversation history
       self.conversation_history.append([self.agent.get_fullname(), agent_response])
 
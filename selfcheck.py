@@ -0,0 +1,358 @@
+"""
+Offline checks of the simulation pipeline. Every check runs against the
+deterministic stub backend (see simulation_engine/llm_backend.py), so no API
+key is needed and the results do not depend on the network.
+
+Run all the checks, or only the named ones, from the repository root:
+  python selfcheck.py [check ...]
+"""
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import traceback
+
+from types import SimpleNamespace
+
+from simulation_engine.llm_backend import set_backend, StubBackend
+from simulation_engine.settings import *
+
+
+SAMPLE_POPULATION = "gss_agents"
+CHECKS = dict()
+
+
+def check(func):
+  """Registers <func> as a check, under its name without "check_"."""
+  CHECKS[func.__name__[len("check_"):]] = func
+  return func
+
+
+def quiet(func, *args, **kwargs):
+  """Calls func(*args, **kwargs) without its progress prints."""
+  with contextlib.redirect_stdout(io.StringIO()):
+    return func(*args, **kwargs)
+
+
+def sample_agents(count):
+  """The agent metas of the first <count> agents of SAMPLE_POPULATION."""
+  population_dir = os.path.join(POPULATIONS_DIR, SAMPLE_POPULATION)
+  agent_ids = sorted(i for i in os.listdir(population_dir)
+                     if os.path.isdir(os.path.join(population_dir, i)))
+  return [{"population": SAMPLE_POPULATION, "agent_id": agent_id}
+          for agent_id in agent_ids[:count]]
+
+
+# ============================================================================
+# ######################### [SECTION 1: ITEM REPAIR] #########################
+# ============================================================================
+
+@check
+def check_item_repair():
+  from genagents.modules.interaction import _complete_items, _in_options
+
+  questions = {"Do you like tea?": ["Yes", "No"],
+               "Favorite season?": ["Summer", "Winter"],
+               "Do you vote?": ["Always", "Never"]}
+  # The second item is missing and the third is not an offered option.
+  output = {"responses": ["Yes", "Maybe"],
+            "reasonings": ["a", "b"],
+            "questions": ["Do you like tea?", "Do you vote?"]}
+  asked = []
+  def request(sub_questions):
+    asked.append(list(sub_questions))
+    return {"responses": ["Never", "Winter"], "reasonings": ["c", "d"],
+            "questions": ["Do you vote?", "Favorite season?"]}
+
+  ret = _complete_items(questions, output, _in_options, request)
+  assert asked == [["Favorite season?", "Do you vote?"]], asked
+  assert ret["responses"] == ["Yes", "Winter", "Never"], ret
+  assert ret["reasonings"] == ["a", "d", "c"], ret
+
+  # Items that never get a valid answer end up as None.
+  ret = _complete_items(questions, output, _in_options,
+                        lambda sub_questions: {"responses": []})
+  assert ret["responses"] == ["Yes", None, None], ret
+
+
+@check
+def check_ask():
+  from genagents.modules.interaction import (_complete_items, _ask_response,
+                                             _valid_ask_response)
+  from genagents.genagents import GenerativeAgent
+
+  questions = dict(enumerate([
+    {"question": "Do you like tea?", "response-type": "categorical",
+     "response-options": ["Yes", "No"]},
+    {"question": "Do you like tea?", "response-type": "categorical",
+     "response-options": ["Yes", "No"]},
+    {"question": "How many kids do you have?", "response-type": "int",
+     "response-scale": [0, 10]},
+    {"question": "Hours of sleep?", "response-type": "float",
+     "response-scale": [0, 24]}]))
+  # The kids item is skipped: the float answer must not be converted with
+  # the type of the question at its position.
+  output = {"responses": ["No", "Yes", "7.5"], "reasonings": ["a", "b", "c"],
+            "questions": ["Do you like tea?", "Do you like tea?",
+                          "Hours of sleep?"]}
+  request = lambda sub_questions: {"responses": ["2"], "reasonings": ["d"],
+                                   "questions": ["How many kids do you have?"]}
+  ret = _complete_items(questions, output, _valid_ask_response, request,
+                        func_convert=_ask_response,
+                        func_text=lambda key: questions[key]["question"])
+  assert ret["responses"] == ["No", "Yes", 2, 7.5], ret
+
+  agent = quiet(GenerativeAgent, os.path.join(
+    POPULATIONS_DIR, SAMPLE_POPULATION, sample_agents(1)[0]["agent_id"]))
+  ret = quiet(agent.ask, list(questions.values()))
+  assert len(ret["responses"]) == len(questions), ret
+  assert all(_valid_ask_response(response, question) for response, question
+             in zip(ret["responses"], questions.values())), ret
+
+  # Repeated texts get their own response columns in a survey.
+  from environment.survey.survey import Survey
+  survey = quiet(Survey)
+  quiet(survey.load_agents, sample_agents(3))
+  outputs = quiet(survey.ask_population, list(questions.values()),
+                  num_threads=2)
+  columns = ["Do you like tea?", "Do you like tea? (2)",
+             "How many kids do you have?", "Hours of sleep?"]
+  assert list(survey.responses.columns) == ["agent_pid"] + columns
+  for output in outputs:
+    row = survey.responses[survey.responses["agent_pid"]
+                           == output["agent_pid"]].iloc[0]
+    assert list(row[columns]) == output["responses"], (row, output)
+
+
+@check
+def check_batch_replies():
+  import environment.survey.survey as survey_module
+
+  questions = {"Do you like tea?": ["Yes", "No"],
+               "Do you like coffee?": ["Yes", "No"]}
+  # A complete reply, in the wrong order.
+  reply = json.dumps({
+    "1": {"Q": "Do you like coffee?", "Reasoning": "", "Response": "No"},
+    "2": {"Q": "Do you like tea?", "Reasoning": "", "Response": "Yes"}})
+  survey = quiet(survey_module.Survey)
+  quiet(survey.load_agents, sample_agents(2))
+
+  # The Batch API is replaced by a job that returns the reply at once.
+  batch_api = {name: getattr(survey_module, name) for name in
+               ["submit_batch", "wait_for_batch", "retrieve_batch_results"]}
+  survey_module.submit_batch = lambda batch_file, client=None: "batch"
+  survey_module.wait_for_batch = (
+    lambda *args, **kwargs: SimpleNamespace(status="completed"))
+  survey_module.retrieve_batch_results = lambda batch, client=None: {
+    agent_pid: reply for agent_pid in survey.agent_registry}
+  try:
+    with tempfile.TemporaryDirectory() as folder:
+      quiet(survey.survey, questions, mode="batch", batch_dir=folder)
+  finally:
+    for name, func in batch_api.items():
+      setattr(survey_module, name, func)
+  assert list(survey.responses["Do you like tea?"]) == ["Yes", "Yes"]
+  assert list(survey.responses["Do you like coffee?"]) == ["No", "No"]
+
+
+# ============================================================================
+# ########################### [SECTION 2: JOURNAL] ###########################
+# ============================================================================
+
+@check
+def check_journal():
+  from environment.survey.survey import Survey
+  from environment.interview.interview import Interview
+
+  questions = {"Do you like tea?": ["Yes", "No"],
+               "Favorite season?": ["Summer", "Winter"]}
+  agent_metas = sample_agents(8)
+  with tempfile.TemporaryDirectory() as folder:
+    journal_path = os.path.join(folder, "survey.jsonl")
+    survey = quiet(Survey, journal_path=journal_path)
+    quiet(survey.load_agents, agent_metas)
+
+    # The run crashes after a few agents.
+    administer = Survey._administer_to_agent
+    done = []
+    def crashing(self, agent_pid, *args, **kwargs):
+      if len(done) == 5:
+        raise RuntimeError("crash")
+      done.append(agent_pid)
+      return administer(self, agent_pid, *args, **kwargs)
+    Survey._administer_to_agent = crashing
+    try:
+      quiet(survey.survey, questions, num_threads=1)
+      raise AssertionError("the run did not crash")
+    except RuntimeError:
+      pass
+    finally:
+      Survey._administer_to_agent = administer
+
+    # A new process resumes it: only the remaining agents are surveyed.
+    resumed = quiet(Survey, journal_path=journal_path)
+    quiet(resumed.load_agents, agent_metas)
+    assert len(resumed.agent_registry) == len(agent_metas)
+    rerun = []
+    def counting(self, agent_pid, *args, **kwargs):
+      rerun.append(agent_pid)
+      return administer(self, agent_pid, *args, **kwargs)
+    Survey._administer_to_agent = counting
+    try:
+      quiet(resumed.survey, questions, num_threads=2)
+    finally:
+      Survey._administer_to_agent = administer
+    assert sorted(rerun) == sorted(set(resumed.agent_registry) - set(done))
+    assert len(resumed.responses) == len(agent_metas)
+    assert not resumed.responses[list(questions)].isna().any().any()
+
+    # Saving compacts the journal; the saved environment has every response.
+    quiet(resumed.save, os.path.join(folder, "saved"))
+    saved = quiet(Survey, saved_dir=os.path.join(folder, "saved"))
+    assert len(saved.responses) == len(agent_metas)
+
+    # Interviews resume per agent as well.
+    journal_path = os.path.join(folder, "interview.jsonl")
+    interview = quiet(Interview, journal_path=journal_path)
+    quiet(interview.load_agents, agent_metas[:3])
+    script = [["What do you do for a living?", 1]]
+    quiet(interview.interview, script, "", num_threads=2)
+    resumed = quiet(Interview, journal_path=journal_path)
+    assert len(resumed.responses) == 3
+    assert not quiet(list, resumed.interview_stream(script, ""))
+
+
+# ============================================================================
+# ########################### [SECTION 3: SHARDING] ##########################
+# ============================================================================
+
+@check
+def check_sharding():
+  from environment.survey.survey import Survey
+  from environment.sharded import ShardedRun, run_shard, shard_agents
+  from simulation_engine.gpt_structure import set_rate_share
+
+  agent_pids = [f"agent_pid_{i}" for i in range(10)]
+  shards = shard_agents(agent_pids, 3)
+  assert sorted(sum(shards, [])) == sorted(agent_pids)
+  assert max(map(len, shards)) - min(map(len, shards)) <= 1
+
+  questions = {"Do you like tea?": ["Yes", "No"],
+               "Favorite season?": ["Summer", "Winter"]}
+  survey = quiet(Survey)
+  quiet(survey.load_agents, sample_agents(12))
+  single = quiet(Survey)
+  single.agent_registry = dict(survey.agent_registry)
+  quiet(single.survey, questions, num_threads=4)
+
+  # The shards run in this process (so they use the stub backend) instead
+  # of on the spawned pool of ShardedRun.run.
+  with tempfile.TemporaryDirectory() as folder:
+    sharded = ShardedRun(survey, folder, num_shards=3)
+    quiet(sharded.prepare, "survey", questions, num_threads=4)
+    try:
+      for shard_index in range(sharded.num_shards):
+        quiet(run_shard, folder, shard_index)
+    finally:
+      set_rate_share(1)
+    quiet(sharded.merge)
+
+  # The merged responses are those of a single-process run, in registry order.
+  assert list(survey.responses["agent_pid"]) == list(survey.agent_registry)
+  assert survey.responses.astype(str).equals(single.responses.astype(str))
+
+
+# ============================================================================
+# ########################### [SECTION 4: ESTIMATE] ##########################
+# ============================================================================
+
+@check
+def check_estimate():
+  from environment.survey.survey import (Survey, _allocate_batch,
+                                         _stratified_estimate)
+
+  # Batches follow the population shares and never exceed what is left.
+  remaining = {"a": list(range(60)), "b": list(range(30)), "c": list(range(3))}
+  weights = {"a": 0.6, "b": 0.3, "c": 0.1}
+  alloc = _allocate_batch(weights, {"a": 0, "b": 0, "c": 0}, remaining, 20)
+  assert sum(alloc.values()) == 20 and alloc["c"] <= 3, alloc
+  assert alloc["a"] > alloc["b"] > 0, alloc
+  # A stratum that is ahead does not push the batch over its size.
+  alloc = _allocate_batch({"a": 0.5, "b": 0.5}, {"a": 10, "b": 0},
+                          {"a": list(range(50)), "b": list(range(50))}, 4)
+  assert alloc == {"a": 0, "b": 4}, alloc
+
+  # Surveying a whole stratum leaves no sampling error (finite population).
+  answers = {"a": ["Yes"] * 3 + ["No"]}
+  ret = _stratified_estimate(answers, ["Yes", "No"], {"a": 4}, 1.96)
+  assert abs(ret["Yes"]["estimate"] - 0.75) < 1e-9, ret
+  assert ret["Yes"]["margin"] < 1e-9, ret
+
+  # End to end: the estimate stops early and covers the full survey's shares.
+  questions = {"Do you support policy X?": ["Yes", "No"]}
+  survey = quiet(Survey)
+  quiet(survey.load_agents, sample_agents(400))
+  full = quiet(Survey)
+  full.agent_registry = dict(survey.agent_registry)
+  quiet(full.survey, questions, num_threads=8)
+  truth = full.responses[list(questions)[0]].value_counts(normalize=True)
+
+  ret = quiet(survey.estimate, questions, precision=0.08, batch_size=40,
+              num_threads=8, seed=0)
+  assert ret["converged"] and ret["sampled"] < ret["population"], ret
+  for option, estimate in ret["estimates"][list(questions)[0]].items():
+    assert estimate["margin"] <= 0.08, estimate
+    low, high = estimate["ci"]
+    assert low <= truth.get(option, 0.0) <= high, (option, estimate, truth)
+
+
+# ============================================================================
+# ######################### [SECTION 5: STREAM PARSER] #######################
+# ============================================================================
+
+@check
+def check_stream_parser():
+  from simulation_engine.llm_json_parser import IncrementalJSONFieldParser
+
+  # Well-formed escapes decode like json.loads; malformed ones stay literal.
+  valid = '{"utterance": "caf\\u00e9 \\ud83d\\ude00 \\"hi\\"\\n"}'
+  cases = {valid: json.loads(valid)["utterance"],
+           '{"utterance": "a\\u12g4b"}': "a\\u12g4b",
+           '{"utterance": "a\\ud83d\\u0041"}': "a\\ud83dA",
+           '{"utterance": "a\\ud83d b"}': "a\\ud83d b"}
+  for raw, expected in cases.items():
+    for size in range(1, len(raw) + 1):
+      parser = IncrementalJSONFieldParser("utterance")
+      text = "".join(parser.feed(raw[start:start+size])
+                     for start in range(0, len(raw), size))
+      assert text == expected, (raw, size, text, expected)
+
+
+# ============================================================================
+# ############################### [MAIN] #####################################
+# ============================================================================
+
+def main(names):
+  set_backend(StubBackend(latency_mean=0, embedding_latency_mean=0))
+  unknown = [name for name in names if name not in CHECKS]
+  if unknown:
+    sys.exit(f"Unknown checks: {', '.join(unknown)} "
+             f"(available: {', '.join(CHECKS)})")
+
+  failed = []
+  for name in names or list(CHECKS):
+    try:
+      CHECKS[name]()
+      print(f"ok      {name}")
+    except Exception:
+      failed += [name]
+      print(f"FAILED  {name}")
+      traceback.print_exc()
+  if failed:
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+  main(sys.argv[1:])
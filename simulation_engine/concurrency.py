@@ -0,0 +1,501 @@
+import asyncio
+import collections
+import concurrent.futures
+import contextvars
+import hashlib
+import itertools
+import queue
+import threading
+import time
+
+import numpy
+
+
+# ============================================================================
+# ######################## [SECTION 1: SINGLE FLIGHT] ########################
+# ============================================================================
+
+def request_key(*parts) -> str:
+  """A stable key for a request made of the given parts."""
+  h = hashlib.sha256()
+  for part in parts:
+    h.update(str(part).encode("utf-8"))
+    h.update(b"\x00")
+  return h.hexdigest()
+
+
+class SingleFlight:
+  """
+  Deduplicates identical in-flight requests. The first caller of a key (the
+  leader) runs the function; every caller that arrives with the same key
+  while the leader is still running waits for the leader's result instead
+  of making its own request. Once the leader finishes, the key is released,
+  so later calls make a fresh request.
+
+  Works across threads (do) and asyncio tasks (do_async), and the two can
+  share in-flight requests since both wait on a concurrent.futures.Future.
+  """
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.in_flight = dict()
+    self.leaders = 0
+    self.coalesced = 0
+
+
+  def _join(self, key):
+    """Returns (future, is_leader) for <key>."""
+    with self.lock:
+      if key in self.in_flight:
+        self.coalesced += 1
+        return self.in_flight[key], False
+      future = concurrent.futures.Future()
+      self.in_flight[key] = future
+      self.leaders += 1
+      return future, True
+
+
+  def _release(self, key):
+    with self.lock:
+      del self.in_flight[key]
+
+
+  def do(self, key, fn, *args, **kwargs):
+    future, is_leader = self._join(key)
+    if not is_leader:
+      return future.result()
+    try:
+      result = fn(*args, **kwargs)
+    except BaseException as e:
+      future.set_exception(e)
+      raise
+    finally:
+      self._release(key)
+    future.set_result(result)
+    return result
+
+
+  async def do_async(self, key, coro_fn, *args, **kwargs):
+    future, is_leader = self._join(key)
+    if not is_leader:
+      return await asyncio.wrap_future(future)
+    try:
+      result = await coro_fn(*args, **kwargs)
+    except BaseException as e:
+      future.set_exception(e)
+      raise
+    finally:
+      self._release(key)
+    future.set_result(result)
+    return result
+
+
+  def stats(self):
+    with self.lock:
+      return {"requests": self.leaders,
+              "coalesced": self.coalesced,
+              "in_flight": len(self.in_flight)}
+
+
+# ============================================================================
+# ######################## [SECTION 2: MICRO-BATCHER] #######################
+# ============================================================================
+
+class MicroBatcher:
+  """
+  Aggregates items submitted from many threads or tasks into batches. A 
+  background thread collects items for up to <max_wait> seconds after the 
+  first one arrives (or until <max_batch> items are queued, or their total 
+  cost_fn(item) would exceed <max_cost>), calls <batch_fn> once with the 
+  list of items, and hands each caller the result at its position. Up to 
+  <max_concurrency> batches can be in flight while the next one is being 
+  collected. An item that costs more than <max_cost> on its own is sent 
+  alone. 
+
+  <batch_fn> takes a list of items and returns a list of results of the 
+  same length. If it raises, the batch is split in halves that are retried 
+  separately, so that an item that cannot be processed (e.g., a text over 
+  the per-request token limit) only fails its own caller. 
+  """
+  def __init__(self, batch_fn, max_batch=64, max_wait=0.005, 
+               max_concurrency=8, max_cost=None, cost_fn=None): 
+    self.batch_fn = batch_fn
+    self.max_batch = max_batch
+    self.max_wait = max_wait
+    self.max_cost = max_cost
+    self.cost_fn = cost_fn or (lambda item: 1)
+    self.queue = queue.Queue()
+    self.executor = concurrent.futures.ThreadPoolExecutor(
+      max_workers=max_concurrency, thread_name_prefix="microbatch")
+    self.lock = threading.Lock()
+    self.worker = None
+    self.batches = 0
+    self.items = 0
+    self.splits = 0
+
+
+  def _ensure_worker(self): 
+    with self.lock: 
+      if self.worker is None: 
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+
+  def submit(self, item) -> concurrent.futures.Future: 
+    self._ensure_worker()
+    future = concurrent.futures.Future()
+    self.queue.put((item, future))
+    return future
+
+
+  def __call__(self, item): 
+    return self.submit(item).result()
+
+
+  async def submit_async(self, item): 
+    return await asyncio.wrap_future(self.submit(item))
+
+
+  def _cost(self, entry): 
+    try: 
+      return self.cost_fn(entry[0])
+    except Exception: 
+      return 0
+
+
+  def _run(self): 
+    held = None
+    while True: 
+      # An item that did not fit in the cost budget of the previous batch 
+      # starts the next one. 
+      batch = [held if held is not None else self.queue.get()]
+      held = None
+      cost = self._cost(batch[0])
+      deadline = time.monotonic() + self.max_wait
+      while len(batch) < self.max_batch: 
+        remaining = deadline - time.monotonic()
+        if remaining <= 0: 
+          break
+        try: 
+          entry = self.queue.get(timeout=remaining)
+        except queue.Empty: 
+          break
+        entry_cost = self._cost(entry)
+        if self.max_cost is not None and cost + entry_cost > self.max_cost: 
+          held = entry
+          break
+        batch += [entry]
+        cost += entry_cost
+      with self.lock: 
+        self.batches += 1
+        self.items += len(batch)
+      self.executor.submit(self._dispatch, batch)
+
+
+  def _dispatch(self, batch): 
+    items = [item for item, _ in batch]
+    try: 
+      results = self.batch_fn(items)
+      if len(results) != len(items): 
+        raise ValueError(f"Batch function returned {len(results)} results "
+                         f"for {len(items)} items.")
+    except Exception as e: 
+      if len(batch) == 1: 
+        batch[0][1].set_exception(e)
+        return
+      with self.lock: 
+        self.splits += 1
+      self._dispatch(batch[:len(batch) // 2])
+      self._dispatch(batch[len(batch) // 2:])
+      return
+    for (_, future), result in zip(batch, results): 
+      future.set_result(result)
+
+
+  def stats(self): 
+    with self.lock: 
+      return {"batches": self.batches, 
+              "items": self.items, 
+              "splits": self.splits, 
+              "mean_batch_size": self.items / self.batches 
+                                 if self.batches else 0.0}
+
+
+# ============================================================================
+# ########################### [SECTION 3: HEDGING] ###########################
+# ============================================================================
+
+class Hedger:
+  """
+  Hedged requests for cutting tail latency. A call runs in a worker thread; 
+  if it has not finished after the <percentile>-th percentile of the recent 
+  latencies, a duplicate is fired and whichever finishes first (and 
+  successfully, per <is_error>) wins. The loser is left to finish in the 
+  background and its result is discarded. 
+
+  Hedges are capped at <budget> times the number of calls so that the extra 
+  spend stays bounded, and no hedging happens before <min_samples> 
+  latencies have been observed. 
+  """
+  def __init__(self, percentile=95, budget=0.05, min_samples=50, 
+               window=1000, max_workers=128, is_error=None): 
+    self.percentile = percentile
+    self.budget = budget
+    self.min_samples = min_samples
+    self.is_error = is_error or (lambda result: False)
+    self.latencies = collections.deque(maxlen=window)
+    self.executor = concurrent.futures.ThreadPoolExecutor(
+      max_workers=max_workers, thread_name_prefix="hedge")
+    self.lock = threading.Lock()
+    self.calls = 0
+    self.hedges = 0
+    self.hedge_wins = 0
+
+
+  def threshold(self): 
+    """The current hedging delay in seconds, or None if not hedging yet."""
+    with self.lock: 
+      if len(self.latencies) < self.min_samples: 
+        return None
+      return float(numpy.percentile(self.latencies, self.percentile))
+
+
+  def _submit(self, fn, args, kwargs): 
+    # Every attempt runs in a copy of the caller's context so that, e.g., 
+    # the metrics are attributed to the caller's call site. 
+    ctx = contextvars.copy_context()
+    start = time.perf_counter()
+
+    def observe(future): 
+      if future.exception() is None: 
+        with self.lock: 
+          self.latencies.append(time.perf_counter() - start)
+
+    future = self.executor.submit(ctx.run, fn, *args, **kwargs)
+    future.add_done_callback(observe)
+    return future
+
+
+  def _failed(self, future): 
+    return future.exception() is not None or self.is_error(future.result())
+
+
+  def call(self, fn, *args, **kwargs): 
+    threshold = self.threshold()
+    with self.lock: 
+      self.calls += 1
+    primary = self._submit(fn, args, kwargs)
+    if threshold is None: 
+      return primary.result()
+
+    done, _ = concurrent.futures.wait([primary], timeout=threshold)
+    if done: 
+      return primary.result()
+    with self.lock: 
+      if self.hedges >= self.budget * self.calls: 
+        hedge = None
+      else: 
+        self.hedges += 1
+        hedge = True
+    if hedge is None: 
+      return primary.result()
+
+    hedge = self._submit(fn, args, kwargs)
+    pending = {primary, hedge}
+    while pending: 
+      done, pending = concurrent.futures.wait(
+        pending, return_when=concurrent.futures.FIRST_COMPLETED)
+      for future in done: 
+        if not self._failed(future) or not pending: 
+          if future is hedge: 
+            with self.lock: 
+              self.hedge_wins += 1
+          return future.result()
+
+
+  def stats(self): 
+    with self.lock: 
+      latencies = list(self.latencies)
+      ret = {"calls": self.calls, 
+             "hedges": self.hedges, 
+             "hedge_wins": self.hedge_wins, 
+             "hedge_rate": self.hedges / self.calls if self.calls else 0.0}
+    if latencies: 
+      p50, p95, p99 = numpy.percentile(latencies, [50, 95, 99])
+      ret.update({"p50": float(p50), "p95": float(p95), "p99": float(p99)})
+    return ret
+
+
+# ============================================================================
+# ########################## [SECTION 4: PIPELINING] #########################
+# ============================================================================
+
+class ChainScheduler: 
+  """
+  Runs many chains of dependent steps (e.g., the turns of many interviews) 
+  on one pool of <max_workers> threads. A chain is a generator: every 
+  next() runs one step, and the chain's return value is its result. A step 
+  only runs after the previous step of its chain, but the steps of 
+  different chains are interleaved, so a slow step only delays its own 
+  chain and the pool stays busy as long as there is work. 
+
+  The ready step of the chain with the fewest completed steps runs first, 
+  so chains progress evenly; at most <max_active> chains are started at a 
+  time (the others wait in submission order) to bound the memory that 
+  in-progress chains hold. as_completed() yields the results as the chains 
+  finish. 
+  """
+  def __init__(self, max_workers=50, max_active=None): 
+    self.max_workers = max_workers
+    self.max_active = max_active or 2 * max_workers
+    self.ready = queue.PriorityQueue()
+    self.backlog = collections.deque()
+    self.finished = queue.Queue()
+    self.lock = threading.Lock()
+    self.seq = itertools.count()
+    self.active = 0
+    self.pending = 0
+    self.workers = []
+    self.closed = False
+
+
+  def submit(self, key, chain): 
+    with self.lock: 
+      self.pending += 1
+      self.backlog.append((key, chain))
+      if not self.workers: 
+        for _ in range(self.max_workers): 
+          worker = threading.Thread(target=self._run, daemon=True)
+          worker.start()
+          self.workers += [worker]
+    self._admit()
+
+
+  def _admit(self): 
+    with self.lock: 
+      while self.backlog and self.active < self.max_active: 
+        key, chain = self.backlog.popleft()
+        self.active += 1
+        self.ready.put((0, next(self.seq), key, chain))
+
+
+  def _run(self): 
+    while True: 
+      done, _, key, chain = self.ready.get()
+      if chain is None: 
+        return
+      if self.closed: 
+        chain.close()
+        continue
+      try: 
+        next(chain)
+      except StopIteration as e: 
+        self._finish(key, e.value, None)
+        continue
+      except Exception as e: 
+        self._finish(key, None, e)
+        continue
+      self.ready.put((done + 1, next(self.seq), key, chain))
+
+
+  def _finish(self, key, result, error): 
+    with self.lock: 
+      self.active -= 1
+    self.finished.put((key, result, error))
+    self._admit()
+
+
+  def as_completed(self): 
+    """Yields (key, result, error) for every chain, as the chains finish."""
+    while True: 
+      with self.lock: 
+        if self.pending == 0: 
+          return
+        self.pending -= 1
+      yield self.finished.get()
+
+
+  def shutdown(self): 
+    """Stops the workers; the chains that did not finish are dropped."""
+    with self.lock: 
+      self.closed = True
+      workers, self.workers = self.workers, []
+    for _ in workers: 
+      self.ready.put((float("inf"), next(self.seq), None, None))
+
+
+# ============================================================================
+# ######################## [SECTION 5: RATE LIMITING] ########################
+# ============================================================================
+
+class RateLimiter: 
+  """
+  Client-side rate limiting with two token buckets, one for requests per 
+  minute and one for tokens per minute (either limit can be None for no 
+  limit). Each bucket holds up to a minute's worth and refills 
+  continuously; acquire() blocks until both buckets have enough. 
+
+  <share> is the fraction of the limits that this process may use, so that 
+  the processes of a sharded run together stay under the account's limits. 
+  """
+  def __init__(self, requests_per_minute=None, tokens_per_minute=None, 
+               share=1.0): 
+    self.lock = threading.Lock()
+    self.requests_per_minute = requests_per_minute
+    self.tokens_per_minute = tokens_per_minute
+    self.set_share(share)
+    self.waited = 0.0
+
+
+  def set_share(self, share): 
+    with self.lock: 
+      self.share = share
+      self.capacity = [limit * share if limit else None 
+                       for limit in (self.requests_per_minute, 
+                                     self.tokens_per_minute)]
+      self.available = list(self.capacity)
+      self.updated = time.monotonic()
+
+
+  def _refill(self): 
+    now = time.monotonic()
+    elapsed = now - self.updated
+    self.updated = now
+    for i, capacity in enumerate(self.capacity): 
+      if capacity: 
+        self.available[i] = min(capacity, 
+                                self.available[i] + elapsed * capacity / 60)
+
+
+  def acquire(self, tokens=0): 
+    """
+    Blocks until one request of <tokens> tokens fits in the limits, and 
+    returns the time waited in seconds. 
+    """
+    start = time.monotonic()
+    while True: 
+      with self.lock: 
+        self._refill()
+        # A request larger than a bucket only waits for the bucket to fill. 
+        needed = [min(1, self.capacity[0] or 1), 
+                  min(tokens, self.capacity[1] or tokens)]
+        wait = 0.0
+        for i, capacity in enumerate(self.capacity): 
+          if capacity and self.available[i] < needed[i]: 
+            wait = max(wait, 
+                       (needed[i] - self.available[i]) * 60 / capacity)
+        if wait == 0.0: 
+          for i, capacity in enumerate(self.capacity): 
+            if capacity: 
+              self.available[i] -= needed[i]
+          waited = time.monotonic() - start
+          self.waited += waited
+          return waited
+      time.sleep(wait)
+
+
+  def stats(self): 
+    with self.lock: 
+      return {"share": self.share, 
+              "requests_per_minute": self.capacity[0], 
+              "tokens_per_minute": self.capacity[1], 
+              "waited_s": self.waited}
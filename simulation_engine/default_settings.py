@@ -0,0 +1,40 @@
+# Defaults of the settings that were added after the first release, so that 
+# a settings.py written for an older version keeps working. Every module 
+# imports these before settings.py, which overrides them. See 
+# example-settings.py for what each setting does. 
+
+LLM_BACKEND = "openai"
+STUB_LATENCY_MEAN = 0.8
+STUB_LATENCY_SIGMA = 0.5
+STUB_EMBEDDING_LATENCY_MEAN = 0.1
+STUB_ERROR_RATE = 0.0
+
+AGENT_DESC_TOKEN_BUDGET = None
+
+PROMPT_LAYOUT = "default"
+
+COALESCE_REQUESTS = True
+
+EMBEDDING_BATCH_SIZE = 256
+EMBEDDING_BATCH_TOKENS = 250000
+EMBEDDING_BATCH_WAIT_MS = 5
+
+HEDGE_REQUESTS = False
+HEDGE_PERCENTILE = 95
+HEDGE_BUDGET = 0.05
+
+LLM_CASCADE = {}
+
+STRUCTURED_OUTPUTS = True
+
+PARTIAL_RETRY_ROUNDS = 2
+
+DIALOGUE_WINDOW_TURNS = 12
+DIALOGUE_ANCHOR_TURNS = 4
+INTERVIEW_DIALOGUE_STATE = False
+
+LLM_REQUESTS_PER_MINUTE = None
+LLM_TOKENS_PER_MINUTE = None
+
+RESPONSES_FORMAT = "csv"
+TRANSCRIPTS_FORMAT = "json"
@@ -10,6 +10,81 @@ MAX_CHUNK_SIZE = 4
 
 LLM_VERS = "gpt-4o-mini"
 
+# "openai" or "stub". The stub backend is deterministic and offline; its 
+# latency (lognormal, in seconds) and error rate are set below. 
+LLM_BACKEND = "openai"
+STUB_LATENCY_MEAN = 0.8
+STUB_LATENCY_SIGMA = 0.5
+STUB_EMBEDDING_LATENCY_MEAN = 0.1
+STUB_ERROR_RATE = 0.0
+
+# Max tokens of the agent description (self description + retrieved 
+# memories) in a prompt. None includes all retrieved memories. 
+AGENT_DESC_TOKEN_BUDGET = None
+
+# "default" retrieves the memories that are relevant to each question. 
+# "cache" renders a question-independent agent description (canonical self 
+# description + memories in a fixed order) so that all prompts for an agent 
+# share a prefix that the provider's prompt cache can reuse. 
+PROMPT_LAYOUT = "default"
+
+# Identical embedding requests (and deterministic, temperature 0, completion 
+# requests) that are in flight at the same time share a single call. 
+COALESCE_REQUESTS = True
+
+# Concurrent get_text_embedding calls are sent together, in requests of up 
+# to EMBEDDING_BATCH_SIZE texts (and EMBEDDING_BATCH_TOKENS tokens) collected 
+# for up to EMBEDDING_BATCH_WAIT_MS. Set EMBEDDING_BATCH_SIZE to 1 to send 
+# one text per request. 
+EMBEDDING_BATCH_SIZE = 256
+EMBEDDING_BATCH_TOKENS = 250000
+EMBEDDING_BATCH_WAIT_MS = 5
+
+# Hedged requests: a chat request that is slower than the HEDGE_PERCENTILE 
+# of recent latencies gets a duplicate, and the first answer wins. Hedges 
+# are capped at HEDGE_BUDGET (fraction) of all requests. 
+HEDGE_REQUESTS = False
+HEDGE_PERCENTILE = 95
+HEDGE_BUDGET = 0.05
+
+# Model cascades, keyed by stage (e.g., "importance_score") or call site. The 
+# models are tried in order and a call only escalates to the next one when 
+# the cheaper model's output fails to parse or validate. 
+LLM_CASCADE = {}
+
+# Send the JSON schema of each prompt template's output along with the 
+# request (OpenAI structured outputs), so that completions always parse. 
+# Models that do not support them get unconstrained completions. 
+STRUCTURED_OUTPUTS = True
+
+# How many follow-up prompts re-issue the questions of a batch 
+# categorical/numerical response that came back missing or invalid. 
+PARTIAL_RETRY_ROUNDS = 2
+
+# Dialogues passed as a DialogueState keep the last DIALOGUE_WINDOW_TURNS 
+# turns verbatim and summarize the older ones; the retrieval anchor is the 
+# last DIALOGUE_ANCHOR_TURNS turns. 
+DIALOGUE_WINDOW_TURNS = 12
+DIALOGUE_ANCHOR_TURNS = 4
+
+# Interviews keep their transcripts in a DialogueState (windowed prompts, 
+# background summaries of the older turns) instead of sending the full 
+# transcript with every turn. This changes the cost and the memories 
+# retrieved, so it is off by default. 
+INTERVIEW_DIALOGUE_STATE = False
+
+# Client-side rate limits for all requests to the LLM backend (None for no 
+# limit). A sharded run splits them evenly between its shards. 
+LLM_REQUESTS_PER_MINUTE = None
+LLM_TOKENS_PER_MINUTE = None
+
+# How saved environments store their responses. RESPONSES_FORMAT is "csv" 
+# or "parquet" (typed columns; needs pyarrow) for surveys, and 
+# TRANSCRIPTS_FORMAT is "json" or "jsonl" (one agent per line) for 
+# interviews. Saved files of either format are detected when loading. 
+RESPONSES_FORMAT = "csv"
+TRANSCRIPTS_FORMAT = "json"
+
 BASE_DIR = f"{Path(__file__).resolve().parent.parent}"
 
 ## To do: Are the following needed in the new structure? Ideally Populations_Dir is for the user to define.
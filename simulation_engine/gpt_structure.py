@@ -1,12 +1,47 @@
 import openai
+import asyncio
 import time
+import json
+import functools
+import threading
 import base64
+from types import SimpleNamespace
 from typing import List, Union
 
+from simulation_engine.default_settings import *
 from simulation_engine.settings import *
+from simulation_engine.global_methods import *
+from simulation_engine.llm_backend import *
+from simulation_engine.instrumentation import *
+from simulation_engine.concurrency import *
 
 openai.api_key = OPENAI_API_KEY
 
+# The sampling temperature of the chat completions. 
+CHAT_TEMPERATURE = 0.7
+
+# Models that do not accept json_schema response formats (see 
+# structured_format): the legacy model families, plus every model whose API 
+# answered that it does not support them. 
+UNSTRUCTURED_MODEL_PREFIXES = ("gpt-3.5", "gpt-4-", "o1-preview", "o1-mini")
+UNSTRUCTURED_MODELS = {"gpt-4"}
+
+# In-flight chat completions and embeddings, keyed by their request. 
+CHAT_FLIGHT = SingleFlight()
+EMBEDDING_FLIGHT = SingleFlight()
+
+# Fires a duplicate of the chat requests that are slower than the 
+# HEDGE_PERCENTILE of recent latencies (see HEDGE_REQUESTS). 
+CHAT_HEDGER = Hedger(percentile=HEDGE_PERCENTILE, 
+                     budget=HEDGE_BUDGET, 
+                     is_error=lambda r: isinstance(r, str) 
+                                        and r.startswith("GENERATION ERROR"))
+
+# Client-side limit on the requests and tokens per minute sent to the 
+# backend (see LLM_REQUESTS_PER_MINUTE). A sharded run gives each process a 
+# share of it. 
+RATE_LIMITER = RateLimiter(LLM_REQUESTS_PER_MINUTE, LLM_TOKENS_PER_MINUTE)
+
 
 # ============================================================================
 # #######################[SECTION 1: HELPER FUNCTIONS] #######################
@@ -26,6 +61,56 @@ def print_run_prompts(prompt_input: Union[str, List[str]],
   print ("\n\n\n")
 
 
+def structured_format(model: str, response_format: dict) -> dict: 
+  """
+  <response_format> if STRUCTURED_OUTPUTS is on and <model> accepts it, 
+  else None (the completion is then generated unconstrained, and the 
+  parsers still read the JSON out of it). 
+  """
+  if not STRUCTURED_OUTPUTS or response_format is None: 
+    return None
+  if (model in UNSTRUCTURED_MODELS 
+      or model.startswith(UNSTRUCTURED_MODEL_PREFIXES)): 
+    return None
+  return response_format
+
+
+def _rejects_response_format(error: Exception) -> bool: 
+  """Whether the request failed because of its response_format."""
+  message = str(error).lower()
+  return "response_format" in message or "json_schema" in message
+
+
+def _lacks_structured_outputs(error: Exception) -> bool: 
+  """
+  Whether the model does not support response formats at all (e.g., 
+  "'response_format' of type 'json_schema' is not supported with this 
+  model"), as opposed to rejecting one schema (e.g., one over the size 
+  limit), which only concerns that request. 
+  """
+  message = str(error).lower()
+  return _rejects_response_format(error) and any(
+    phrase in message for phrase in ["not supported with this model", 
+                                     "model does not support", 
+                                     "not supported by this model"])
+
+
+def throttle(texts: List[str], max_tokens: int = None) -> None:
+  """
+  Waits until a request with <texts> as its input (and up to <max_tokens> 
+  of output) fits in the rate limits, if any are set. Tokens are 
+  approximated at ~4 characters per token. 
+  """
+  if LLM_REQUESTS_PER_MINUTE or LLM_TOKENS_PER_MINUTE: 
+    tokens = sum(max(1, len(text) // 4) for text in texts)
+    RATE_LIMITER.acquire(tokens + (max_tokens or 0))
+
+
+def set_rate_share(share: float) -> None:
+  """Limits this process to <share> of the configured rate limits."""
+  RATE_LIMITER.set_share(share)
+
+
 def generate_prompt(prompt_input: Union[str, List[str]], 
                     prompt_lib_file: str) -> str:
   """Generate a prompt by replacing placeholders in a template file with 
@@ -50,47 +135,177 @@ def generate_prompt(prompt_input: Union[str, List[str]],
 # ####################### [SECTION 2: SAFE GENERATE] #########################
 # ============================================================================
 
-def gpt_request(prompt: str, 
-                model: str = "gpt-4o", 
-                max_tokens: int = 1500) -> str:
-  """Make a request to OpenAI's GPT model."""
-  if model == "o1-preview": 
-    try:
-      client = openai.OpenAI(api_key=OPENAI_API_KEY)
-      response = client.chat.completions.create(
-        model=model,
-        messages=[{"role": "user", "content": prompt}]
-      )
-      return response.choices[0].message.content
-    except Exception as e:
-      return f"GENERATION ERROR: {str(e)}"
-
+def _timed_chat(messages: List[dict], 
+                model: str, 
+                max_tokens: int = None, 
+                temperature: float = None,
+                response_format: dict = None,
+                n: int = None,
+                top_logprobs: int = None) -> Union[str, List[str], tuple]:
+  """
+  Sends a chat request to the backend and records its metrics. With <n>, 
+  requests n choices and returns the list of their texts; with 
+  <top_logprobs>, returns (text, the completion's top_logprobs). Errors 
+  return the "GENERATION ERROR" string. 
+  """
+  throttle([message["content"] for message in messages], 
+           (max_tokens or 0) * (n or 1))
+  start = time.perf_counter()
   try:
-    client = openai.OpenAI(api_key=OPENAI_API_KEY)
-    response = client.chat.completions.create(
-      model=model,
-      messages=[{"role": "user", "content": prompt}],
-      max_tokens=max_tokens,
-      temperature=0.7
-    )
-    return response.choices[0].message.content
+    # Only passed when used, so that backends without them keep working. 
+    kwargs = {"n": n} if n else {}
+    if top_logprobs: 
+      kwargs["top_logprobs"] = top_logprobs
+    completion = get_backend().chat(messages, model, max_tokens, temperature, 
+                                    response_format, **kwargs)
   except Exception as e:
+    record_request("gpt_request", model, time.perf_counter() - start, 
+                   error=True)
+    if response_format is not None and _rejects_response_format(e): 
+      # Generate without the schema. If the model does not support them at 
+      # all, its later requests skip the schema as well. 
+      if _lacks_structured_outputs(e): 
+        UNSTRUCTURED_MODELS.add(model)
+      return _timed_chat(messages, model, max_tokens, temperature, None, n, 
+                         top_logprobs)
     return f"GENERATION ERROR: {str(e)}"
+  record_request("gpt_request", model, time.perf_counter() - start, 
+                 completion.usage)
+  if n: 
+    return completion.choices
+  if top_logprobs: 
+    return completion.text, completion.top_logprobs
+  return completion.text
+
+
+def _gpt_request(prompt: str, 
+                 model: str, 
+                 max_tokens: int, 
+                 response_format: dict = None,
+                 n: int = None) -> Union[str, List[str]]:
+  messages = [{"role": "user", "content": prompt}]
+  if model == "o1-preview": 
+    args = (messages, model, None, None, None, n)
+  else: 
+    args = (messages, model, max_tokens, CHAT_TEMPERATURE, response_format, 
+            n)
+  if HEDGE_REQUESTS: 
+    return CHAT_HEDGER.call(_timed_chat, *args)
+  return _timed_chat(*args)
+
+
+def _coalesce_chat() -> bool: 
+  """
+  Whether identical chat requests can share a call. Only deterministic 
+  (temperature 0) completions are coalesced: sampled completions must stay 
+  independent, or agents with identical prompts would share one answer and 
+  the variance across the population would be understated. 
+  """
+  return COALESCE_REQUESTS and CHAT_TEMPERATURE == 0
+
+
+def gpt_request(prompt: str, 
+                model: str = "gpt-4o", 
+                max_tokens: int = 1500,
+                response_format: dict = None) -> str:
+  """
+  Make a request to the GPT model through the current LLM backend. If 
+  COALESCE_REQUESTS is on and the completions are deterministic (see 
+  _coalesce_chat), identical requests that are in flight at the same time 
+  share a single call. <response_format> is passed on to the 
+  backend (e.g., a JSON schema from llm_json_parser.json_schema_format). 
+  """
+  if not _coalesce_chat(): 
+    return _gpt_request(prompt, model, max_tokens, response_format)
+  key = request_key("chat", model, max_tokens, prompt, 
+                    json.dumps(response_format, sort_keys=True))
+  return CHAT_FLIGHT.do(key, _gpt_request, prompt, model, max_tokens, 
+                        response_format)
+
+
+async def gpt_request_async(prompt: str, 
+                            model: str = "gpt-4o", 
+                            max_tokens: int = 1500,
+                            response_format: dict = None) -> str:
+  """asyncio version of gpt_request."""
+  if not _coalesce_chat(): 
+    return await asyncio.to_thread(_gpt_request, prompt, model, max_tokens, 
+                                   response_format)
+  key = request_key("chat", model, max_tokens, prompt, 
+                    json.dumps(response_format, sort_keys=True))
+  return await CHAT_FLIGHT.do_async(key, asyncio.to_thread, _gpt_request, 
+                                    prompt, model, max_tokens, response_format)
+
+
+def gpt_request_samples(prompt: str, 
+                        model: str = "gpt-4o", 
+                        n: int = 1,
+                        max_tokens: int = 1500,
+                        response_format: dict = None) -> Union[str, List[str]]:
+  """
+  Requests <n> independent completions of <prompt> in a single call (the 
+  prompt tokens are paid once), and returns the list of their texts, or a 
+  "GENERATION ERROR" string like gpt_request. 
+  """
+  if not _coalesce_chat(): 
+    return _gpt_request(prompt, model, max_tokens, response_format, n)
+  key = request_key("chat", model, max_tokens, prompt, 
+                    json.dumps(response_format, sort_keys=True), n)
+  return CHAT_FLIGHT.do(key, _gpt_request, prompt, model, max_tokens, 
+                        response_format, n)
+
+
+def gpt_request_logprobs(prompt: str, 
+                         model: str = "gpt-4o", 
+                         max_tokens: int = 1,
+                         top_logprobs: int = 20) -> Union[str, tuple]:
+  """
+  Requests the completion of <prompt> along with the <top_logprobs> most 
+  likely tokens at each of its positions. Returns (text, [{token: logprob} 
+  per position], or None if the backend did not return them), or a 
+  "GENERATION ERROR" string like gpt_request. 
+  """
+  messages = [{"role": "user", "content": prompt}]
+  return _timed_chat(messages, model, max_tokens, None, None, None, 
+                     top_logprobs)
 
 
 def gpt4_vision(messages: List[dict], max_tokens: int = 1500) -> str:
   """Make a request to OpenAI's GPT-4 Vision model."""
-  try:
-    client = openai.OpenAI(api_key=OPENAI_API_KEY)
-    response = client.chat.completions.create(
-      model="gpt-4o",
-      messages=messages,
-      max_tokens=max_tokens,
-      temperature=0.7
-    )
-    return response.choices[0].message.content
-  except Exception as e:
-    return f"GENERATION ERROR: {str(e)}"
+  return _timed_chat(messages, "gpt-4o", max_tokens, CHAT_TEMPERATURE)
+
+
+def cascade_models(call_site: str, gpt_version: str) -> List[str]: 
+  """
+  The models to try, in order, for a call site: its LLM_CASCADE entry (by 
+  call site, e.g. "memory_stream/importance_score/batch_v1", or by stage, 
+  e.g. "importance_score"), or just gpt_version. 
+  """
+  if call_site in LLM_CASCADE: 
+    return LLM_CASCADE[call_site]
+  return LLM_CASCADE.get(stage_of(call_site), [gpt_version])
+
+
+def _request_with_retries(prompt: str, 
+                          model: str, 
+                          repeat: int, 
+                          max_tokens: int = 1500,
+                          response_format: dict = None) -> str: 
+  """The completion of <prompt>, or None if all <repeat> attempts failed."""
+  for i in range(repeat):
+    response = gpt_request(prompt, model, max_tokens, response_format)
+    if not response.startswith("GENERATION ERROR"):
+      return response
+    time.sleep(2**i)
+  return None
+
+
+def _timed_clean_up(func_clean_up, response, prompt, record): 
+  start = time.perf_counter()
+  try: 
+    return func_clean_up(response, prompt=prompt)
+  finally: 
+    record.parse_time += time.perf_counter() - start
 
 
 def chat_safe_generate(prompt_input: Union[str, List[str]], 
@@ -102,72 +317,549 @@ def chat_safe_generate(prompt_input: Union[str, List[str]],
                        verbose: bool = False,
                        max_tokens: int = 1500,
                        file_attachment: str = None,
-                       file_type: str = None) -> tuple:
-  """Generate a response using GPT models with error handling & retries."""
-  if file_attachment and file_type:
-    prompt = generate_prompt(prompt_input, prompt_lib_file)
-    messages = [{"role": "user", "content": prompt}]
-
-    if file_type.lower() == 'image':
-      with open(file_attachment, "rb") as image_file:
-        base64_image = base64.b64encode(image_file.read()).decode('utf-8')
-      messages.append({
-        "role": "user",
-        "content": [
-            {"type": "text", "text": "Please refer to the attached image."},
-            {"type": "image_url", "image_url": 
-              {"url": f"data:image/jpeg;base64,{base64_image}"}}
-        ]
-      })
-      response = gpt4_vision(messages, max_tokens)
-
-    elif file_type.lower() == 'pdf':
-      pdf_text = extract_text_from_pdf_file(file_attachment)
-      pdf = f"PDF attachment in text-form:\n{pdf_text}\n\n"
-      instruction = generate_prompt(prompt_input, prompt_lib_file)
-      prompt = f"{pdf}"
-      prompt += f"<End of the PDF attachment>\n=\nTask description:\n{instruction}"
-      response = gpt_request(prompt, gpt_version, max_tokens)
-
-  else:
+                       file_type: str = None,
+                       func_validate: callable = None,
+                       response_format: dict = None) -> tuple:
+  """
+  Generate a response using GPT models with error handling & retries. The 
+  call is recorded in METRICS under the call site of its prompt template.
+
+  If LLM_CASCADE has an entry for the call site, its models are tried in 
+  order (instead of gpt_version) and we only escalate to the next model 
+  when func_clean_up fails or func_validate rejects its output. 
+
+  With STRUCTURED_OUTPUTS on, <response_format> (the JSON schema of the 
+  template's output) is sent along to the models that support it (see 
+  structured_format) so that the completion is guaranteed to parse. When the generation fails altogether, <fail_safe> is returned 
+  as is, without going through func_clean_up. 
+  """
+  with track_call(call_site_from_template(prompt_lib_file)) as record: 
+    if file_attachment and file_type:
+      prompt = generate_prompt(prompt_input, prompt_lib_file)
+      messages = [{"role": "user", "content": prompt}]
+
+      if file_type.lower() == 'image':
+        with open(file_attachment, "rb") as image_file:
+          base64_image = base64.b64encode(image_file.read()).decode('utf-8')
+        messages.append({
+          "role": "user",
+          "content": [
+              {"type": "text", "text": "Please refer to the attached image."},
+              {"type": "image_url", "image_url": 
+                {"url": f"data:image/jpeg;base64,{base64_image}"}}
+          ]
+        })
+        response = gpt4_vision(messages, max_tokens)
+
+      elif file_type.lower() == 'pdf':
+        pdf_text = extract_text_from_pdf_file(file_attachment)
+        pdf = f"PDF attachment in text-form:\n{pdf_text}\n\n"
+        instruction = generate_prompt(prompt_input, prompt_lib_file)
+        prompt = f"{pdf}"
+        prompt += f"<End of the PDF attachment>\n=\nTask description:\n{instruction}"
+        response = gpt_request(prompt, gpt_version, max_tokens)
+
+      if func_clean_up and not response.startswith("GENERATION ERROR"):
+        response = _timed_clean_up(func_clean_up, response, prompt, record)
+
+    else:
+      prompt = generate_prompt(prompt_input, prompt_lib_file)
+      models = cascade_models(record.call_site, gpt_version)
+      for count, model in enumerate(models): 
+        response = _request_with_retries(
+          prompt, model, repeat, max_tokens, 
+          structured_format(model, response_format))
+        if response is None: 
+          response = fail_safe
+        elif count == len(models) - 1: 
+          # The last model of the cascade: parse errors propagate. 
+          if func_clean_up:
+            response = _timed_clean_up(func_clean_up, response, prompt, 
+                                       record)
+        else: 
+          try: 
+            output = response
+            if func_clean_up:
+              output = _timed_clean_up(func_clean_up, response, prompt, 
+                                       record)
+            if func_validate is None or func_validate(output): 
+              response = output
+              break
+          except Exception: 
+            pass
+        if count < len(models) - 1: 
+          record.escalations += 1
+
+  if verbose or DEBUG:
+    print_run_prompts(prompt_input, prompt, response)
+
+  return response, prompt, prompt_input, fail_safe
+
+
+def chat_safe_generate_samples(prompt_input: Union[str, List[str]], 
+                               prompt_lib_file: str,
+                               gpt_version: str = "gpt-4o", 
+                               samples: int = 1,
+                               repeat: int = 1,
+                               fail_safe: str = "error", 
+                               func_clean_up: callable = None,
+                               verbose: bool = False,
+                               max_tokens: int = 1500,
+                               response_format: dict = None) -> tuple:
+  """
+  Like chat_safe_generate, but requests <samples> choices of the prompt in 
+  one call and parses each of them independently. A choice that fails to 
+  parse is replaced by <fail_safe>, and so are all of them when the 
+  generation fails. The model cascade does not apply: every choice comes 
+  from gpt_version. 
+
+  Returns: 
+    The list of the <samples> parsed outputs, the prompt, the prompt input, 
+    and the fail safe. 
+  """
+  with track_call(call_site_from_template(prompt_lib_file)) as record: 
     prompt = generate_prompt(prompt_input, prompt_lib_file)
-    for i in range(repeat):
-      response = gpt_request(prompt, model=gpt_version)
-      if response != "GENERATION ERROR":
+    response_format = structured_format(gpt_version, response_format)
+    choices = None
+    for i in range(repeat): 
+      response = gpt_request_samples(prompt, gpt_version, samples, max_tokens, 
+                                     response_format)
+      if not isinstance(response, str): 
+        choices = response
         break
       time.sleep(2**i)
-    else:
-      response = fail_safe
 
-  if func_clean_up:
-    response = func_clean_up(response, prompt=prompt)
+    outputs = []
+    for choice in (choices or []): 
+      try: 
+        output = choice
+        if func_clean_up: 
+          output = _timed_clean_up(func_clean_up, choice, prompt, record)
+        outputs += [output]
+      except Exception: 
+        outputs += [fail_safe]
+    outputs += [fail_safe] * (samples - len(outputs))
 
   if verbose or DEBUG:
-    print_run_prompts(prompt_input, prompt, response)
+    print_run_prompts(prompt_input, prompt, outputs)
+
+  return outputs, prompt, prompt_input, fail_safe
+
+
+def chat_safe_generate_logprobs(prompt_input: Union[str, List[str]], 
+                                prompt_lib_file: str,
+                                gpt_version: str = "gpt-4o", 
+                                repeat: int = 1,
+                                verbose: bool = False,
+                                max_tokens: int = 1,
+                                top_logprobs: int = 20) -> tuple:
+  """
+  Generates a short completion and returns the log-probabilities of the 
+  most likely candidates for its first token. 
+
+  Returns: 
+    The {token: logprob} of the first token (None if the generation failed 
+    or the backend does not return logprobs), the prompt, and the prompt 
+    input. 
+  """
+  with track_call(call_site_from_template(prompt_lib_file)): 
+    prompt = generate_prompt(prompt_input, prompt_lib_file)
+    token_logprobs = None
+    for i in range(repeat): 
+      response = gpt_request_logprobs(prompt, gpt_version, max_tokens, 
+                                      top_logprobs)
+      if not isinstance(response, str): 
+        if response[1]: 
+          token_logprobs = response[1][0]
+        break
+      time.sleep(2**i)
 
-  return response, prompt, prompt_input, fail_safe
+  if verbose or DEBUG:
+    print_run_prompts(prompt_input, prompt, token_logprobs)
+
+  return token_logprobs, prompt, prompt_input
+
+
+def chat_safe_generate_stream(prompt_input: Union[str, List[str]], 
+                              prompt_lib_file: str,
+                              gpt_version: str = "gpt-4o", 
+                              func_stream_parse: callable = None,
+                              verbose: bool = False,
+                              max_tokens: int = 1500,
+                              response_format: dict = None):
+  """
+  Streaming version of chat_safe_generate. This is a generator: it yields 
+  the text of the completion as the tokens arrive. If <func_stream_parse> 
+  is given, every raw delta is passed through it and only its non-empty 
+  return values are yielded (e.g., IncrementalJSONFieldParser.feed). When 
+  the stream ends, the generator returns the raw completion (use 
+  `raw = yield from chat_safe_generate_stream(...)`); on errors, it returns 
+  a "GENERATION ERROR" string like gpt_request. 
+
+  The time to the first yielded chunk is recorded as the call's ttft. 
+  """
+  prompt = generate_prompt(prompt_input, prompt_lib_file)
+  messages = [{"role": "user", "content": prompt}]
+  record = CallRecord(call_site_from_template(prompt_lib_file) + ":stream")
+  throttle([prompt], max_tokens)
+  start = time.perf_counter()
+  ttft = None
+  try: 
+    response_format = structured_format(gpt_version, response_format)
+    stream = get_backend().stream_chat(messages, gpt_version, max_tokens, 
+                                       CHAT_TEMPERATURE, response_format)
+    for delta in stream: 
+      text = func_stream_parse(delta) if func_stream_parse else delta
+      if text: 
+        if ttft is None: 
+          ttft = time.perf_counter() - start
+        yield text
+    raw = stream.text
+    record.add_request(gpt_version, time.perf_counter() - start, 
+                       stream.usage, ttft=ttft)
+  except Exception as e: 
+    if response_format is not None and _lacks_structured_outputs(e): 
+      # Later requests to this model go without structured outputs. 
+      UNSTRUCTURED_MODELS.add(gpt_version)
+    raw = f"GENERATION ERROR: {str(e)}"
+    record.add_request(gpt_version, time.perf_counter() - start, 
+                       error=True, ttft=ttft)
+  METRICS.add(record)
+
+  if verbose or DEBUG:
+    print_run_prompts(prompt_input, prompt, raw)
+  return raw
 
 
 # ============================================================================
 # #################### [SECTION 3: OTHER API FUNCTIONS] ######################
 # ============================================================================
 
+def _embed_batch(texts: List[str], model: str) -> List[List[float]]:
+  """Embeds <texts> with one backend request and records its metrics."""
+  throttle(texts)
+  start = time.perf_counter()
+  try: 
+    embeddings = get_backend().embed(texts, model)
+  except Exception: 
+    record_request("embedding", model, time.perf_counter() - start, 
+                   error=True)
+    raise
+  # The backends do not report the usage of embedding requests, so we 
+  # approximate the token count of the texts (~4 characters per token). 
+  tokens = sum(max(1, len(text) // 4) for text in texts)
+  record_request("embedding", model, time.perf_counter() - start, 
+                 {"prompt_tokens": tokens})
+  return embeddings
+
+
+_embedding_batchers = dict()
+_embedding_batchers_lock = threading.Lock()
+
+
+def _get_embedding_batcher(model: str) -> MicroBatcher: 
+  with _embedding_batchers_lock: 
+    if model not in _embedding_batchers: 
+      _embedding_batchers[model] = MicroBatcher(
+        lambda texts: _embed_batch(texts, model), 
+        max_batch=EMBEDDING_BATCH_SIZE, 
+        max_wait=EMBEDDING_BATCH_WAIT_MS / 1000, 
+        max_cost=EMBEDDING_BATCH_TOKENS, 
+        cost_fn=lambda text: count_tokens(text, model))
+    return _embedding_batchers[model]
+
+
+def _get_text_embedding(text: str, model: str) -> List[float]:
+  if EMBEDDING_BATCH_SIZE > 1: 
+    return _get_embedding_batcher(model)(text)
+  return _embed_batch([text], model)[0]
+
+
 def get_text_embedding(text: str, 
                        model: str = "text-embedding-3-small") -> List[float]:
-  """Generate an embedding for the given text using OpenAI's API."""
+  """
+  Generate an embedding for the given text through the LLM backend. 
+  Identical texts that are embedded at the same time share a single call 
+  if COALESCE_REQUESTS is on. 
+  """
   if not isinstance(text, str) or not text.strip():
     raise ValueError("Input text must be a non-empty string.")
 
   text = text.replace("\n", " ").strip()
-  response = openai.embeddings.create(
-    input=[text], model=model).data[0].embedding
-  return response
+  if not COALESCE_REQUESTS: 
+    return _get_text_embedding(text, model)
+  key = request_key("embedding", model, text)
+  return EMBEDDING_FLIGHT.do(key, _get_text_embedding, text, model)
 
 
+async def get_text_embedding_async(
+  text: str, model: str = "text-embedding-3-small") -> List[float]:
+  """asyncio version of get_text_embedding."""
+  if not isinstance(text, str) or not text.strip():
+    raise ValueError("Input text must be a non-empty string.")
 
+  text = text.replace("\n", " ").strip()
+  if not COALESCE_REQUESTS: 
+    return await asyncio.to_thread(_get_text_embedding, text, model)
+  key = request_key("embedding", model, text)
+  return await EMBEDDING_FLIGHT.do_async(key, asyncio.to_thread, 
+                                         _get_text_embedding, text, model)
+
+
+def get_text_embeddings(texts: List[str], 
+                        model: str = "text-embedding-3-small"
+                        ) -> List[List[float]]:
+  """
+  Embeds a list of texts. With the micro-batcher on, the texts are submitted 
+  together so they go out in as few requests as possible; otherwise they 
+  are sent as a single request. 
+  """
+  for text in texts: 
+    if not isinstance(text, str) or not text.strip():
+      raise ValueError("Input text must be a non-empty string.")
+  texts = [text.replace("\n", " ").strip() for text in texts]
+  if not texts: 
+    return []
+  if EMBEDDING_BATCH_SIZE > 1: 
+    batcher = _get_embedding_batcher(model)
+    futures = [batcher.submit(text) for text in texts]
+    return [future.result() for future in futures]
+  return _embed_batch(texts, model)
+
+
+def embedding_batch_stats() -> dict: 
+  """Counters of the embedding micro-batchers, per model."""
+  with _embedding_batchers_lock: 
+    return {model: batcher.stats() 
+            for model, batcher in _embedding_batchers.items()}
+
+
+def hedging_stats() -> dict: 
+  """Counters and recent latency percentiles of the hedged chat requests."""
+  return CHAT_HEDGER.stats()
+
+
+def coalescing_stats() -> dict: 
+  """Counters of the requests that were made vs. coalesced."""
+  return {"chat": CHAT_FLIGHT.stats(), 
+          "embedding": EMBEDDING_FLIGHT.stats()}
 
 
+# ============================================================================
+# ######################## [SECTION 4: BATCH API] ############################
+# ============================================================================
 
+def write_batch_file(batch_requests: List[dict], 
+                     batch_file: str, 
+                     max_tokens: int = 1500) -> str:
+  """
+  Writes the requests of a batch job to a JSONL file in the format that is 
+  expected by OpenAI's Batch API. 
+
+  Parameters:
+    batch_requests: A list of dictionaries, each with the keys "custom_id", 
+      "prompt", and "model", and optionally "response_format". 
+    batch_file: The path of the JSONL file to write. 
+    max_tokens: The max_tokens used for every request in the batch. 
+  Returns: 
+    The path of the written batch file. 
+  """
+  create_folder_if_not_there(batch_file)
+  with open(batch_file, "w") as f: 
+    for request in batch_requests: 
+      line = {"custom_id": request["custom_id"], 
+              "method": "POST", 
+              "url": "/v1/chat/completions", 
+              "body": {"model": request["model"], 
+                       "messages": [{"role": "user", 
+                                     "content": request["prompt"]}],
+                       "max_tokens": max_tokens,
+                       "temperature": CHAT_TEMPERATURE}}
+      if request.get("response_format"): 
+        line["body"]["response_format"] = request["response_format"]
+      f.write(json.dumps(line) + "\n")
+  return batch_file
+
+
+def submit_batch(batch_file: str, client=None) -> str: 
+  """Upload a batch JSONL file and create a batch job. Returns its id."""
+  client = client or openai.OpenAI(api_key=OPENAI_API_KEY)
+  with open(batch_file, "rb") as f: 
+    input_file = client.files.create(file=f, purpose="batch")
+  batch = client.batches.create(input_file_id=input_file.id, 
+                                endpoint="/v1/chat/completions", 
+                                completion_window="24h")
+  return batch.id
+
+
+def wait_for_batch(batch_id: str, 
+                   client=None, 
+                   poll_interval: float = 30, 
+                   verbose: bool = True): 
+  """
+  Polls a batch job until it reaches a terminal status. 
+
+  Parameters:
+    batch_id: The id of the batch job. 
+    client: The OpenAI client (or a FakeBatchClient). 
+    poll_interval: Seconds to wait between two polls. 
+  Returns: 
+    The final batch object. 
+  """
+  client = client or openai.OpenAI(api_key=OPENAI_API_KEY)
+  while True: 
+    batch = client.batches.retrieve(batch_id)
+    if verbose: 
+      print (f"Batch {batch_id}: {batch.status}")
+    if batch.status in ["completed", "failed", "expired", "cancelled"]: 
+      return batch
+    time.sleep(poll_interval)
+
+
+def retrieve_batch_results(batch, client=None) -> dict: 
+  """
+  Downloads the output of a finished batch job. 
+
+  Parameters:
+    batch: The batch object returned by wait_for_batch. 
+    client: The OpenAI client (or a FakeBatchClient). 
+  Returns: 
+    A dictionary whose keys are the custom_ids of the requests and whose 
+    values are the raw completion strings. Requests that errored out map 
+    to a "GENERATION ERROR" string like in gpt_request. 
+  """
+  client = client or openai.OpenAI(api_key=OPENAI_API_KEY)
+  results = dict()
+  for file_id in [batch.output_file_id, batch.error_file_id]: 
+    if not file_id: 
+      continue
+    for line in client.files.content(file_id).text.splitlines(): 
+      if not line.strip(): 
+        continue
+      row = json.loads(line)
+      response = row.get("response") or {}
+      if row.get("error") or response.get("status_code") != 200: 
+        error = row.get("error") or response.get("body")
+        results[row["custom_id"]] = f"GENERATION ERROR: {str(error)}"
+      else: 
+        body = response["body"]
+        results[row["custom_id"]] = body["choices"][0]["message"]["content"]
+  return results
+
+
+class FakeBatchClient: 
+  """
+  A local stand-in for the parts of the OpenAI client that the Batch API 
+  uses (files.create, files.content, batches.create, batches.retrieve). The 
+  state of the fake endpoint lives in <root_dir> so that a batch can be 
+  resumed from its id by a different client instance. 
+
+  <responder> is a function that takes the body of a chat completion 
+  request and returns the completion string; it defaults to the stub 
+  backend without latency or errors. A batch completes after it has been 
+  polled <complete_after> times. 
+  """
+  def __init__(self, root_dir, responder=None, complete_after=1): 
+    self.root_dir = root_dir
+    if responder is None: 
+      stub = StubBackend(latency_mean=0, embedding_latency_mean=0, 
+                         error_rate=0)
+      responder = lambda body: stub.chat(body["messages"], body["model"]).text
+    self.responder = responder
+    self.complete_after = complete_after
+    self.files = _FakeFiles(self)
+    self.batches = _FakeBatches(self)
+    create_folder_if_not_there(f"{root_dir}/files/")
+    create_folder_if_not_there(f"{root_dir}/batches/")
+
+
+class _FakeFiles: 
+  def __init__(self, client): 
+    self.client = client
+
+  def create(self, file, purpose="batch"): 
+    file_id = f"file-{generate_alphanumeric_string(24)}"
+    with open(f"{self.client.root_dir}/files/{file_id}.jsonl", "wb") as f: 
+      f.write(file.read())
+    return SimpleNamespace(id=file_id, purpose=purpose)
+
+  def content(self, file_id): 
+    with open(f"{self.client.root_dir}/files/{file_id}.jsonl") as f: 
+      return SimpleNamespace(text=f.read())
+
+
+class _FakeBatches: 
+  def __init__(self, client): 
+    self.client = client
+
+  def _path(self, batch_id): 
+    return f"{self.client.root_dir}/batches/{batch_id}.json"
+
+  def create(self, input_file_id, endpoint, completion_window="24h"): 
+    batch = {"id": f"batch_{generate_alphanumeric_string(24)}", 
+             "status": "in_progress", 
+             "endpoint": endpoint,
+             "input_file_id": input_file_id, 
+             "output_file_id": None, 
+             "error_file_id": None, 
+             "polls": 0}
+    write_dict_to_json(batch, self._path(batch["id"]))
+    return SimpleNamespace(**batch)
+
+  def retrieve(self, batch_id): 
+    batch = read_json_to_dict(self._path(batch_id))
+    batch["polls"] += 1
+    if batch["status"] == "in_progress" and (batch["polls"] 
+                                             >= self.client.complete_after): 
+      batch["output_file_id"] = self._run(batch["input_file_id"])
+      batch["status"] = "completed"
+    write_dict_to_json(batch, self._path(batch_id))
+    return SimpleNamespace(**batch)
+
+  def _run(self, input_file_id): 
+    output_file_id = f"file-{generate_alphanumeric_string(24)}"
+    input_text = self.client.files.content(input_file_id).text
+    with open(f"{self.client.root_dir}/files/{output_file_id}.jsonl", 
+              "w") as f: 
+      for line in input_text.splitlines(): 
+        request = json.loads(line)
+        content = self.client.responder(request["body"])
+        body = {"choices": [{"index": 0, 
+                             "message": {"role": "assistant", 
+                                         "content": content}}]}
+        row = {"id": f"batch_req_{generate_alphanumeric_string(12)}",
+               "custom_id": request["custom_id"],
+               "response": {"status_code": 200, "body": body}, 
+               "error": None}
+        f.write(json.dumps(row) + "\n")
+    return output_file_id
 
 
+# ============================================================================
+# ###################### [SECTION 5: TOKEN COUNTING] #########################
+# ============================================================================
 
+@functools.lru_cache(maxsize=None)
+def _get_tokenizer(model: str): 
+  """
+  Loads (once per model) the tiktoken encoding of the model. Returns None if 
+  tiktoken or its encoding files are not available, in which case we fall 
+  back on an approximate count. 
+  """
+  try: 
+    import tiktoken
+    try: 
+      return tiktoken.encoding_for_model(model)
+    except KeyError: 
+      return tiktoken.get_encoding("o200k_base")
+  except Exception: 
+    return None
+
+
+@functools.lru_cache(maxsize=100000)
+def count_tokens(text: str, model: str = LLM_VERS) -> int: 
+  """Counts the tokens of <text> for <model>. Results are cached."""
+  tokenizer = _get_tokenizer(model)
+  if tokenizer is None: 
+    return (len(text) + 3) // 4
+  return len(tokenizer.encode(text, disallowed_special=()))
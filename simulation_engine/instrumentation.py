@@ -0,0 +1,465 @@
+import contextvars
+import copy
+import json
+import os
+import threading
+import time
+
+from simulation_engine.default_settings import *
+from simulation_engine.settings import *
+
+
+# ============================================================================
+# ############################ [SECTION 1: PRICES] ###########################
+# ============================================================================
+
+# USD per 1M tokens: (input, cached input, output). Models that are not in
+# this table are recorded with a cost of 0.
+MODEL_PRICES = {
+  "gpt-4o": (2.50, 1.25, 10.00),
+  "gpt-4o-mini": (0.15, 0.075, 0.60),
+  "o1-preview": (15.00, 7.50, 60.00),
+  "text-embedding-3-small": (0.02, 0.02, 0.0),
+  "text-embedding-3-large": (0.13, 0.13, 0.0),
+}
+
+
+def estimate_cost(model, prompt_tokens, completion_tokens, cached_tokens=0):
+  if model not in MODEL_PRICES:
+    return 0.0
+  price_in, price_cached, price_out = MODEL_PRICES[model]
+  return ((prompt_tokens - cached_tokens) * price_in
+          + cached_tokens * price_cached
+          + completion_tokens * price_out) / 1_000_000
+
+
+# ============================================================================
+# ########################## [SECTION 2: HISTOGRAM] ##########################
+# ============================================================================
+
+SECONDS_BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5,
+                   5, 10, 30, 60, 120]
+TOKENS_BUCKETS = [16, 64, 256, 1024, 4096, 16384, 65536]
+
+
+class Histogram:
+  """A cumulative-bucket histogram in the style of Prometheus."""
+  def __init__(self, buckets):
+    self.buckets = list(buckets)
+    self.counts = [0] * (len(self.buckets) + 1)
+    self.count = 0
+    self.sum = 0.0
+
+
+  def observe(self, val):
+    for i, bound in enumerate(self.buckets):
+      if val <= bound:
+        self.counts[i] += 1
+        break
+    else:
+      self.counts[-1] += 1
+    self.count += 1
+    self.sum += val
+
+
+  def subtract(self, other):
+    ret = copy.deepcopy(self)
+    ret.counts = [a - b for a, b in zip(self.counts, other.counts)]
+    ret.count -= other.count
+    ret.sum -= other.sum
+    return ret
+
+
+  def mean(self):
+    return self.sum / self.count if self.count else 0.0
+
+
+  def percentile(self, q):
+    """Estimates the q-th percentile (0-100) by interpolating in buckets."""
+    if not self.count:
+      return 0.0
+    target = self.count * q / 100
+    seen = 0
+    for i, c in enumerate(self.counts):
+      if c and seen + c >= target:
+        low = self.buckets[i-1] if i > 0 else 0
+        high = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+        return low + (high - low) * (target - seen) / c
+      seen += c
+    return self.buckets[-1]
+
+
+  def package(self):
+    return {"buckets": self.buckets + ["+Inf"],
+            "counts": self.counts,
+            "count": self.count,
+            "sum": self.sum}
+
+
+# ============================================================================
+# ######################### [SECTION 3: CALL RECORDS] ########################
+# ============================================================================
+
+class CallRecord:
+  """
+  Everything we measure about one logical LLM call. A logical call can
+  span several requests (e.g., retries); their latency and tokens add up.
+  The requests of a hedged call finish on different threads, so the
+  counters they share are updated under <lock>.
+  """
+  def __init__(self, call_site, model=None):
+    self.lock = threading.Lock()
+    self.call_site = call_site
+    self.model = model
+    self.created = time.perf_counter()
+    self.dispatched = None
+    self.requests = 0
+    self.errors = 0
+    self.prompt_tokens = 0
+    self.completion_tokens = 0
+    self.cached_tokens = 0
+    self.latency = 0.0
+    self.ttft = None
+    self.parse_time = 0.0
+    self.escalations = 0
+
+
+  def add_request(self, model, latency, usage=None, error=False, ttft=None):
+    """
+    Adds one request. <ttft> is the time to the first token; for requests
+    that are not streamed it is the full latency.
+    """
+    usage = usage or {}
+    with self.lock:
+      if self.dispatched is None:
+        self.dispatched = time.perf_counter() - latency
+      if self.ttft is None:
+        self.ttft = latency if ttft is None else ttft
+      self.model = model
+      self.requests += 1
+      self.latency += latency
+      if error:
+        self.errors += 1
+      self.prompt_tokens += usage.get("prompt_tokens", 0)
+      self.completion_tokens += usage.get("completion_tokens", 0)
+      self.cached_tokens += usage.get("cached_tokens", 0)
+
+
+  def queue_wait(self):
+    """Time between the creation of the call and its first request."""
+    if self.dispatched is None:
+      return 0.0
+    return max(0.0, self.dispatched - self.created)
+
+
+  def cost(self):
+    return estimate_cost(self.model, self.prompt_tokens,
+                         self.completion_tokens, self.cached_tokens)
+
+
+_current_record = contextvars.ContextVar("current_record", default=None)
+
+
+def call_site_from_template(prompt_lib_file):
+  """
+  Derives the call site name from a prompt template path, e.g.,
+  ".../generative_agent/interaction/categorical_resp/batch_v1.txt" becomes
+  "interaction/categorical_resp/batch_v1".
+  """
+  path = os.path.relpath(prompt_lib_file, LLM_PROMPT_DIR)
+  path = os.path.splitext(path)[0].replace(os.sep, "/")
+  if path.startswith("generative_agent/"):
+    path = path[len("generative_agent/"):]
+  return path
+
+
+def stage_of(call_site):
+  """The stage of a call site is its template folder (e.g., "reflection")."""
+  parts = call_site.split("/")
+  return parts[-2] if len(parts) > 1 else parts[0]
+
+
+class track_call:
+  """
+  Context manager that opens a CallRecord for <call_site>. Requests made on
+  the same thread while it is open are attributed to it, and the record is
+  added to METRICS when it closes.
+  """
+  def __init__(self, call_site, registry=None):
+    self.record = CallRecord(call_site)
+    self.registry = registry
+    self.token = None
+
+  def __enter__(self):
+    self.token = _current_record.set(self.record)
+    return self.record
+
+  def __exit__(self, exc_type, exc, tb):
+    _current_record.reset(self.token)
+    if exc_type is not None:
+      # E.g., the response could not be parsed.
+      with self.record.lock:
+        self.record.errors += 1
+    (self.registry or METRICS).add(self.record)
+    return False
+
+
+def current_record():
+  return _current_record.get()
+
+
+def record_request(call_site, model, latency, usage=None, error=False):
+  """
+  Attributes one request to the currently open CallRecord, or records it as
+  a standalone call of <call_site> if no record is open.
+  """
+  record = current_record()
+  if record is not None:
+    record.add_request(model, latency, usage, error)
+    return
+  record = CallRecord(call_site, model)
+  record.created -= latency
+  record.add_request(model, latency, usage, error)
+  METRICS.add(record)
+
+
+# ============================================================================
+# ########################### [SECTION 4: REGISTRY] ##########################
+# ============================================================================
+
+class CallSiteMetrics:
+  def __init__(self):
+    self.calls = 0
+    self.requests = 0
+    self.errors = 0
+    self.prompt_tokens = 0
+    self.completion_tokens = 0
+    self.cached_tokens = 0
+    self.cost = 0.0
+    self.escalations = 0
+    self.escalated_calls = 0
+    self.histograms = {"queue_wait_seconds": Histogram(SECONDS_BUCKETS),
+                       "latency_seconds": Histogram(SECONDS_BUCKETS),
+                       "ttft_seconds": Histogram(SECONDS_BUCKETS),
+                       "parse_seconds": Histogram(SECONDS_BUCKETS),
+                       "prompt_tokens": Histogram(TOKENS_BUCKETS),
+                       "completion_tokens": Histogram(TOKENS_BUCKETS)}
+
+
+  def add(self, record):
+    self.calls += 1
+    self.requests += record.requests
+    self.errors += record.errors
+    self.prompt_tokens += record.prompt_tokens
+    self.completion_tokens += record.completion_tokens
+    self.cached_tokens += record.cached_tokens
+    self.cost += record.cost()
+    self.escalations += record.escalations
+    self.escalated_calls += 1 if record.escalations else 0
+    self.histograms["queue_wait_seconds"].observe(record.queue_wait())
+    self.histograms["latency_seconds"].observe(record.latency)
+    self.histograms["ttft_seconds"].observe(record.ttft or 0.0)
+    self.histograms["parse_seconds"].observe(record.parse_time)
+    self.histograms["prompt_tokens"].observe(record.prompt_tokens)
+    self.histograms["completion_tokens"].observe(record.completion_tokens)
+
+
+  def subtract(self, other):
+    ret = CallSiteMetrics()
+    for attr in ["calls", "requests", "errors", "prompt_tokens",
+                 "completion_tokens", "cached_tokens", "cost", "escalations",
+                 "escalated_calls"]:
+      setattr(ret, attr, getattr(self, attr) - getattr(other, attr))
+    ret.histograms = {key: hist.subtract(other.histograms[key])
+                      for key, hist in self.histograms.items()}
+    return ret
+
+
+  def escalation_rate(self):
+    """The fraction of calls that escalated to a stronger model."""
+    return self.escalated_calls / self.calls if self.calls else 0.0
+
+
+  def package(self):
+    return {"calls": self.calls,
+            "requests": self.requests,
+            "errors": self.errors,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cached_tokens": self.cached_tokens,
+            "cost_usd": self.cost,
+            "escalations": self.escalations,
+            "escalation_rate": self.escalation_rate(),
+            "histograms": {key: hist.package()
+                           for key, hist in self.histograms.items()}}
+
+
+class MetricsRegistry:
+  """Aggregates CallRecords by call site. Thread-safe."""
+  def __init__(self):
+    self.sites = dict()
+    self.lock = threading.Lock()
+
+
+  def add(self, record):
+    with self.lock, record.lock:
+      if record.call_site not in self.sites:
+        self.sites[record.call_site] = CallSiteMetrics()
+      self.sites[record.call_site].add(record)
+
+
+  def reset(self):
+    with self.lock:
+      self.sites = dict()
+
+
+  def snapshot(self):
+    """A copy of the registry, to be used as the baseline of summary()."""
+    with self.lock:
+      ret = MetricsRegistry()
+      ret.sites = copy.deepcopy(self.sites)
+      return ret
+
+
+  def since(self, baseline=None):
+    """The metrics recorded after <baseline> (a snapshot) was taken."""
+    with self.lock:
+      sites = copy.deepcopy(self.sites)
+    if baseline is None:
+      return sites
+    ret = dict()
+    for site, metrics in sites.items():
+      if site in baseline.sites:
+        metrics = metrics.subtract(baseline.sites[site])
+      if metrics.calls:
+        ret[site] = metrics
+    return ret
+
+
+  def to_json(self, baseline=None):
+    return json.dumps({site: metrics.package()
+                       for site, metrics in self.since(baseline).items()},
+                      indent=2)
+
+
+  def to_prometheus(self, baseline=None, prefix="genagents_llm"):
+    lines = []
+    sites = self.since(baseline)
+    counters = ["calls", "requests", "errors", "prompt_tokens",
+                "completion_tokens", "cached_tokens", "escalations"]
+    for counter in counters:
+      lines += [f"# TYPE {prefix}_{counter}_total counter"]
+      for site, metrics in sites.items():
+        lines += [f'{prefix}_{counter}_total{{call_site="{site}"}} '
+                  f'{getattr(metrics, counter)}']
+    lines += [f"# TYPE {prefix}_cost_usd_total counter"]
+    for site, metrics in sites.items():
+      lines += [f'{prefix}_cost_usd_total{{call_site="{site}"}} '
+                f'{metrics.cost:.6f}']
+
+    hist_names = list(CallSiteMetrics().histograms.keys())
+    for name in hist_names:
+      lines += [f"# TYPE {prefix}_{name} histogram"]
+      for site, metrics in sites.items():
+        hist = metrics.histograms[name]
+        cumulative = 0
+        for bound, count in zip(hist.buckets + ["+Inf"], hist.counts):
+          cumulative += count
+          lines += [f'{prefix}_{name}_bucket{{call_site="{site}",'
+                    f'le="{bound}"}} {cumulative}']
+        lines += [f'{prefix}_{name}_sum{{call_site="{site}"}} {hist.sum}']
+        lines += [f'{prefix}_{name}_count{{call_site="{site}"}} {hist.count}']
+    return "\n".join(lines) + "\n"
+
+
+  def summary(self, baseline=None):
+    """A per-stage summary table of the metrics recorded since <baseline>."""
+    stages = dict()
+    for site, metrics in self.since(baseline).items():
+      stage = stage_of(site)
+      if stage not in stages:
+        stages[stage] = CallSiteMetrics()
+      stages[stage] = _merge(stages[stage], metrics)
+
+    header = (f"{'stage':<18}{'calls':>7}{'errors':>7}{'prompt_tok':>12}"
+              f"{'cached_tok':>12}{'compl_tok':>11}{'cost_usd':>10}"
+              f"{'p50_s':>8}{'p95_s':>8}{'ttft_s':>8}{'queue_s':>9}"
+              f"{'parse_ms':>10}{'escal%':>8}")
+    lines = [header, "-" * len(header)]
+    for stage, m in sorted(stages.items()):
+      latency = m.histograms["latency_seconds"]
+      lines += [f"{stage:<18}{m.calls:>7}{m.errors:>7}{m.prompt_tokens:>12}"
+                f"{m.cached_tokens:>12}{m.completion_tokens:>11}"
+                f"{m.cost:>10.4f}"
+                f"{latency.percentile(50):>8.2f}"
+                f"{latency.percentile(95):>8.2f}"
+                f"{m.histograms['ttft_seconds'].percentile(50):>8.2f}"
+                f"{m.histograms['queue_wait_seconds'].mean():>9.3f}"
+                f"{m.histograms['parse_seconds'].mean() * 1000:>10.2f}"
+                f"{m.escalation_rate() * 100:>8.1f}"]
+    return "\n".join(lines)
+
+
+def _merge(a, b):
+  ret = copy.deepcopy(a)
+  for attr in ["calls", "requests", "errors", "prompt_tokens",
+               "completion_tokens", "cached_tokens", "cost", "escalations",
+               "escalated_calls"]:
+    setattr(ret, attr, getattr(a, attr) + getattr(b, attr))
+  for key, hist in ret.histograms.items():
+    other = b.histograms[key]
+    hist.counts = [x + y for x, y in zip(hist.counts, other.counts)]
+    hist.count += other.count
+    hist.sum += other.sum
+  return ret
+
+
+METRICS = MetricsRegistry()
+
+
+# ============================================================================
+# ######################## [SECTION 5: CONTEXT SAVINGS] ######################
+# ============================================================================
+
+class ContextSavings:
+  """
+  Records, per description builder, how many tokens of agent description 
+  were available and how many were packed into the prompt under the token 
+  budget. Thread-safe. 
+  """
+  def __init__(self):
+    self.sites = dict()
+    self.lock = threading.Lock()
+
+
+  def record(self, site, full_tokens, packed_tokens):
+    with self.lock:
+      if site not in self.sites:
+        self.sites[site] = {"calls": 0, 
+                            "full_tokens": 0, 
+                            "packed_tokens": 0,
+                            "saved_tokens": Histogram(TOKENS_BUCKETS)}
+      curr = self.sites[site]
+      curr["calls"] += 1
+      curr["full_tokens"] += full_tokens
+      curr["packed_tokens"] += packed_tokens
+      curr["saved_tokens"].observe(full_tokens - packed_tokens)
+
+
+  def reset(self):
+    with self.lock:
+      self.sites = dict()
+
+
+  def package(self):
+    with self.lock:
+      return {site: {"calls": curr["calls"],
+                     "full_tokens": curr["full_tokens"],
+                     "packed_tokens": curr["packed_tokens"],
+                     "saved_tokens": (curr["full_tokens"]
+                                      - curr["packed_tokens"]),
+                     "saved_tokens_histogram": curr["saved_tokens"].package()}
+              for site, curr in self.sites.items()}
+
+
+CONTEXT_SAVINGS = ContextSavings()
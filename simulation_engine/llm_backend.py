@@ -0,0 +1,474 @@
+import ast
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+import time
+from typing import List
+
+import numpy
+import openai
+
+from simulation_engine.default_settings import *
+from simulation_engine.settings import *
+
+
+# ============================================================================
+# ########################## [SECTION 1: INTERFACE] ##########################
+# ============================================================================
+
+class Completion:
+  """
+  The result of a chat completion request. <usage> holds the token counts
+  reported by the backend (prompt_tokens, completion_tokens, cached_tokens).
+  <choices> holds the text of every choice when several were requested
+  (<text> is the first one). <top_logprobs> holds, when they were requested
+  and the backend returned them, the {token: logprob} of the most likely
+  tokens at each position of the (first) choice.
+  """
+  def __init__(self, text, usage=None, choices=None, top_logprobs=None):
+    self.text = text
+    self.usage = usage or {}
+    self.choices = choices or [text]
+    self.top_logprobs = top_logprobs
+
+
+class CompletionStream:
+  """
+  A streamed chat completion. Iterating over it yields the text deltas as
+  they arrive; once it is exhausted, <text> holds the full completion and
+  <usage> the token counts. <events> is an iterable of (delta, usage)
+  pairs where either element may be None.
+  """
+  def __init__(self, events):
+    self.events = events
+    self.text = ""
+    self.usage = {}
+
+  def __iter__(self):
+    for delta, usage in self.events:
+      if usage:
+        self.usage = usage
+      if delta:
+        self.text += delta
+        yield delta
+
+
+class LLMBackend:
+  """
+  The interface that every LLM/embedding backend implements. gpt_structure
+  only talks to the models through the currently selected backend.
+  """
+  def chat(self,
+           messages: List[dict],
+           model: str,
+           max_tokens: int = None,
+           temperature: float = None,
+           response_format: dict = None,
+           n: int = None,
+           top_logprobs: int = None) -> Completion:
+    raise NotImplementedError
+
+  def stream_chat(self,
+                  messages: List[dict],
+                  model: str,
+                  max_tokens: int = None,
+                  temperature: float = None,
+                  response_format: dict = None) -> CompletionStream:
+    raise NotImplementedError
+
+  def embed(self, texts: List[str], model: str) -> List[List[float]]:
+    raise NotImplementedError
+
+
+# ============================================================================
+# ########################### [SECTION 2: OPENAI] ############################
+# ============================================================================
+
+class OpenAIBackend(LLMBackend):
+  def __init__(self, api_key=None):
+    # One client is shared across threads so that the connection pool is
+    # reused instead of re-created on every request.
+    self.client = openai.OpenAI(api_key=api_key or OPENAI_API_KEY)
+
+  def chat(self, messages, model, max_tokens=None, temperature=None, 
+           response_format=None, n=None, top_logprobs=None):
+    params = {"model": model, "messages": messages}
+    if max_tokens is not None:
+      params["max_tokens"] = max_tokens
+    if temperature is not None:
+      params["temperature"] = temperature
+    if response_format is not None:
+      params["response_format"] = response_format
+    if n is not None and n > 1:
+      params["n"] = n
+    if top_logprobs:
+      params["logprobs"] = True
+      params["top_logprobs"] = top_logprobs
+    response = self.client.chat.completions.create(**params)
+    choices = [choice.message.content for choice in response.choices]
+    logprobs = getattr(response.choices[0], "logprobs", None)
+    if logprobs is not None and logprobs.content:
+      logprobs = [{top.token: top.logprob for top in token.top_logprobs}
+                  for token in logprobs.content]
+    else:
+      logprobs = None
+    return Completion(choices[0], _usage_to_dict(response.usage), choices,
+                      logprobs)
+
+  def stream_chat(self, messages, model, max_tokens=None, temperature=None, 
+                  response_format=None):
+    params = {"model": model, "messages": messages, "stream": True,
+              "stream_options": {"include_usage": True}}
+    if max_tokens is not None:
+      params["max_tokens"] = max_tokens
+    if temperature is not None:
+      params["temperature"] = temperature
+    if response_format is not None:
+      params["response_format"] = response_format
+    response = self.client.chat.completions.create(**params)
+
+    def events():
+      for chunk in response:
+        delta = None
+        if chunk.choices:
+          delta = chunk.choices[0].delta.content
+        yield delta, _usage_to_dict(getattr(chunk, "usage", None))
+    return CompletionStream(events())
+
+  def embed(self, texts, model):
+    response = self.client.embeddings.create(input=texts, model=model)
+    return [row.embedding for row in response.data]
+
+
+def _usage_to_dict(usage):
+  if usage is None:
+    return {}
+  ret = {"prompt_tokens": usage.prompt_tokens,
+         "completion_tokens": usage.completion_tokens,
+         "cached_tokens": 0}
+  details = getattr(usage, "prompt_tokens_details", None)
+  if details is not None and getattr(details, "cached_tokens", None):
+    ret["cached_tokens"] = details.cached_tokens
+  return ret
+
+
+# ============================================================================
+# ############################ [SECTION 3: STUB] #############################
+# ============================================================================
+
+class StubBackendError(Exception):
+  pass
+
+
+class StubBackend(LLMBackend):
+  """
+  A deterministic, offline backend for load testing. It returns well-formed
+  JSON for every prompt template under LLM_PROMPT_DIR and hash-derived
+  embeddings, so the whole pipeline runs without network access. The
+  content of a response only depends on the prompt; the latency (lognormal
+  with the given mean and sigma, in seconds) and the injected errors are
+  drawn from a seeded random generator. When streaming, the first token
+  arrives after <ttft_fraction> of the sampled latency and the rest of the
+  tokens are spread over the remainder.
+  """
+  def __init__(self,
+               latency_mean=None,
+               latency_sigma=None,
+               embedding_latency_mean=None,
+               error_rate=None,
+               embedding_dim=1536,
+               ttft_fraction=0.2,
+               seed=0):
+    self.latency_mean = _default(latency_mean, STUB_LATENCY_MEAN)
+    self.latency_sigma = _default(latency_sigma, STUB_LATENCY_SIGMA)
+    self.embedding_latency_mean = _default(embedding_latency_mean,
+                                           STUB_EMBEDDING_LATENCY_MEAN)
+    self.error_rate = _default(error_rate, STUB_ERROR_RATE)
+    self.embedding_dim = embedding_dim
+    self.ttft_fraction = ttft_fraction
+    self.rng = random.Random(seed)
+    self.lock = threading.Lock()
+    self.seen_prefixes = set()
+
+
+  def _sample(self, mean):
+    """Samples (delay, fail) for one request."""
+    with self.lock:
+      fail = self.rng.random() < self.error_rate
+      if mean > 0:
+        # Parametrized so that <mean> is the mean of the distribution.
+        mu = math.log(mean) - self.latency_sigma ** 2 / 2
+        delay = self.rng.lognormvariate(mu, self.latency_sigma)
+      else:
+        delay = 0
+    return delay, fail
+
+
+  def _wait(self, mean):
+    delay, fail = self._sample(mean)
+    time.sleep(delay)
+    if fail:
+      raise StubBackendError("Injected stub backend error")
+
+
+  def chat(self, messages, model, max_tokens=None, temperature=None, 
+           response_format=None, n=None, top_logprobs=None):
+    # The stub's completions always follow the templates' output format, so 
+    # <response_format> is accepted and ignored. With <n> choices, every 
+    # choice is a different (but deterministic) sample. 
+    self._wait(self.latency_mean)
+    prompt = "\n".join(_message_text(m) for m in messages)
+    choices = [stub_completion(prompt, sample) for sample in range(n or 1)]
+    usage = {"prompt_tokens": _approx_tokens(prompt),
+             "completion_tokens": sum(_approx_tokens(text) 
+                                      for text in choices),
+             "cached_tokens": self._cached_tokens(prompt)}
+    logprobs = None
+    if top_logprobs: 
+      # Only the first token's candidates are emulated. 
+      logprobs = [dict(stub_logprobs(prompt, choices[0])[:top_logprobs])]
+    return Completion(choices[0], usage, choices, logprobs)
+
+
+  def stream_chat(self, messages, model, max_tokens=None, temperature=None, 
+                  response_format=None):
+    delay, fail = self._sample(self.latency_mean)
+    prompt = "\n".join(_message_text(m) for m in messages)
+    text = stub_completion(prompt)
+    # ~4 characters per token.
+    chunks = [text[i:i+4] for i in range(0, len(text), 4)]
+    usage = {"prompt_tokens": _approx_tokens(prompt),
+             "completion_tokens": len(chunks),
+             "cached_tokens": self._cached_tokens(prompt)}
+
+    def events():
+      time.sleep(delay * self.ttft_fraction)
+      if fail:
+        raise StubBackendError("Injected stub backend error")
+      per_token = delay * (1 - self.ttft_fraction) / max(1, len(chunks) - 1)
+      for count, chunk in enumerate(chunks):
+        if count > 0:
+          time.sleep(per_token)
+        yield chunk, None
+      yield None, usage
+    return CompletionStream(events())
+
+
+  def _cached_tokens(self, prompt):
+    """
+    Emulates the provider's prompt caching: prefixes of 1024 tokens and
+    more are cached in increments of 128 tokens, and a request is charged
+    as cached for the longest prefix that an earlier request shared.
+    """
+    chars_per_block = 128 * 4
+    h = hashlib.sha256()
+    prefixes = []
+    for end in range(chars_per_block, len(prompt) + 1, chars_per_block):
+      h.update(prompt[end - chars_per_block:end].encode("utf-8"))
+      if end >= 1024 * 4:
+        prefixes += [(end, h.copy().digest())]
+    cached = 0
+    with self.lock:
+      for end, digest in prefixes:
+        if digest in self.seen_prefixes:
+          cached = end // 4
+        self.seen_prefixes.add(digest)
+    return cached
+
+
+  def embed(self, texts, model):
+    self._wait(self.embedding_latency_mean)
+    return [stub_embedding(text, self.embedding_dim) for text in texts]
+
+
+def _default(val, setting):
+  return setting if val is None else val
+
+
+def _message_text(message):
+  if isinstance(message["content"], str):
+    return message["content"]
+  return "\n".join(part.get("text", "") for part in message["content"])
+
+
+def _approx_tokens(text):
+  return max(1, len(text) // 4)
+
+
+def _hash_int(text):
+  return int(hashlib.sha256(text.encode("utf-8")).hexdigest()[:16], 16)
+
+
+def stub_embedding(text, dim=1536):
+  """A unit-length embedding derived from the hash of <text>."""
+  vec = numpy.random.RandomState(_hash_int(text) % (2**32)).standard_normal(dim)
+  return (vec / numpy.linalg.norm(vec)).tolist()
+
+
+def _stub_questions(prompt, field):
+  """
+  Parses the "Q: ...\n<field>: ..." blocks of the categorical and
+  numerical prompts into a list of (question, value) pairs.
+  """
+  task = prompt.split("Here are the questions:")[-1]
+  task = task.split("Here is the question:")[-1]
+  pattern = re.compile(rf"Q: (.*?)\n{field}: (.*?)\n", re.S)
+  questions = []
+  for q, val in pattern.findall(task + "\n"):
+    try:
+      questions += [(q.strip(), ast.literal_eval(val.strip()))]
+    except (ValueError, SyntaxError):
+      questions += [(q.strip(), val.strip())]
+  return questions
+
+
+def _stub_option_labels(prompt):
+  return re.findall(r"^([A-Z])\) ", 
+                    prompt.split("Options (Letter Answer):")[-1], re.M)
+
+
+def stub_logprobs(prompt, text):
+  """
+  The (token, logprob) candidates of the first token of the completion of 
+  <prompt>, most likely first. For the letter-answer prompts, it is a 
+  deterministic distribution over the option letters; otherwise the 
+  completion's first token is certain. 
+  """
+  labels = _stub_option_labels(prompt)
+  if "Options (Letter Answer):" not in prompt or not labels: 
+    return [(text[:4], 0.0)]
+  h = _hash_int(prompt)
+  scores = [((h >> (count * 5)) % 32) / 8 for count in range(len(labels))]
+  log_total = math.log(sum(math.exp(score) for score in scores))
+  candidates = [(label, score - log_total) 
+                for label, score in zip(labels, scores)]
+  return sorted(candidates, key=lambda c: c[1], reverse=True)
+
+
+def stub_completion(prompt, sample=0):
+  """
+  Returns a deterministic, well-formed completion for a prompt rendered
+  from one of the prompt templates. Different <sample> numbers give 
+  different completions of the same prompt. 
+  """
+  h = _hash_int(prompt if not sample else f"{prompt}\x00{sample}")
+
+  if "Options (Letter Answer):" in prompt and _stub_option_labels(prompt): 
+    if not sample: 
+      return stub_logprobs(prompt, "")[0][0]
+    # Samples follow the distribution of the log-probabilities. 
+    candidates = stub_logprobs(prompt, "")
+    draw = (h % 10000) / 10000
+    for label, logprob in candidates: 
+      draw -= math.exp(logprob)
+      if draw < 0: 
+        return label
+    return candidates[-1][0]
+
+  if '{"utterance"' in prompt:
+    words = ["I", "think", "that", "really", "depends", "on", "the", "day",
+             "honestly", "but", "mostly", "yes", "and", "my", "family",
+             "matters", "most"]
+    utterance = " ".join(words[(h >> i) % len(words)] for i in range(12))
+    return json.dumps({"utterance": utterance.capitalize() + "."})
+
+  if '{"summary"' in prompt:
+    return json.dumps({"summary": f"Stub summary of the earlier turns "
+                                  f"({h % 10000})."})
+
+  if '"reflection"' in prompt:
+    count = re.search(r"Write a list of (\d+) reflections", prompt)
+    count = int(count.group(1)) if count else 1
+    return json.dumps({"reflection": [f"I reflect on this ({(h >> i) % 97})."
+                                      for i in range(count)]})
+
+  if "rate its importance" in prompt.lower():
+    count = len(re.findall(r"^Item \d+:$", prompt, re.M)) or 1
+    return json.dumps({f"Item {i+1}": (h >> (i * 3)) % 101
+                       for i in range(count)})
+
+  if "Question Type: " in prompt:
+    ret = dict()
+    pattern = re.compile(r"^Q\d+: (.*)\nQuestion Type: (\w+)\n(?:\w[\w ]*: (.*))?", 
+                         re.M)
+    for count, (q, resp_type, spec) in enumerate(pattern.findall(prompt)):
+      bits = h >> count
+      try:
+        spec = ast.literal_eval(spec)
+      except (ValueError, SyntaxError):
+        pass
+      if resp_type == "categorical":
+        options = spec if isinstance(spec, list) else [spec]
+        response = options[bits % len(options)]
+      elif resp_type in ["int", "float"]:
+        low, high = (spec[0], spec[-1]) if isinstance(spec, list) else (0, 1)
+        val = low + (high - low) * ((bits % 1000) / 999)
+        response = round(val, 2) if resp_type == "float" else int(round(val))
+      else:
+        response = f"Stub answer {bits % 97}."
+      ret[str(count+1)] = {"Q": q,
+                           "Reasoning": "Stub reasoning.",
+                           "Response": response}
+    return json.dumps(ret)
+
+  if "Option Interpretation" in prompt:
+    ret = dict()
+    for count, (q, options) in enumerate(_stub_questions(prompt, "Option")):
+      options = options if isinstance(options, list) else [options]
+      choice = options[(h >> count) % len(options)]
+      ret[str(count+1)] = {"Q": q,
+                           "Reasoning": "Stub reasoning.",
+                           "Response": choice}
+    return json.dumps(ret)
+
+  if "Range Interpretation" in prompt:
+    float_resp = "a single float value" in prompt
+    ret = dict()
+    for count, (q, scale) in enumerate(_stub_questions(prompt, "Range")):
+      low, high = (scale[0], scale[-1]) if isinstance(scale, list) else (0, 1)
+      frac = ((h >> (count * 7)) % 1000) / 999
+      val = low + (high - low) * frac
+      val = round(val, 2) if float_resp else int(round(val))
+      ret[str(count+1)] = {"Q": q,
+                           "Reasoning": "Stub reasoning.",
+                           "Response": val}
+    return json.dumps(ret)
+
+  return json.dumps({"response": f"stub-{h % 10000}"})
+
+
+# ============================================================================
+# ######################## [SECTION 4: BACKEND REGISTRY] #####################
+# ============================================================================
+
+BACKENDS = {"openai": OpenAIBackend,
+            "stub": StubBackend}
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend() -> LLMBackend:
+  """Returns the backend selected by LLM_BACKEND in the settings."""
+  global _backend
+  if _backend is None:
+    with _backend_lock:
+      if _backend is None:
+        _backend = BACKENDS[LLM_BACKEND]()
+  return _backend
+
+
+def set_backend(backend) -> LLMBackend:
+  """
+  Overrides the current backend. <backend> is either the name of a
+  registered backend or an LLMBackend instance.
+  """
+  global _backend
+  if isinstance(backend, str):
+    backend = BACKENDS[backend]()
+  with _backend_lock:
+    _backend = backend
+  return backend
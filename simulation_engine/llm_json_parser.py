@@ -1,57 +1,215 @@
 import json
 import re
+import string
+
+
+_DECODER = json.JSONDecoder()
+
+_CURLY_QUOTES = str.maketrans({"“": "\"", "”": "\"", "‘": "'", "’": "'"})
 
 
 def extract_first_json_dict(input_str):
-  try:
-    # Replace curly quotes with standard double quotes
-    input_str = (input_str.replace("“", "\"")
-                          .replace("”", "\"")
-                          .replace("‘", "'")
-                          .replace("’", "'"))
-    
-    # Find the first occurrence of '{' in the input_str
-    start_index = input_str.index('{')
-    
-    # Initialize a count to keep track of open and close braces
-    count = 1
-    end_index = start_index + 1
-    
-    # Loop to find the closing '}' for the first JSON dictionary
-    while count > 0 and end_index < len(input_str):
-        if input_str[end_index] == '{':
-            count += 1
-        elif input_str[end_index] == '}':
-            count -= 1
-        end_index += 1
-    
-    # Extract the JSON substring
-    json_str = input_str[start_index:end_index]
-    
-    # Parse the JSON string into a Python dictionary
-    json_dict = json.loads(json_str)
-    
-    return json_dict
-  except ValueError:
-    # Handle the case where the JSON parsing fails
+  """
+  Returns the first JSON dictionary in <input_str> (e.g., a completion that 
+  wraps the JSON in prose or a code fence), or None if there is none. The 
+  completions of structured-output requests are plain JSON, so the common 
+  case is a single raw_decode call. 
+  """
+  if not isinstance(input_str, str): 
     return None
+  for text in [input_str, input_str.translate(_CURLY_QUOTES)]: 
+    start = text.find("{")
+    if start == -1: 
+      return None
+    try: 
+      json_dict, _ = _DECODER.raw_decode(text, start)
+    except ValueError: 
+      continue
+    if isinstance(json_dict, dict): 
+      return json_dict
+  return None
 
 
-def extract_first_json_dict_categorical(input_str): 
-  reasoning_pattern = r'"Reasoning":\s*"([^"]+)"'
-  response_pattern = r'"Response":\s*"([^"]+)"'
+def extract_response_items(input_str): 
+  """
+  The per-question dictionaries ({"Q": ..., "Reasoning": ..., "Response": 
+  ...}) of a categorical or numerical completion, in order, or None if the 
+  completion is not valid JSON. 
+  """
+  json_dict = extract_first_json_dict(input_str)
+  if json_dict is None: 
+    return None
+  if "Response" in json_dict: 
+    return [json_dict]
+  return [val for val in json_dict.values() 
+          if isinstance(val, dict) and "Response" in val]
+
+
+# Fallback patterns for completions that are not valid JSON (e.g., cut off 
+# at max_tokens). The strings may contain escaped quotes. 
+_REASONING_PATTERN = re.compile(r'"Reasoning":\s*"((?:[^"\\]|\\.)*)"')
+_STR_RESPONSE_PATTERN = re.compile(r'"Response":\s*"((?:[^"\\]|\\.)*)"')
+_NUM_RESPONSE_PATTERN = re.compile(r'"Response":\s*"?(-?\d+\.?\d*)')
+
 
-  reasonings = re.findall(reasoning_pattern, input_str)
-  responses = re.findall(response_pattern, input_str)
+def _unescape(json_str): 
+  try: 
+    return json.loads(f'"{json_str}"')
+  except ValueError: 
+    return json_str
 
+
+def extract_first_json_dict_categorical(input_str): 
+  items = extract_response_items(input_str)
+  if items is not None: 
+    responses = [str(i["Response"]) for i in items]
+    reasonings = [str(i.get("Reasoning", "")) for i in items]
+    return responses, reasonings
+
+  if not isinstance(input_str, str): 
+    return [], []
+  reasonings = [_unescape(i) for i in _REASONING_PATTERN.findall(input_str)]
+  responses = [_unescape(i) for i in _STR_RESPONSE_PATTERN.findall(input_str)]
   return responses, reasonings
 
 
 def extract_first_json_dict_numerical(input_str): 
-  reasoning_pattern = re.compile(r'"Reasoning":\s*"([^"]+)"')
-  response_pattern = re.compile(r'"Response":\s*(\d+\.?\d*)')
+  items = extract_response_items(input_str)
+  if items is not None: 
+    responses = [i["Response"] for i in items]
+    reasonings = [str(i.get("Reasoning", "")) for i in items]
+    return responses, reasonings
 
-  reasonings = reasoning_pattern.findall(input_str)
-  responses = response_pattern.findall(input_str)
+  if not isinstance(input_str, str): 
+    return [], []
+  reasonings = [_unescape(i) for i in _REASONING_PATTERN.findall(input_str)]
+  responses = _NUM_RESPONSE_PATTERN.findall(input_str)
   return responses, reasonings
 
+
+def strict_object(properties): 
+  """A JSON schema object that requires exactly the given properties."""
+  return {"type": "object", 
+          "properties": properties, 
+          "required": list(properties.keys()), 
+          "additionalProperties": False}
+
+
+def json_schema_format(name, properties): 
+  """
+  The response_format of a structured-output request whose completion is a 
+  JSON object with the given properties (a dict of property name to JSON 
+  schema). 
+  """
+  return {"type": "json_schema", 
+          "json_schema": {"name": name, 
+                          "strict": True, 
+                          "schema": strict_object(properties)}}
+
+
+_JSON_ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 
+                 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+
+
+def _is_hex(text): 
+  return all(c in string.hexdigits for c in text)
+
+
+def _unicode_escape(buffer, i): 
+  """
+  Decodes the \\u escape at buffer[i] (and its low surrogate, if it starts 
+  a surrogate pair). Returns the decoded text and the number of characters 
+  it took, or None if the escape is not complete yet. A malformed escape 
+  is kept as literal text. 
+  """
+  digits = buffer[i+2:i+6]
+  if not _is_hex(digits): 
+    return buffer[i:i+2], 2
+  if len(digits) < 4: 
+    return None
+  code = int(digits, 16)
+  if 0xDC00 <= code <= 0xDFFF: 
+    return buffer[i:i+6], 6
+  if not 0xD800 <= code <= 0xDBFF: 
+    return chr(code), 6
+
+  # A surrogate pair needs the second half. 
+  low = buffer[i+6:i+12]
+  if low[:2] != "\\u"[:len(low)] or not _is_hex(low[2:]): 
+    return buffer[i:i+6], 6
+  if len(low) < 6: 
+    return None
+  low = int(low[2:], 16)
+  if not 0xDC00 <= low <= 0xDFFF: 
+    return buffer[i:i+6], 6
+  return chr(0x10000 + ((code - 0xD800) << 10) + (low - 0xDC00)), 12
+
+
+class IncrementalJSONFieldParser: 
+  """
+  Extracts the value of one string field (e.g., "utterance") from a JSON 
+  object that arrives in chunks, and emits the decoded text of the value as 
+  soon as it arrives instead of waiting for the object to close. 
+
+  Usage: 
+    parser = IncrementalJSONFieldParser("utterance")
+    for chunk in stream: 
+      print(parser.feed(chunk), end="")
+  """
+  def __init__(self, field): 
+    self.key_pattern = re.compile(r'"%s"\s*:\s*"' % re.escape(field))
+    self.buffer = ""
+    self.state = "seek"
+    self.value = ""
+
+
+  def feed(self, chunk): 
+    """
+    Adds <chunk> to the parser and returns the newly decoded part of the 
+    field's value ("" if there is none yet). 
+    """
+    self.buffer += chunk
+    if self.state == "seek": 
+      match = self.key_pattern.search(self.buffer)
+      if not match: 
+        return ""
+      self.buffer = self.buffer[match.end():]
+      self.state = "value"
+    if self.state != "value": 
+      return ""
+
+    out = []
+    i = 0
+    buffer = self.buffer
+    while i < len(buffer): 
+      c = buffer[i]
+      if c == '"': 
+        self.state = "done"
+        i += 1
+        break
+      if c != "\\": 
+        out += [c]
+        i += 1
+        continue
+      # An escape sequence; wait for the rest of it if it is incomplete. 
+      if i + 1 >= len(buffer): 
+        break
+      if buffer[i+1] != "u": 
+        out += [_JSON_ESCAPES.get(buffer[i+1], buffer[i+1])]
+        i += 2
+        continue
+      escape = _unicode_escape(buffer, i)
+      if escape is None: 
+        break
+      out += [escape[0]]
+      i += escape[1]
+    self.buffer = buffer[i:]
+
+    text = "".join(out)
+    self.value += text
+    return text
+
+
+  def found(self): 
+    """True once the parser has found the field."""
+    return self.state != "seek"
@@ -0,0 +1,139 @@
+import json
+import os
+
+import pandas as pd
+
+try:
+  import orjson
+except ImportError:
+  orjson = None
+
+
+def _ensure_folder(path):
+  """Creates the folder that contains the file at <path>."""
+  if os.path.dirname(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+
+# ============================================================================
+# ########################### [SECTION 1: JSON CODEC] ########################
+# ============================================================================
+
+def dumps(obj) -> bytes:
+  """
+  Compact JSON encoding of <obj>, with orjson if it is installed (numpy
+  values and non-string keys are supported either way).
+  """
+  if orjson is not None:
+    return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY
+                                    | orjson.OPT_NON_STR_KEYS)
+  return json.dumps(obj, separators=(",", ":"), ensure_ascii=False,
+                    default=_to_builtin).encode("utf-8")
+
+
+def loads(data):
+  if orjson is not None:
+    return orjson.loads(data)
+  return json.loads(data)
+
+
+def _to_builtin(obj):
+  # numpy scalars and arrays, for the json fallback.
+  if hasattr(obj, "tolist"):
+    return obj.tolist()
+  raise TypeError(f"Object of type {type(obj).__name__} is not JSON "
+                  f"serializable")
+
+
+def write_json(obj, path):
+  _ensure_folder(path)
+  with open(path, "wb") as f:
+    f.write(dumps(obj))
+
+
+def read_json(path):
+  with open(path, "rb") as f:
+    return loads(f.read())
+
+
+def write_jsonl(records, path):
+  """Writes <records> as JSON Lines, one record per line."""
+  _ensure_folder(path)
+  with open(path, "wb") as f:
+    for record in records:
+      f.write(dumps(record) + b"\n")
+
+
+def read_jsonl(path):
+  with open(path, "rb") as f:
+    return [loads(line) for line in f if line.strip()]
+
+
+# ============================================================================
+# ########################## [SECTION 2: TABLES] #############################
+# ============================================================================
+
+def parquet_available() -> bool:
+  """Whether pandas can write Parquet (it needs pyarrow or fastparquet)."""
+  for module in ["pyarrow", "fastparquet"]:
+    try:
+      __import__(module)
+      return True
+    except ImportError:
+      continue
+  return False
+
+
+def _typed_for_parquet(frame):
+  """
+  Gives every column a single type: the nullable pandas dtypes where they
+  fit, and strings for the object columns that mix types (e.g., answers
+  that are sometimes numbers), which Parquet cannot store.
+  """
+  frame = frame.convert_dtypes()
+  for col in frame.columns:
+    if frame[col].dtype == object and pd.api.types.infer_dtype(
+        frame[col], skipna=True).startswith("mixed"):
+      frame[col] = frame[col].astype("string")
+  return frame
+
+
+def write_table(frame, path_stem, fmt="csv"):
+  """
+  Writes <frame> to <path_stem>.csv or, with <fmt> "parquet", to
+  <path_stem>.parquet with typed columns. Falls back on CSV if no Parquet
+  engine is installed. Returns the path written.
+  """
+  _ensure_folder(path_stem)
+  if fmt == "parquet" and not parquet_available():
+    print("Parquet needs pyarrow (pip install pyarrow); writing CSV instead.")
+    fmt = "csv"
+  if fmt == "parquet":
+    path = f"{path_stem}.parquet"
+    _typed_for_parquet(frame).to_parquet(path, index=False)
+  else:
+    path = f"{path_stem}.csv"
+    frame.to_csv(path, index=False)
+  # A table left in the other format would shadow this one in find_table.
+  for ext in [".parquet", ".csv"]:
+    if path_stem + ext != path and os.path.exists(path_stem + ext):
+      os.remove(path_stem + ext)
+  return path
+
+
+def find_table(path_stem):
+  """The saved table at <path_stem> (Parquet first, then CSV), or None."""
+  for ext in [".parquet", ".csv"]:
+    if os.path.exists(path_stem + ext):
+      return path_stem + ext
+  return None
+
+
+def read_table(path):
+  """Reads a table written by write_table; the format is detected from the
+  extension. An empty CSV file gives an empty frame."""
+  if path.endswith(".parquet"):
+    return pd.read_parquet(path)
+  if not os.path.getsize(path):
+    return pd.DataFrame()
+  return pd.read_csv(path)
@@ -0,0 +1,147 @@
+"""
+Save/load benchmark of the formats in serialization.py, against the way the
+same files were written before (list-of-lists CSV, indented json).
+
+Run it from the repository root:
+  python -m simulation_engine.serialization_benchmark [--rows 100000]
+
+Every timing is the best of <repeat> runs. Parquet is only measured if
+pyarrow (or fastparquet) is installed.
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import numpy
+import pandas as pd
+
+from simulation_engine.settings import *
+from simulation_engine.global_methods import write_list_of_list_to_csv
+from simulation_engine.serialization import *
+
+
+SAMPLE_AGENT = (f"{POPULATIONS_DIR}/single_agent/"
+                f"01fd7d2a-0357-4c1b-9f3e-8eade2d537ae")
+
+
+def best_time(func, repeat=3):
+  best = float("inf")
+  for _ in range(repeat):
+    start = time.perf_counter()
+    func()
+    best = min(best, time.perf_counter() - start)
+  return best
+
+
+def _json_dump(obj, path, indent=None):
+  with open(path, "w") as f:
+    json.dump(obj, f, indent=indent)
+
+
+def _json_load(path):
+  with open(path, "r") as f:
+    return json.load(f)
+
+
+def survey_frame(rows, questions=20, seed=0):
+  """A responses table of <rows> agents, half categorical, half numbers."""
+  rng = numpy.random.default_rng(seed)
+  frame = pd.DataFrame({"agent_pid": [f"agent_pid_{i}" for i in range(rows)]})
+  for count in range(questions):
+    if count % 2:
+      frame[f"Q{count}"] = rng.choice(
+        ["Strongly agree", "Agree", "Disagree", None], rows)
+    else:
+      frame[f"Q{count}"] = rng.integers(0, 100, rows)
+  return frame.astype(object)
+
+
+def transcripts(agents, turns=20):
+  """Interview responses of <agents> agents with <turns> utterances each."""
+  return {f"agent_pid_{i}": [["Interviewer", "What do you do on weekends?"],
+                             [f"agent_pid_{i}", "Mostly errands and some time "
+                                                "outdoors with my family. " * 4]]
+                            * (turns // 2)
+          for i in range(agents)}
+
+
+def bench_survey(folder, rows, repeat):
+  frame = survey_frame(rows)
+  stem = os.path.join(folder, "responses")
+  ret = {"csv (list of lists) save": best_time(
+           lambda: write_list_of_list_to_csv(
+             [list(frame.columns)] + frame.values.tolist(), f"{stem}_old.csv"),
+           repeat),
+         "csv save": best_time(lambda: write_table(frame, stem), repeat)}
+  ret["csv load"] = best_time(lambda: read_table(f"{stem}.csv"), repeat)
+  if parquet_available():
+    ret["parquet save"] = best_time(
+      lambda: write_table(frame, stem, "parquet"), repeat)
+    ret["parquet load"] = best_time(
+      lambda: read_table(f"{stem}.parquet"), repeat)
+  return ret
+
+
+def bench_transcripts(folder, agents, repeat):
+  responses = transcripts(agents)
+  paths = {fmt: os.path.join(folder, f"transcripts_{fmt}")
+           for fmt in ["indent", "json", "jsonl"]}
+  records = lambda: [{"agent_pid": agent_pid, "transcript": transcript}
+                     for agent_pid, transcript in responses.items()]
+  return {"json indent=2 save": best_time(
+            lambda: _json_dump(responses, paths["indent"], 2), repeat),
+          "json save": best_time(
+            lambda: write_json(responses, paths["json"]), repeat),
+          "jsonl save": best_time(
+            lambda: write_jsonl(records(), paths["jsonl"]), repeat),
+          "json indent=2 load": best_time(
+            lambda: _json_load(paths["indent"]), repeat),
+          "json load": best_time(lambda: read_json(paths["json"]), repeat),
+          "jsonl load": best_time(lambda: read_jsonl(paths["jsonl"]), repeat)}
+
+
+def bench_agent(folder, repeat):
+  files = [f"{SAMPLE_AGENT}/memory_stream/embeddings.json",
+           f"{SAMPLE_AGENT}/memory_stream/nodes.json"]
+  contents = [read_json(path) for path in files]
+  out = [os.path.join(folder, os.path.basename(path)) for path in files]
+  return {"json load": best_time(
+            lambda: [_json_load(path) for path in files], repeat),
+          "codec load": best_time(
+            lambda: [read_json(path) for path in files], repeat),
+          "json save": best_time(
+            lambda: [_json_dump(obj, path, indent) for obj, path, indent
+                     in zip(contents, out, [None, 2])], repeat),
+          "codec save": best_time(
+            lambda: [write_json(obj, path)
+                     for obj, path in zip(contents, out)], repeat)}
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+  parser.add_argument("--rows", type=int, default=100000,
+                      help="agents in the survey responses table")
+  parser.add_argument("--agents", type=int, default=3505,
+                      help="agents in the interview transcripts")
+  parser.add_argument("--repeat", type=int, default=3)
+  args = parser.parse_args()
+
+  print(f"orjson: {'yes' if orjson is not None else 'no'}, "
+        f"parquet: {'yes' if parquet_available() else 'no'}")
+  with tempfile.TemporaryDirectory() as folder:
+    benches = [(f"survey responses ({args.rows} x 20)",
+                lambda: bench_survey(folder, args.rows, args.repeat)),
+               (f"interview transcripts ({args.agents} x 20 turns)",
+                lambda: bench_transcripts(folder, args.agents, args.repeat)),
+               ("agent memory stream (single_agent)",
+                lambda: bench_agent(folder, args.repeat))]
+    for title, bench in benches:
+      print(f"\n{title}")
+      for name, seconds in bench().items():
+        print(f"  {name:<28}{seconds:8.3f}s")
+
+
+if __name__ == "__main__":
+  main()